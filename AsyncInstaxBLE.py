@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import sys
+
+# Try to import with a relative import first
+try:
+    from .InstaxBLE import InstaxBLE, lazy_import
+    from .Types import EventType, InfoType, QUALITY_MODES
+    from .TransferStats import TransferStats
+    from . import LedPatterns
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from InstaxBLE import InstaxBLE, lazy_import
+    from Types import EventType, InfoType, QUALITY_MODES
+    from TransferStats import TransferStats
+    import LedPatterns
+
+from collections import deque
+from struct import pack, unpack_from
+from time import perf_counter
+
+
+class AsyncInstaxBLE(InstaxBLE):
+    """
+    asyncio version of InstaxBLE. Instead of busy-waiting for a reply, every
+    command returns a future that gets resolved by the notification handler
+    as soon as the printer replies.
+    """
+
+    def __init__(self, *args, timeout=5, transfer_window=1, reconnect_attempts=3, **kwargs):
+        """
+        Initialize the AsyncInstaxBLE class. Takes the same arguments as InstaxBLE.
+        timeout: seconds to wait for the printer to reply to a command.
+        transfer_window: number of image chunks to send ahead before waiting for
+            the printer to acknowledge them. 1 means stop-and-wait.
+        reconnect_attempts: number of times to reconnect and resume when the
+            connection drops during an image transfer.
+        """
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+        self.transferWindow = max(1, transfer_window)
+        self.reconnectAttempts = reconnect_attempts
+        self.transferPosition = 0  # number of image packets the printer acknowledged, a resumed transfer continues from there
+        self.loop = None
+        self.pendingResponses = {}
+        self.pendingChunks = {}
+        self.pendingInfo = {}  # InfoType value -> future, for pipelined info requests
+        self.pipelineInfo = True  # set to False when the printer doesn't answer pipelined info requests
+        self.commandLock = asyncio.Lock()
+        self.connectLock = asyncio.Lock()  # held while connecting, so a reconnect and e.g. the daemon don't connect at the same time
+
+    def parse_printer_response(self, event, packet):
+        """ Parse the response packet and resolve the command waiting for it """
+        try:
+            super().parse_printer_response(event, packet)
+        finally:
+            # notifications arrive on simplepyble's thread, so hand the reply over to our event loop
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self.resolve_response, event.value, bytes(packet))
+
+    def resolve_response(self, opCode, packet):
+        """ Resolve the future of the command waiting for this reply (if any) """
+        if opCode == EventType.PRINT_IMAGE_DOWNLOAD_DATA.value and self.pendingChunks:
+            # replies to image chunks echo the chunk index after the status byte,
+            # if they don't we match them to the oldest unacknowledged chunk
+            if len(packet) >= 12:
+                index = unpack_from('>I', packet, 7)[0]
+            else:
+                index = min((i for i, f in self.pendingChunks.items() if not f.done()), default=None)
+            future = self.pendingChunks.get(index)
+            if future is not None and not future.done():
+                future.set_result(packet)
+            return
+
+        if opCode == EventType.SUPPORT_FUNCTION_INFO.value and packet[7] in self.pendingInfo:
+            future = self.pendingInfo.pop(packet[7])
+            if not future.done():
+                future.set_result(packet)
+            return
+
+        future = self.pendingResponses.pop(opCode, None)
+        if future is not None and not future.done():
+            future.set_result(packet)
+
+    def handle_image_packet_queue(self):
+        """ Not used: print_image sends the image packets itself """
+        pass
+
+    def continue_image_transfer(self, packet):
+        """ Not used: send_image_packets checks the replies itself """
+        pass
+
+    async def connect(self, timeout=0):
+        """ Connect to the printer. Stops trying after <timeout> seconds. """
+        async with self.connectLock:
+            await self.connect_peripheral(timeout)
+
+    async def ensure_connected(self, timeout=0):
+        """
+        Connect to the printer, unless we're connected already (or someone
+        else connected while we waited for the lock). Returns True if we're connected.
+        """
+        async with self.connectLock:
+            if not self.is_connected():
+                await self.connect_peripheral(timeout)
+        return self.is_connected()
+
+    async def connect_peripheral(self, timeout):
+        """ Connect to the printer and read its info, with connectLock held """
+        self.loop = asyncio.get_running_loop()
+        if self.dummyPrinter:
+            return
+
+        start = perf_counter()
+        if self.peripheral is None:
+            self.peripheral = await self.loop.run_in_executor(None, self.find_device, timeout)
+        if self.peripheral:
+            try:
+                if not self.peripheral.is_connected():  # find_device already connects to known printers
+                    self.log(f"Connecting to {self.peripheral.identifier()} [{self.peripheral.address()}]")
+                    await self.loop.run_in_executor(None, self.peripheral.connect)
+            except Exception as e:
+                if not self.quiet:
+                    self.log(f'error on connecting: {e}')
+
+            if self.peripheral.is_connected():
+                self.log("Connected")
+                self.update_fragment_size()
+                self.frameReassembler.reset()
+                self.state.invalidate()
+                self.ledPatterns.clear()
+                self.sentLedPatterns.clear()
+                self.sentTimes.clear()  # replies to commands sent before reconnecting won't come anymore
+                try:
+                    self.peripheral.notify(self.serviceUUID, self.notifyCharUUID, self.notification_handler)
+                except Exception as e:
+                    if not self.quiet:
+                        self.log(f'Error on attaching notification_handler: {e}')
+                        return
+
+                self.connectTime = perf_counter() - start
+                await self.get_printer_info()
+                await self.loop.run_in_executor(None, self.remember_printer)
+                if not self.quiet:
+                    self.display_current_status()
+
+    async def disconnect(self):
+        """ Disconnect from the printer (if connected) """
+        if self.loop is None:
+            return super().disconnect()
+        await self.loop.run_in_executor(None, super().disconnect)
+
+    async def send_packet(self, packet, timeout=None):
+        """
+        Send a packet to the printer and return the printer's reply to it.
+        Raises asyncio.TimeoutError if no reply arrives within <timeout> seconds.
+        """
+        if self.dummyPrinter:
+            return None
+
+        if not self.quiet:
+            if not self.peripheral:
+                self.log("no peripheral to send packet to")
+            elif not self.peripheral.is_connected():
+                self.log("peripheral not connected")
+
+        # the printer handles one command at a time, so neither do we
+        async with self.commandLock:
+            opCode = (packet[4], packet[5])
+            future = self.loop.create_future()
+            self.pendingResponses[opCode] = future
+            try:
+                await self.write_packet_async(packet)
+                return await asyncio.wait_for(future, timeout or self.timeout)
+            finally:
+                if self.pendingResponses.get(opCode) is future:
+                    del self.pendingResponses[opCode]
+                self.sentTimes.pop(self.request_key(packet), None)  # on a timeout, so a late reply doesn't get timed
+
+    async def write_packet_async(self, packet):
+        """ Write a packet to the printer, without blocking the event loop on write requests """
+        if self.get_write_mode(packet) == 'request':
+            await self.loop.run_in_executor(None, self.write_packet, packet)
+        else:
+            self.write_packet(packet)
+
+    async def cancel_print(self):
+        """ Cancel the current image transfer """
+        self.packetsForPrinting = deque()
+        self.sentTimes.clear()
+        if self.dummyPrinter or not self.peripheral or not self.peripheral.is_connected():
+            return
+        try:
+            await self.send_packet(self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_CANCEL))
+        except asyncio.TimeoutError:
+            self.log('No reply to cancel command')
+
+    async def send_led_pattern(self, pattern, speed=5, repeat=255, when=0, force=False):
+        """
+        Send a LED pattern to the Instax printer. See InstaxBLE.send_led_pattern for details.
+        Returns the printer's reply, or None if the printer was already showing the pattern.
+        """
+        payload = self.create_color_payload(pattern, speed, repeat, when)
+        if not force and self.is_led_pattern_active(payload):
+            self.log('LED pattern already set, not sending it again')
+            return None
+        packet = self.create_packet(EventType.LED_PATTERN_SETTINGS, payload)
+        reply = await self.send_packet(packet)
+        if reply is not None and reply[6] == 0:
+            self.ledPatterns[when] = payload
+        return reply
+
+    async def get_printer_orientation(self):
+        """ Get the current XYZ orientation of the printer """
+        await self.send_packet(self.create_packet(EventType.XYZ_AXIS_INFO))
+        return self.pos
+
+    async def get_printer_status(self):
+        """ Get the printer's status"""
+        packet = self.create_packet(EventType.SUPPORT_FUNCTION_INFO, pack('>B', InfoType.PRINTER_FUNCTION_INFO.value))
+        await self.send_packet(packet)
+
+    async def get_printer_info(self):
+        """ Get the printer's status and info, like photos left and battery level """
+        await self.refresh_status(force=True)
+
+    async def refresh_status(self, force=False):
+        """ Request the printer info that's older than its TTL (see PrinterState), or all of it if <force> is set """
+        infoTypes = list(self.state.ttls) if force else self.state.stale()
+        if len(infoTypes) > 0:
+            await self.request_info(infoTypes)
+
+    async def request_info(self, infoTypes, timeout=None):
+        """
+        Request several types of function info in one go: all requests are
+        written before waiting for the replies, which get matched by their
+        info type. Falls back to one request at a time if the printer doesn't
+        answer pipelined requests.
+        """
+        if self.dummyPrinter:
+            return
+        if self.pipelineInfo and len(infoTypes) > 1:
+            async with self.commandLock:
+                futures = {infoType.value: self.loop.create_future() for infoType in infoTypes}
+                self.pendingInfo.update(futures)
+                try:
+                    for infoType in infoTypes:
+                        await self.write_packet_async(self.create_packet(EventType.SUPPORT_FUNCTION_INFO, pack('>B', infoType.value)))
+                    done, pending = await asyncio.wait(futures.values(), timeout=timeout or self.timeout)
+                finally:
+                    for value in futures:
+                        self.pendingInfo.pop(value, None)
+                        self.sentTimes.pop((EventType.SUPPORT_FUNCTION_INFO.value, value), None)
+            if len(pending) == 0:
+                return
+            self.log('Printer did not answer pipelined info requests, sending them one at a time from now on')
+            self.pipelineInfo = False
+            infoTypes = [infoType for infoType in infoTypes if not futures[infoType.value].done()]
+
+        for infoType in infoTypes:
+            await self.send_packet(self.create_packet(EventType.SUPPORT_FUNCTION_INFO, pack('>B', infoType.value)), timeout)
+
+    def is_idle(self):
+        """ Check if we're connected and not sending anything to the printer """
+        return self.is_connected() and not self.commandLock.locked() and len(self.packetsForPrinting) == 0
+
+    async def keep_state_fresh(self, interval=1):
+        """
+        Refresh printer info that's older than its TTL in the background, but
+        only while the printer is idle, so it never competes with an image
+        transfer. Run it as a task and cancel that to stop.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if self.is_idle() and len(self.state.stale()) > 0:
+                try:
+                    await self.refresh_status()
+                except asyncio.TimeoutError:
+                    self.log('No reply to background status request')
+
+    async def print_image(self, imgSrc, timeout=None):
+        """
+        Print an image. Either pass a path to an image (as a string) or pass
+        the bytearray to print directly. Returns once the last packet has been
+        acknowledged by the printer. On a timeout or when the task gets
+        cancelled, the transfer is cancelled on the printer as well.
+        """
+        self.log(f'printing image "{imgSrc}"')
+        if self.photosLeft == 0 and not self.dummyPrinter:
+            self.log("Can't print: no photos left")
+            return False
+
+        self.stats = TransferStats(self.connectTime)
+        self.photosBeforePrint = self.photosLeft
+        self.printStartedAt = None
+        self.printError = None
+        start = perf_counter()
+        # resizing and encoding is CPU work, keep it off the event loop
+        imgData = await asyncio.get_running_loop().run_in_executor(None, self.get_prepared_image, imgSrc)
+        self.stats.encodeTime = perf_counter() - start
+        packets = list(self.create_image_packets(imgData))
+        self.cancelled = False
+        self.start_transfer_stats(imgData)
+
+        position = 0
+        resumed = False
+        reconnects = 0
+        try:
+            while True:
+                try:
+                    if await self.send_image_packets(packets, timeout, position):
+                        return True
+                    failure = None
+                except (asyncio.TimeoutError, RuntimeError, ConnectionError) as e:
+                    failure = e
+
+                if not self.is_connected() and reconnects < self.reconnectAttempts:
+                    # the connection dropped, reconnect and continue where the printer left off
+                    reconnects += 1
+                    self.report_error(f'Connection lost after {self.transferPosition} of {len(packets)} packets, reconnecting')
+                    await self.reconnect()
+                    position = self.transferPosition if self.transferPosition > 1 else 0
+                    resumed = position > 0
+                    self.stats.resumes += 1
+                    continue
+                elif resumed and self.is_connected():
+                    # the printer didn't accept (or didn't answer) continuing the old transfer, start over
+                    self.log(f'Printer rejected resuming at packet {position}, restarting the transfer')
+                    self.stats.restarts += 1
+                    resumed = False
+                elif failure is not None:
+                    raise failure
+                elif self.printError is not None:
+                    # the printer rejected starting, ending or printing the transfer, retrying won't help
+                    await self.cancel_print()
+                    return False
+                elif self.transferWindow > 1:
+                    # not every model accepts chunks it hasn't acknowledged the previous one of yet,
+                    # so start over without sending ahead
+                    self.log(f'Printer rejected a transfer window of {self.transferWindow}, falling back to 1')
+                    self.transferWindow = 1
+                else:
+                    self.printError = 'Printer rejected the image'
+                    self.report_error(self.printError)
+                    await self.cancel_print()
+                    return False
+
+                await self.cancel_print()
+                self.sentTimes.clear()
+                self.stats.chunksAcked = 0
+                self.printError = None
+                position = 0
+        except (asyncio.TimeoutError, asyncio.CancelledError, RuntimeError, ConnectionError):
+            self.report_error('Image transfer interrupted, cancelling print')
+            self.cancelled = True
+            await self.cancel_print()
+            raise
+
+    def is_connected(self):
+        """ Check if we're connected to the printer """
+        return self.dummyPrinter or (self.peripheral is not None and self.peripheral.is_connected())
+
+    async def reconnect(self):
+        """ Reconnect to the printer after the connection dropped """
+        for attempt in range(self.reconnectAttempts):
+            try:
+                await self.ensure_connected()
+            except Exception as e:
+                self.log(f'Reconnecting failed: {e}')
+            if self.is_connected():
+                return
+            await asyncio.sleep(1)
+        raise ConnectionError('Could not reconnect to the printer')
+
+    def packet_acknowledged(self, packet):
+        """ Keep track of how far the printer got, so a transfer can be resumed from there """
+        self.transferPosition += 1
+
+    async def send_image_packets(self, packets, timeout=None, start=0):
+        """
+        Send the packets created by create_image_packets, starting at packet
+        <start>. Returns False if the printer rejected one of them, if that
+        wasn't an image chunk printError says which.
+        """
+        self.packetsForPrinting = deque(packets[start:])
+        self.transferPosition = start
+        while len(self.packetsForPrinting) > 0:
+            if len(self.packetsForPrinting) % 10 == 0:
+                self.log(f"Img packets left to send: {len(self.packetsForPrinting)}")
+
+            if self.transferWindow > 1 and self.is_image_chunk(self.packetsForPrinting[0]):
+                chunks = []
+                while len(self.packetsForPrinting) > 0 and self.is_image_chunk(self.packetsForPrinting[0]):
+                    chunks.append(self.packetsForPrinting.popleft())
+                if not await self.send_image_chunks(chunks, timeout):
+                    return False
+            else:
+                packet = self.packetsForPrinting.popleft()
+                reply = await self.send_packet(packet, timeout)
+                if reply is not None and reply[6] != 0:
+                    if self.is_image_chunk(packet):
+                        self.log(f'Printer rejected image chunk {unpack_from(">I", packet, 6)[0]} (status {reply[6]})')
+                    else:
+                        self.print_rejected(reply)
+                    return False
+                self.packet_acknowledged(packet)
+        return True
+
+    def is_image_chunk(self, packet):
+        """ Check if a packet is a PRINT_IMAGE_DOWNLOAD_DATA packet """
+        return (packet[4], packet[5]) == EventType.PRINT_IMAGE_DOWNLOAD_DATA.value
+
+    async def send_image_chunks(self, packets, timeout=None):
+        """
+        Send PRINT_IMAGE_DOWNLOAD_DATA packets while keeping up to <transferWindow>
+        of them in flight, matching every reply to its chunk index. Returns False
+        if the printer rejected (or never acknowledged) one of the chunks.
+        """
+        if self.dummyPrinter:
+            return True
+
+        inFlight = deque()
+        async with self.commandLock:
+            try:
+                for packet in packets:
+                    if len(inFlight) >= self.transferWindow:
+                        if not await self.wait_for_chunk(*inFlight.popleft(), timeout):
+                            return False
+                    index = unpack_from('>I', packet, 6)[0]
+                    self.pendingChunks[index] = self.loop.create_future()
+                    inFlight.append((index, packet))
+                    await self.write_packet_async(packet)
+
+                while len(inFlight) > 0:
+                    if not await self.wait_for_chunk(*inFlight.popleft(), timeout):
+                        return False
+            finally:
+                for index in self.pendingChunks:
+                    self.sentTimes.pop((EventType.PRINT_IMAGE_DOWNLOAD_DATA.value, index), None)
+                self.pendingChunks.clear()
+        return True
+
+    async def wait_for_chunk(self, index, packet, timeout=None):
+        """ Wait for the reply to image chunk <packet> with the given index. Returns False if it was rejected. """
+        try:
+            reply = await asyncio.wait_for(self.pendingChunks[index], timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.report_error(f'No reply to image chunk {index}')
+            return False
+        finally:
+            del self.pendingChunks[index]
+            self.sentTimes.pop(self.request_key(packet), None)
+        if reply[6] != 0:
+            self.log(f'Printer rejected image chunk {index} (status {reply[6]})')
+            return False
+        self.packet_acknowledged(packet)
+        return True
+
+    async def wait_one_minute(self):
+        """ Wait for one minute. Hacky way of preventing disconnecting too soon """
+        if not self.quiet:
+            print("Waiting for one minute...")
+        await asyncio.sleep(60)
+
+    async def wait_for_print_completion(self, timeout=120, interval=1):
+        """
+        Wait until the printer has finished printing the last image, by polling
+        its photo counter every <interval> seconds until it drops. Returns the
+        number of seconds the print took (counted from the printer accepting
+        the print command), or None if it didn't finish within <timeout> seconds
+        or the printer rejected it (see printError).
+        """
+        if self.dummyPrinter or not self.printEnabled:
+            return 0
+        if not self.quiet:
+            print("Waiting for the print to finish...")
+        start = perf_counter()
+        while perf_counter() - start < timeout:
+            if self.printError is not None:
+                return self.print_failed()
+            if self.print_finished():
+                return self.print_completed()
+            await asyncio.sleep(interval)
+            try:
+                await self.get_printer_status()
+            except asyncio.TimeoutError:
+                self.log('No reply to status request while printing')
+        return self.print_timed_out(timeout)
+
+
+async def main(args={}):
+    """ Example usage of the AsyncInstaxBLE class """
+    instax = AsyncInstaxBLE(**args)
+    try:
+        if instax.image_path:
+            instax.prepare_image_ahead(instax.image_path)
+        await instax.connect()
+        await instax.send_led_pattern(LedPatterns.rainbow, when=1)
+        await instax.send_led_pattern(LedPatterns.pulseGreen, when=2)
+
+        if instax.image_path:
+            await instax.print_image(instax.image_path)
+        else:
+            await instax.print_image(instax.printerSettings['exampleImage'])
+        await instax.wait_for_print_completion()
+
+    except ConnectionError:
+        raise  # e.g. no bluetooth adapters, shown without a traceback below
+    except Exception as e:
+        print(type(e).__name__, __file__, e.__traceback__.tb_lineno)
+        instax.log(f'Error: {e}')
+    finally:
+        await instax.disconnect()  # all done, disconnect
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--device-address')
+    parser.add_argument('-n', '--device-name')
+    parser.add_argument('-p', '--print-enabled', action='store_true')
+    parser.add_argument('-d', '--dummy-printer', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    parser.add_argument('-i', '--image-path', help='Path to the image file')
+    parser.add_argument('-t', '--timeout', type=float, default=5, help='Seconds to wait for a reply from the printer')
+    parser.add_argument('-w', '--transfer-window', type=int, default=1, help='Number of image chunks to send ahead')
+    parser.add_argument('--control-write-mode', choices=['command', 'request'], default='command')
+    parser.add_argument('--image-write-mode', choices=['command', 'request'], default='command')
+    parser.add_argument('--quality-mode', choices=QUALITY_MODES, default='search',
+                        help='How to find the JPEG quality that fits the file size limit')
+    parser.add_argument('-c', '--cache-dir', help='Cache printer-ready images in this directory')
+    parser.add_argument('--cache-size', type=int, default=100, help='Max size of the image cache in MB')
+    parser.add_argument('--no-known-printers', action='store_true',
+                        help="Don't remember printers or try to connect to remembered ones before scanning")
+    parser.add_argument('--simulate', choices=['mini', 'square', 'wide'], help='Use a simulated printer of this model instead of a real one')
+    args = vars(parser.parse_args())
+
+    cacheDir, cacheSize = args.pop('cache_dir'), args.pop('cache_size')
+    if cacheDir:
+        args['image_cache'] = lazy_import('ImageCache').ImageCache(cacheDir, cacheSize)
+    simulate, noKnownPrinters = args.pop('simulate'), args.pop('no_known_printers')
+    if simulate:
+        simulator = lazy_import('SimulatedPrinter')
+        args['adapter'] = simulator.SimulatedAdapter([simulator.SimulatedPrinter(simulate)])
+    elif not noKnownPrinters:
+        args['known_printers'] = lazy_import('KnownPrinters').KnownPrinters()
+    try:
+        asyncio.run(main(args))
+    except ConnectionError as e:
+        sys.exit(str(e))
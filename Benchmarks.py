@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+""" Benchmarks for InstaxBLE. Run with --help to see the available benchmarks. """
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from io import BytesIO
+from struct import pack
+from time import perf_counter
+from timeit import repeat
+
+# Try to import with a relative import first
+try:
+    from .AsyncInstaxBLE import AsyncInstaxBLE
+    from .InstaxBLE import InstaxBLE
+    from .FrameParser import FrameReassembler
+    from .ImageEncoder import encode_jpeg, prepare_jpeg, QUALITY_MODES
+    from .Packetizer import create_image_data_packets
+    from .SimulatedPrinter import SimulatedAdapter, SimulatedPrinter
+    from .Types import EventType, InfoType, PrinterSettings
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from AsyncInstaxBLE import AsyncInstaxBLE
+    from InstaxBLE import InstaxBLE
+    from FrameParser import FrameReassembler
+    from ImageEncoder import encode_jpeg, prepare_jpeg, QUALITY_MODES
+    from Packetizer import create_image_data_packets
+    from SimulatedPrinter import SimulatedAdapter, SimulatedPrinter
+    from Types import EventType, InfoType, PrinterSettings
+
+from PIL import Image
+
+MODELS = ('mini', 'square', 'wide')
+EXAMPLE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_image_data_packets_concat(imgData, chunkSize):
+    """ The original way of creating image packets: by slicing, concatenating and summing each packet """
+    def create_packet(eventType, payload):
+        packet = b'\x41\x62' + pack('>H', 7 + len(payload)) + bytes(eventType) + payload
+        return packet + pack('B', (255 - (sum(packet) & 255)) & 255)
+
+    imgDataChunks = [imgData[i:i + chunkSize] for i in range(0, len(imgData), chunkSize)]
+    if len(imgDataChunks[-1]) < chunkSize:
+        imgDataChunks[-1] = imgDataChunks[-1] + bytes(chunkSize - len(imgDataChunks[-1]))
+    packets = []
+    for index, chunk in enumerate(imgDataChunks):
+        packets.append(create_packet(EventType.PRINT_IMAGE_DOWNLOAD_DATA.value, pack('>I', index) + chunk))
+    # drain the queue like the original handle_image_packet_queue did
+    while len(packets) > 0:
+        packets.pop(0)
+
+
+def create_image_data_packets_buffer(imgData, chunkSize):
+    """ Create image packets with the packetizer and drain the queue """
+    packets = create_image_data_packets(imgData, chunkSize)
+    while len(packets) > 0:
+        packets.popleft()
+
+
+def bench_packetize(args):
+    """ Compare the packetizer to the original packet creation, for a max size image on every model """
+    imgData = bytearray(os.urandom(args.size * 1024))
+    for model in ('mini', 'square', 'wide'):
+        chunkSize = PrinterSettings[model]['chunkSize']
+        for name, function in (('concat', create_image_data_packets_concat), ('buffer', create_image_data_packets_buffer)):
+            best = min(repeat(lambda: function(imgData, chunkSize), number=args.number, repeat=5)) / args.number
+            print(f"{model:<7} {name:<7} {best * 1000:.3f}ms per image")
+
+
+async def bench_transfer_window(args):
+    """
+    Compare the image transfer speed of stop-and-wait (window 1) with sending
+    <window> chunks ahead. Printing stays disabled, so no film is used.
+    With --simulate the transfer goes to a simulated printer instead.
+    """
+    adapter = None
+    if args.simulate:
+        printer = SimulatedPrinter(args.simulate, mtu=args.mtu, latency=args.latency / 1000,
+                                   bandwidth=args.bandwidth * 1024, jitter=args.jitter / 1000, seed=0)
+        adapter = SimulatedAdapter([printer])
+    instax = AsyncInstaxBLE(device_address=args.device_address, device_name=args.device_name,
+                            verbose=args.verbose, timeout=args.timeout, adapter=adapter)
+    try:
+        await instax.connect()
+        imagePath = args.image_path or instax.printerSettings['exampleImage']
+        imgData = instax.prepare_image(imagePath)
+        print(f"Sending {len(imgData) / 1024:.1f}KB to a {instax.printerSettings['modelName']} in {instax.chunkSize} byte chunks")
+
+        results = {}
+        for window in (1, args.window):
+            instax.transferWindow = window
+            durations = []
+            for _ in range(args.repeat):
+                start = perf_counter()
+                await instax.print_image(imgData)
+                durations.append(perf_counter() - start)
+            best = min(durations)
+            results[window] = best
+            fellBack = ' (fell back to 1)' if instax.transferWindow != window else ''
+            print(f"window {window:>3}{fellBack}: {best:.2f}s, {len(imgData) / 1024 / best:.1f}KB/s")
+
+        print(f"speedup: {results[1] / results[args.window]:.2f}x")
+    finally:
+        await instax.disconnect()
+
+
+def offline_instax(model, **kwargs):
+    """ An InstaxBLE instance set up for <model> that doesn't need a bluetooth adapter """
+    instax = InstaxBLE(quiet=True, adapter=SimulatedAdapter([]), **kwargs)
+    instax.quiet = False  # so notifications get validated like they do normally
+    instax.printerModel = model
+    instax.printerSettings = PrinterSettings[model]
+    instax.chunkSize = instax.printerSettings['chunkSize']
+    instax.imageSize = (instax.printerSettings['width'], instax.printerSettings['height'])
+    return instax
+
+
+def best_of(function, number, repeats):
+    """ Fastest time of <repeats> runs of calling <function> <number> times, in seconds per call """
+    return min(repeat(function, number=number, repeat=repeats)) / number
+
+
+def suite_encode(results, args):
+    """ Time turning the example image into printer-ready JPEG data, for every model and quality mode """
+    for model in MODELS:
+        path = os.path.join(EXAMPLE_DIR, PrinterSettings[model]['exampleImage'])
+        for mode in QUALITY_MODES:
+            instax = offline_instax(model, quality_mode=mode)
+            results[f'encode.{model}.{mode}'] = best_of(lambda: instax.prepare_image(path), 1, args.repeat)
+
+
+def suite_decode(results, args):
+    """
+    Time preparing a large (24MP) camera JPEG for a mini printer: decoding it at
+    full resolution, with draft mode, and passing through a JPEG that already fits
+    """
+    size = (PrinterSettings['mini']['width'], PrinterSettings['mini']['height'])
+    example = Image.open(os.path.join(EXAMPLE_DIR, PrinterSettings['mini']['exampleImage']))
+    photo = BytesIO()
+    example.resize((4000, 6000), Image.Resampling.BILINEAR).save(photo, 'JPEG', quality=92)
+    printable = BytesIO()
+    example.save(printable, 'JPEG', quality=80)
+
+    def prepare(source, function):
+        source.seek(0)
+        return function(source)
+
+    results['decode.full'] = best_of(lambda: prepare(photo, lambda f: encode_jpeg(Image.open(f), size, 105)), 1, args.repeat)
+    results['decode.draft'] = best_of(lambda: prepare(photo, lambda f: prepare_jpeg(f, size, 105)), 1, args.repeat)
+    results['decode.passthrough'] = best_of(lambda: prepare(printable, lambda f: prepare_jpeg(f, size, 105)), args.number, args.repeat)
+
+
+def suite_packetize(results, args):
+    """ Time creating all packets for a max size image, and creating single control packets """
+    imgData = bytearray(os.urandom(105 * 1024))
+    for model in MODELS:
+        instax = offline_instax(model)
+        results[f'packetize.{model}'] = best_of(lambda: instax.create_image_packets(imgData), args.number, args.repeat)
+
+    instax = offline_instax('mini')
+    payload = pack('>B', InfoType.PRINTER_FUNCTION_INFO.value)
+    results['packetize.control'] = best_of(lambda: instax.create_packet(EventType.SUPPORT_FUNCTION_INFO, payload),
+                                           args.number * 100, args.repeat)
+
+
+def suite_parse(results, args):
+    """ Time handling the notifications a printer sends during connecting and an image transfer """
+    printer = SimulatedPrinter('mini')
+    infoReplies = [printer.create_reply(EventType.SUPPORT_FUNCTION_INFO.value, b'\x00' + printer.function_info(infoType.value))
+                   for infoType in (InfoType.IMAGE_SUPPORT_INFO, InfoType.BATTERY_INFO, InfoType.PRINTER_FUNCTION_INFO)]
+    dataReplies = [printer.create_reply(EventType.PRINT_IMAGE_DOWNLOAD_DATA.value, pack('>BI', 0, index)) for index in range(120)]
+    instax = offline_instax('mini')
+
+    def handle(replies):
+        for reply in replies:
+            instax.notification_handler(reply)
+
+    results['parse.info'] = best_of(lambda: handle(infoReplies), args.number, args.repeat) / len(infoReplies)
+    results['parse.data'] = best_of(lambda: handle(dataReplies), args.number, args.repeat) / len(dataReplies)
+
+    # the byte stream of the same replies, split over small notifications and coalesced into large ones
+    replies = infoReplies + dataReplies
+    stream = b''.join(replies)
+    for name, size in (('split', 20), ('coalesced', 509)):
+        notifications = [stream[i:i + size] for i in range(0, len(stream), size)]
+        reassembler = FrameReassembler()
+        if [frame for notification in notifications for frame in reassembler.feed(notification)] != replies:
+            raise RuntimeError(f'Reassembling {name} notifications failed')
+        results[f'parse.stream.{name}'] = best_of(lambda: handle(notifications), args.number, args.repeat) / len(replies)
+
+
+async def suite_transfer(results, args):
+    """ Time sending the example image to a simulated printer, stop-and-wait and windowed """
+    for model in MODELS:
+        for window in (1, 8):
+            printer = SimulatedPrinter(model, latency=args.latency / 1000, write_latency=0.001,
+                                       bandwidth=args.bandwidth * 1024, seed=0)
+            instax = AsyncInstaxBLE(adapter=SimulatedAdapter([printer]), quiet=True, transfer_window=window)
+            await instax.connect()
+            try:
+                imgData = instax.prepare_image(os.path.join(EXAMPLE_DIR, instax.printerSettings['exampleImage']))
+                durations = []
+                for _ in range(args.repeat):
+                    start = perf_counter()
+                    if not await instax.print_image(imgData) or printer.receivedImages[-1] != imgData:
+                        raise RuntimeError(f'Simulated transfer to a {model} printer failed')
+                    durations.append(perf_counter() - start)
+                results[f'transfer.{model}.window{window}'] = min(durations)
+            finally:
+                await instax.disconnect()
+
+
+def run_python(*args):
+    """ Wall time of running a Python process with <args> in the repo directory """
+    start = perf_counter()
+    subprocess.run([sys.executable, *args], cwd=EXAMPLE_DIR, check=True, stdout=subprocess.DEVNULL)
+    return perf_counter() - start
+
+
+def suite_startup(results, args):
+    """
+    Time starting a new Python process that only imports InstaxBLE, and one
+    that shows the CLI's help, to catch heavy imports sneaking back in
+    """
+    heavy = ('PIL', 'simplepyble', 'SimulatedPrinter', 'KnownPrinters')
+    check = f"import sys, InstaxBLE; sys.exit(','.join(m for m in {heavy} if m in sys.modules) or None)"
+    imported = subprocess.run([sys.executable, '-c', check], cwd=EXAMPLE_DIR, capture_output=True, text=True).stderr.strip()
+    if imported:
+        print(f"Importing InstaxBLE also imports {imported}")
+    results['startup.baseline'] = min(run_python('-c', 'pass') for _ in range(args.repeat))
+    results['startup.import'] = min(run_python('-c', 'import InstaxBLE') for _ in range(args.repeat))
+    results['startup.help'] = min(run_python('InstaxBLE.py', '--help') for _ in range(args.repeat))
+
+
+def compare(results, baseline):
+    """ Print the results next to a baseline. Returns the largest slowdown in percent. """
+    worst = 0
+    for name, duration in results.items():
+        if name not in baseline:
+            print(f"{name:<28} {duration * 1000:>10.4f}ms")
+            continue
+        change = (duration / baseline[name] - 1) * 100
+        worst = max(worst, change)
+        print(f"{name:<28} {duration * 1000:>10.4f}ms {baseline[name] * 1000:>10.4f}ms {change:>+7.1f}%")
+    return worst
+
+
+def bench_suite(args):
+    """
+    Run the offline benchmarks (image preparation and decoding, packet construction,
+    notification parsing, a simulated transfer and startup time) on the example images,
+    optionally saving the results as JSON and comparing them to a baseline.
+    """
+    benchmarks = {
+        'encode': suite_encode,
+        'decode': suite_decode,
+        'packetize': suite_packetize,
+        'parse': suite_parse,
+        'transfer': lambda results, args: asyncio.run(suite_transfer(results, args)),
+        'startup': suite_startup,
+    }
+    results = {}
+    for name in args.only or benchmarks:
+        print(f"Running {name} benchmarks...")
+        benchmarks[name](results, args)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print(f"{'':<28} {'current':>12} {'baseline':>12}")
+    worst = compare(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'pillow': Image.__version__,
+                'results': results,
+            }, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+    if args.max_slowdown is not None and worst > args.max_slowdown:
+        sys.exit(f"Slower than the baseline by {worst:.1f}% (max {args.max_slowdown}%)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    transfer = subparsers.add_parser('transfer', help='Compare windowed image transfer to stop-and-wait')
+    transfer.add_argument('-a', '--device-address')
+    transfer.add_argument('-n', '--device-name')
+    transfer.add_argument('-i', '--image-path', help='Path to the image file')
+    transfer.add_argument('-w', '--window', type=int, default=8, help='Number of image chunks to send ahead')
+    transfer.add_argument('-r', '--repeat', type=int, default=3, help='Number of transfers per window size, the fastest one counts')
+    transfer.add_argument('-t', '--timeout', type=float, default=5, help='Seconds to wait for a reply from the printer')
+    transfer.add_argument('-v', '--verbose', action='store_true')
+    transfer.add_argument('--simulate', choices=['mini', 'square', 'wide'], help='Use a simulated printer of this model')
+    transfer.add_argument('--mtu', type=int, default=185, help='MTU of the simulated printer')
+    transfer.add_argument('--latency', type=float, default=15, help='Reply latency of the simulated printer in ms')
+    transfer.add_argument('--bandwidth', type=float, default=20, help='Link speed of the simulated printer in KB/s')
+    transfer.add_argument('--jitter', type=float, default=0, help='Max random delay added to simulated replies in ms')
+
+    packetize = subparsers.add_parser('packetize', help='Compare the packetizer to the original packet creation')
+    packetize.add_argument('-s', '--size', type=int, default=105, help='Image size in KB')
+    packetize.add_argument('-N', '--number', type=int, default=100, help='Number of runs per measurement')
+
+    suite = subparsers.add_parser('suite', help='Run the offline benchmarks on the example images')
+    suite.add_argument('--only', nargs='+', choices=['encode', 'decode', 'packetize', 'parse', 'transfer', 'startup'], help='Only run these benchmarks')
+    suite.add_argument('-o', '--output', help='Save the results to this JSON file')
+    suite.add_argument('-b', '--baseline', help='Compare the results to this JSON file from an earlier run')
+    suite.add_argument('--max-slowdown', type=float, help='Exit with an error if anything is this many percent slower than the baseline')
+    suite.add_argument('-r', '--repeat', type=int, default=3, help='Number of measurements per benchmark, the fastest one counts')
+    suite.add_argument('-N', '--number', type=int, default=20, help='Number of runs per measurement for the fast benchmarks')
+    suite.add_argument('--latency', type=float, default=5, help='Reply latency of the simulated printer in ms')
+    suite.add_argument('--bandwidth', type=float, default=200, help='Link speed of the simulated printer in KB/s')
+
+    args = parser.parse_args()
+    if args.benchmark == 'transfer':
+        asyncio.run(bench_transfer_window(args))
+    elif args.benchmark == 'packetize':
+        bench_packetize(args)
+    elif args.benchmark == 'suite':
+        bench_suite(args)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+from time import monotonic
+
+# Try to import with a relative import first
+try:
+    from .AsyncInstaxBLE import AsyncInstaxBLE
+    from .PrintQueue import PrintJob, PrintQueue
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from AsyncInstaxBLE import AsyncInstaxBLE
+    from PrintQueue import PrintJob, PrintQueue
+
+import simplepyble
+
+
+class FleetPrinter:
+    """ A printer in the fleet, with its own connection and print queue """
+
+    def __init__(self, instax):
+        self.instax = instax
+        self.queue = PrintQueue(instax)
+        self.printed = 0
+        self.running = None
+        self.printing = None  # the job being printed, PrintQueue.run_one has taken it off the queue already
+        self.photosAtStart = 0  # photos left when that job started
+
+    def load(self):
+        """ Number of jobs queued on (or being printed by) this printer """
+        return len(self.queue.jobs) + (1 if self.printing is not None else 0)
+
+    def film_left(self):
+        """ Number of photos left for jobs that aren't queued on this printer yet """
+        photosLeft = self.instax.photosLeft
+        if self.printing is not None:
+            # the job being printed needs a photo as well, until the printer's counter dropped for it
+            photosLeft = min(photosLeft, self.photosAtStart - 1)
+        return photosLeft - len(self.queue.jobs)
+
+    def can_print(self, minBattery):
+        """ Check if this printer has film left for another job and enough battery """
+        instax = self.instax
+        if instax.dummyPrinter:
+            return True
+        if not instax.peripheral or not instax.peripheral.is_connected():
+            return False
+        if self.film_left() <= 0:
+            return False
+        return instax.isCharging or instax.batteryPercentage >= minBattery
+
+
+class Fleet:
+    """
+    Drives all Instax printers that can be found on all bluetooth adapters at
+    the same time. Print jobs are dispatched to the least busy printer that
+    has film left and enough battery.
+    """
+
+    def __init__(self, adapters=None, min_battery=20, verbose=False, **kwargs):
+        """
+        adapters: the simplepyble adapters to scan with, by default all of them.
+        min_battery: don't send jobs to printers with a lower battery percentage (unless they're charging).
+        Other arguments are passed on to every AsyncInstaxBLE instance.
+        """
+        self.adapters = adapters if adapters is not None else simplepyble.Adapter.get_adapters()
+        self.minBattery = min_battery
+        self.verbose = verbose
+        self.instaxArgs = kwargs
+        self.printers = []
+        self.startTime = None
+
+    def log(self, msg):
+        """ Print a debug message"""
+        if self.verbose:
+            print(msg)
+
+    def scan(self, scanTime=5):
+        """
+        Scan all adapters and return a (adapter, peripheral) pair for every
+        printer found. A printer seen by multiple adapters is driven by the
+        adapter that receives it the strongest.
+        """
+        found = {}
+        for adapter in self.adapters:
+            adapter.scan_for(int(scanTime * 1000))
+            for peripheral in adapter.scan_get_results():
+                name = peripheral.identifier()
+                if not (name.startswith('INSTAX-') and name.endswith('(IOS)')) or not peripheral.is_connectable():
+                    continue
+                address = peripheral.address()
+                if address not in found or peripheral.rssi() > found[address][1].rssi():
+                    found[address] = (adapter, peripheral)
+        return list(found.values())
+
+    async def discover(self, scanTime=5):
+        """ Find and connect to all printers. Returns the number of connected printers. """
+        loop = asyncio.get_running_loop()
+        for adapter, peripheral in await loop.run_in_executor(None, self.scan, scanTime):
+            if any(printer.instax.peripheral.address() == peripheral.address() for printer in self.printers):
+                continue
+            self.log(f"Found {peripheral.identifier()} [{peripheral.address()}] on {adapter.identifier()}")
+            instax = AsyncInstaxBLE(adapter=adapter, peripheral=peripheral, verbose=self.verbose, **self.instaxArgs)
+            self.printers.append(FleetPrinter(instax))
+
+        await asyncio.gather(*(printer.instax.connect() for printer in self.printers
+                               if not printer.instax.peripheral.is_connected()))
+        return len([printer for printer in self.printers if printer.instax.peripheral.is_connected()])
+
+    def submit(self, imgSrc):
+        """
+        Queue an image on the least busy printer that can print it. Returns its
+        PrintJob, which is skipped right away if no printer can print it.
+        """
+        printers = [printer for printer in self.printers if printer.can_print(self.minBattery)]
+        if len(printers) == 0:
+            self.log(f"No printer with film and battery left for {imgSrc}")
+            job = PrintJob(imgSrc)
+            job.finish('skipped')
+            return job
+
+        printer = min(printers, key=FleetPrinter.load)
+        self.log(f"Sending {imgSrc} to {printer.instax.peripheral.identifier()}")
+        job = printer.queue.add(imgSrc)
+        self.start(printer)
+        return job
+
+    def start(self, printer):
+        """ Start working through a printer's queue, if it isn't already """
+        if self.startTime is None:
+            self.startTime = monotonic()
+        if printer.running is None or printer.running.done():
+            printer.running = asyncio.ensure_future(self.work(printer))
+
+    async def work(self, printer):
+        """ Print all jobs queued on a printer """
+        while len(printer.queue.jobs) > 0:
+            job = printer.queue.jobs[0]
+            printer.printing = job
+            printer.photosAtStart = printer.instax.photosLeft
+            try:
+                await printer.queue.run_one()
+            finally:
+                printer.printing = None
+            if job.status == 'printed':
+                printer.printed += 1
+        printer.running = None
+
+    async def join(self):
+        """ Wait until all queued jobs are done """
+        while any(printer.running for printer in self.printers):
+            await asyncio.gather(*(printer.running for printer in self.printers if printer.running))
+
+    def stats(self):
+        """ Prints per printer and the fleet's throughput in prints per hour """
+        printed = sum(printer.printed for printer in self.printers)
+        elapsed = monotonic() - self.startTime if self.startTime else 0
+        return {
+            'printers': {printer.instax.peripheral.identifier(): printer.printed for printer in self.printers},
+            'printed': printed,
+            'elapsed': elapsed,
+            'printsPerHour': printed / elapsed * 3600 if elapsed > 0 else 0,
+        }
+
+    async def disconnect(self):
+        """ Disconnect from all printers """
+        await asyncio.gather(*(printer.instax.disconnect() for printer in self.printers))
+
+
+async def main(args):
+    """ Print all images passed on the command line on all printers that can be found """
+    imagePaths = args.pop('image_paths')
+    fleet = Fleet(**args)
+    try:
+        print(f"Connected to {await fleet.discover()} printer(s)")
+        jobs = [fleet.submit(imagePath) for imagePath in imagePaths]
+        await fleet.join()
+        for job in jobs:
+            print(f"{job.imgSrc}: {job.status}")
+        print(fleet.stats())
+    finally:
+        await fleet.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print a list of images on all printers that can be found')
+    parser.add_argument('image_paths', nargs='+', help='Paths to the image files')
+    parser.add_argument('-b', '--min-battery', type=int, default=20, help='Skip printers with a lower battery percentage')
+    parser.add_argument('-p', '--print-enabled', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-w', '--transfer-window', type=int, default=1, help='Number of image chunks to send ahead')
+    args = parser.parse_args()
+
+    asyncio.run(main(vars(args)))
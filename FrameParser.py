@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Try to import with a relative import first
+try:
+    from .Types import EventType
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import EventType
+
+# opCode -> EventType, so replies don't need an Enum lookup
+EVENT_TYPES = {event.value: event for event in EventType}
+
+PRINTER_HEADER = b'\x61\x42'  # 'aB': printer to client
+CLIENT_HEADER = b'\x41\x62'  # 'Ab': client to printer
+MIN_FRAME_LENGTH = 7  # header, length, opCode and checksum
+MAX_REPLY_LENGTH = 256  # the printer's replies are a few dozen bytes at most
+MAX_PACKET_LENGTH = 0xFFFF  # what the length field can hold, for our own packets (image chunks are up to 1819 bytes)
+
+
+class FrameReassembler:
+    """
+    Turns a stream of bytes (e.g. BLE notifications or writes) back into
+    complete frames, using the length field after the header. Frames split
+    over multiple notifications are joined, notifications holding more than
+    one frame are split. When the stream doesn't start with a valid frame
+    (or a frame's checksum is wrong, e.g. because its length field got
+    corrupted), bytes are skipped until the next header.
+    """
+
+    def __init__(self, header=PRINTER_HEADER, max_length=MAX_REPLY_LENGTH):
+        self.header = header
+        self.maxLength = max_length
+        self.buffer = bytearray()
+        self.droppedBytes = 0
+
+    def feed(self, data):
+        """ Add received bytes and return the list of frames that are now complete """
+        buffer = self.buffer
+        # usually a notification holds exactly one frame, skip the copying for those
+        if not buffer and len(data) >= MIN_FRAME_LENGTH and data[:2] == self.header and ((data[2] << 8) | data[3]) == len(data) \
+                and sum(data) & 255 == 255:
+            return [data]
+        buffer += data
+        frames = []
+        start = 0
+        while len(buffer) - start >= 4:
+            if buffer[start:start + 2] != self.header:
+                start = self.resync(start + 1)
+                continue
+            length = (buffer[start + 2] << 8) | buffer[start + 3]
+            if length < MIN_FRAME_LENGTH or length > self.maxLength:
+                start = self.resync(start + 1)
+                continue
+            if len(buffer) - start < length:
+                break
+            frame = bytes(buffer[start:start + length])
+            if sum(frame) & 255 != 255:
+                # most likely the length is wrong, the real frames are in the bytes it covers
+                start = self.resync(start + 1)
+                continue
+            frames.append(frame)
+            start += length
+        if start:
+            del buffer[:start]
+        return frames
+
+    def resync(self, start):
+        """ Skip to the next header in the buffer (or to its end) and return where that is """
+        nextStart = self.buffer.find(self.header, start)
+        if nextStart == -1:
+            # keep a last byte that could be the start of a header
+            nextStart = max(start, len(self.buffer) - 1)
+        self.droppedBytes += nextStart - start + 1
+        return nextStart
+
+    def reset(self):
+        """ Drop any partial frame, e.g. after reconnecting """
+        self.buffer.clear()
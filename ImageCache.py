@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+# Try to import with a relative import first
+try:
+    from .Types import PrinterSettings
+    from .ImageEncoder import prepare_jpeg, QUALITY_MODES
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import PrinterSettings
+    from ImageEncoder import prepare_jpeg, QUALITY_MODES
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tif', '.tiff')
+
+
+class ImageCache:
+    """
+    On-disk cache of printer-ready JPEG data, keyed by the contents of the
+    source image, the printer model and the max file size. When the cache
+    grows beyond <max_size_mb>, the least recently used entries are removed.
+    """
+
+    def __init__(self, directory=None, max_size_mb=100):
+        self.directory = directory or os.path.join(os.path.expanduser('~'), '.cache', 'instaxble', 'images')
+        self.maxSize = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def entries(self):
+        """ (last used time, size, path) of every entry in the cache """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.jpg'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # removed by another process sharing the cache
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def key(self, sourceData, model, max_size_kb, quality_mode='search'):
+        """ Create the cache key for the given source image data and print settings """
+        sourceHash = hashlib.sha256(sourceData).hexdigest()
+        return hashlib.sha256(f'{sourceHash}:{model}:{max_size_kb}:{quality_mode}'.encode()).hexdigest()
+
+    def path(self, key):
+        """ Path of the cache entry for the given key """
+        return os.path.join(self.directory, f'{key}.jpg')
+
+    def get(self, key):
+        """ Get the cached JPEG data for this key, or None if it's not in the cache """
+        with self.lock:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = bytearray(f.read())
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            # the modification time tracks when an entry was last used
+            os.utime(self.path(key))
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """ Store JPEG data in the cache, removing old entries if the cache gets too large """
+        with self.lock:
+            path = self.path(key)
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            temporaryPath = f'{path}.{os.getpid()}.tmp'
+            with open(temporaryPath, 'wb') as f:
+                f.write(data)
+            os.replace(temporaryPath, path)  # so other processes never read a half written entry
+            self.size += len(data)
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in its max size """
+        if self.size <= self.maxSize:
+            return
+        for _, size, path in sorted(self.entries()):
+            if self.size <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another process sharing the cache evicted it first
+            self.size -= size
+
+    def get_or_encode(self, sourceData, model, max_size_kb=105, quality_mode='search', log=None):
+        """
+        Get the printer-ready JPEG data for the given source image data, encoding
+        (and caching) it if it's not in the cache yet.
+        """
+        key = self.key(sourceData, model, max_size_kb, quality_mode)
+        data = self.get(key)
+        if data is None:
+            settings = PrinterSettings[model]
+            data = prepare_jpeg(BytesIO(sourceData), (settings['width'], settings['height']), max_size_kb, quality_mode, log)
+            self.put(key, data)
+        if log:
+            log(f'Image cache: {self.stats()}')
+        return data
+
+    def prewarm(self, directory, models=('mini', 'square', 'wide'), max_size_kb=105, quality_mode='search', log=None):
+        """
+        Encode and cache every image in <directory> for the given printer
+        models. An image that can't be read or encoded doesn't stop the
+        others. Returns the number of images cached and a dict of name ->
+        error for the ones that failed.
+        """
+        names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+        errors = {}
+        for name in names:
+            try:
+                with open(os.path.join(directory, name), 'rb') as f:
+                    sourceData = f.read()
+                for model in models:
+                    if log:
+                        log(f'Prewarming {name} for {model}')
+                    self.get_or_encode(sourceData, model, max_size_kb, quality_mode)
+            except Exception as e:
+                errors[name] = str(e) or type(e).__name__
+                if log:
+                    log(f'Prewarming {name} failed: {errors[name]}')
+        return len(names) - len(errors), errors
+
+    def stats(self):
+        """ Summary of the cache's hits, misses and size """
+        return f'{self.hits} hits, {self.misses} misses, {self.size / 1024 / 1024:.1f}/{self.maxSize / 1024 / 1024:.1f}MB'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prewarm the InstaxBLE image cache from a directory of images')
+    parser.add_argument('directory', help='Directory with the images to cache')
+    parser.add_argument('-m', '--models', nargs='+', choices=['mini', 'square', 'wide'], default=['mini', 'square', 'wide'])
+    parser.add_argument('-c', '--cache-dir', help='Cache directory (default: ~/.cache/instaxble/images)')
+    parser.add_argument('-s', '--cache-size', type=int, default=100, help='Max cache size in MB')
+    parser.add_argument('--quality-mode', choices=QUALITY_MODES, default='search')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    cache = ImageCache(args.cache_dir, args.cache_size)
+    cached, errors = cache.prewarm(args.directory, args.models, quality_mode=args.quality_mode, log=print if args.verbose else None)
+    for name, error in errors.items():
+        print(f'{name} failed: {error}')
+    print(f'Cached {cached} images' + (f', {len(errors)} failed' if errors else '') + f' ({cache.stats()})')
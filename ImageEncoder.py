@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import os
+from io import BytesIO
+from time import perf_counter
+
+from PIL import Image, ImageOps
+
+# Try to import with a relative import first
+try:
+    from .Types import QUALITY_MODES
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import QUALITY_MODES
+
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)  # EXIF orientations that swap width and height
+
+
+class JpegEncoder:
+    """
+    Encodes a (resized) PIL image as JPEG while keeping track of how many
+    encodes were needed and how long they took.
+    """
+
+    def __init__(self, img):
+        self.img = img
+        self.encodes = 0
+        self.trialEncodes = 0
+        self.encodeTime = 0
+        self.results = {}  # quality -> JPEG data of the full size image
+
+    def encode(self, quality, img=None):
+        """ Encode the image (or the given trial image) at the given quality and return the JPEG data """
+        if img is None and quality in self.results:
+            return self.results[quality]
+
+        start = perf_counter()
+        img_buffer = BytesIO()
+        (self.img if img is None else img).save(img_buffer, format='JPEG', quality=quality)
+        if img is None:
+            self.encodes += 1
+        else:
+            self.trialEncodes += 1
+        self.encodeTime += perf_counter() - start
+        data = img_buffer.getvalue()
+        if img is None:
+            self.results[quality] = data
+        return data
+
+
+SEARCH_START = 75  # the quality the binary search starts at
+
+
+def search_path(size, max_size, min_size, tried=None):
+    """
+    Binary search over the JPEG quality, using <size>(quality) as the size
+    of the image at that quality. Stops at the first quality between
+    <min_size> and <max_size> bytes. Returns the highest quality tried that
+    fitted below <max_size>, or None if none did. The qualities tried are
+    added to the list <tried>, if given.
+    """
+    low_quality, high_quality = 1, 100
+    current_quality = SEARCH_START
+    best = None
+
+    while low_quality <= high_quality:
+        current_size = size(current_quality)
+        if tried is not None:
+            tried.append(current_quality)
+
+        if current_size <= max_size:
+            if best is None or current_quality > best:
+                best = current_quality
+            if current_size >= min_size:
+                break
+
+        if current_size > max_size:
+            high_quality = current_quality - 1
+        else:
+            low_quality = current_quality + 1
+
+        current_quality = (low_quality + high_quality) // 2
+    return best
+
+
+def search_quality(encoder, max_size, min_size):
+    """
+    Binary search for the highest quality that ends up between <min_size>
+    and <max_size> bytes. Returns the quality and JPEG data of the highest
+    quality encode that fitted below <max_size>.
+    """
+    quality = search_path(lambda quality: len(encoder.encode(quality)), max_size, min_size)
+    if quality is None:  # even the lowest quality is too large, send that anyway
+        quality = 1
+    return quality, encoder.encode(quality)  # already encoded during the search
+
+
+def trial_image(img, scale=2, grid=4):
+    """
+    A copy of <img> with about 1/<scale>^2 of its pixels, to try JPEG
+    qualities on. It's made of crops from a <grid> x <grid> grid over the
+    whole image instead of a downscaled copy, because scaling smooths away
+    the fine detail and noise the JPEG size depends on most.
+    """
+    w, h = img.size
+    # whole 16x16 blocks (JPEG's MCUs with chroma subsampling), so the seams between crops don't add anything
+    cropWidth = max(16, w // (scale * grid) // 16 * 16)
+    cropHeight = max(16, h // (scale * grid) // 16 * 16)
+    trial = Image.new(img.mode, (cropWidth * grid, cropHeight * grid))
+    for row in range(grid):
+        for column in range(grid):
+            x = column * w // grid + (w // grid - cropWidth) // 2
+            y = row * h // grid + (h // grid - cropHeight) // 2
+            trial.paste(img.crop((x, y, x + cropWidth, y + cropHeight)), (column * cropWidth, row * cropHeight))
+    return trial
+
+
+def predict_quality(encoder, max_size, min_size, trialScale=2):
+    """
+    Predict where the binary search of search_quality ends up, by running it
+    on the sizes of trial encodes of a smaller copy (see trial_image), scaled
+    by how much larger the full size image is at the search's first quality.
+    Then encode that quality directly, which usually takes two or three full
+    size encodes instead of up to seven, all of which the search would have
+    done as well.
+    The result is never larger than what the search would give: it's the
+    same quality when the search would have gone the predicted way, and a
+    lower one (still between <min_size> and <max_size>) when it would have
+    stopped at a higher quality. If the search could have stopped at a lower
+    quality than predicted, or the prediction misses the size window, the
+    binary search takes over, reusing the encodes done so far.
+    This relies on a higher quality never giving a smaller file, which holds
+    for JPEG in practice.
+    """
+    first = encoder.encode(SEARCH_START)
+    if min_size <= len(first) <= max_size:
+        return SEARCH_START, first
+
+    trial = trial_image(encoder.img, trialScale)
+    trialSizes = {}
+
+    def predicted_size(quality):
+        if quality == SEARCH_START:
+            return len(first)
+        if quality not in trialSizes:
+            trialSizes[quality] = len(encoder.encode(quality, img=trial))
+        return trialSizes[quality] * ratio
+
+    # how much larger the full size image is than the trial, at the quality both were encoded at
+    ratio = len(first) / len(encoder.encode(SEARCH_START, img=trial))
+    tried = []
+    quality = search_path(predicted_size, max_size, min_size, tried) or 1
+    if quality == 100 and predicted_size(100) < min_size:
+        data = encoder.encode(quality)
+        if len(data) < min_size:
+            return quality, data  # everything fits, so the search ends at 100 too
+    # the search stops at the first quality in the window, and it gets to the lower qualities on the predicted path first.
+    # Those are smaller than the highest of them, so if that one is below the window the search gets to <quality> as well.
+    lower = [q for q in tried if q < quality]
+    if len(lower) > 0 and len(encoder.encode(max(lower))) >= min_size:
+        return search_quality(encoder, max_size, min_size)
+    data = encoder.encode(quality)
+    if min_size <= len(data) <= max_size or (quality == 100 and len(data) < min_size):
+        return quality, data
+    return search_quality(encoder, max_size, min_size)
+
+
+def encode_jpeg(img: Image.Image, size, max_size_kb: int = None, quality_mode='search', log=None) -> bytearray:
+    """
+    Resize a PIL image to <size> and encode it as JPEG. If <max_size_kb> is
+    given, the quality is lowered until the result is at most that large
+    (aiming for 90-100% of it).
+    quality_mode: 'search' does a binary search over the quality, 'predict'
+        predicts where that search ends from trial encodes of a smaller
+        copy first (see predict_quality).
+    """
+    # JPEG only holds RGB and grayscale images, convert the rest (RGBA, palette, LA, CMYK, ...) to RGB
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    # Resize the image to <size> pixels
+    img = img.resize(size, Image.Resampling.LANCZOS)
+    encoder = JpegEncoder(img)
+
+    if max_size_kb is None:
+        data = encoder.encode(75)  # PIL's default quality
+    else:
+        max_size = max_size_kb * 1024
+        min_size = max_size * 0.9
+        if quality_mode == 'predict':
+            quality, data = predict_quality(encoder, max_size, min_size)
+        elif quality_mode == 'search':
+            quality, data = search_quality(encoder, max_size, min_size)
+        else:
+            raise ValueError(f"Unknown quality mode: {quality_mode} (use one of {', '.join(QUALITY_MODES)})")
+
+        if log:
+            log(f'Saved img with quality of {quality}')
+
+    if log:
+        log(f'Encoded {len(data) / 1024:.1f}KB JPEG in {encoder.encodes} full size and {encoder.trialEncodes} trial encodes, '
+            f'{encoder.encodeTime * 1000:.0f}ms')
+    return bytearray(data)
+
+
+def load_image(img, size, log=None):
+    """
+    Decode an opened image that's going to be resized to <size>. JPEGs are
+    decoded at the smallest scale (1/8, 1/4, 1/2 or full) that's still at
+    least <size>, instead of at full resolution. EXIF orientation is applied.
+    """
+    orientation = img.getexif().get(EXIF_ORIENTATION)
+    if img.format == 'JPEG':
+        # the size to draft for is before rotating
+        w, h = size
+        if orientation in ROTATED_ORIENTATIONS:
+            w, h = h, w
+        fullSize = img.size
+        img.draft('RGB', (w, h))
+        start = perf_counter()
+        img.load()
+        if log:
+            scale = fullSize[0] // img.size[0]
+            log(f'Decoded {fullSize[0]}x{fullSize[1]} JPEG at 1/{scale} scale ({img.size[0]}x{img.size[1]}) '
+                f'in {(perf_counter() - start) * 1000:.0f}ms')
+    if orientation not in (None, 1):
+        img = ImageOps.exif_transpose(img)
+    return img
+
+
+def is_printable_jpeg(img, dataSize, size, max_size_kb=None):
+    """
+    Check if opened (but not decoded) image <img> of <dataSize> bytes can be
+    sent to the printer as is: a baseline RGB JPEG of exactly <size> pixels,
+    upright and small enough.
+    """
+    if img.format != 'JPEG' or img.mode != 'RGB' or img.size != tuple(size):
+        return False
+    if img.info.get('progressive') or img.getexif().get(EXIF_ORIENTATION) not in (None, 1):
+        return False
+    return max_size_kb is None or dataSize <= max_size_kb * 1024
+
+
+def prepare_jpeg(source, size, max_size_kb=None, quality_mode='search', log=None) -> bytearray:
+    """
+    Turn an image (path or file object) into JPEG data of <size> pixels that
+    fits the printer. JPEGs that already do are passed through without
+    decoding, others are decoded with load_image and encoded with encode_jpeg.
+    """
+    # closing the image closes the file it opened, but not a file object that was passed in
+    with Image.open(source) as img:
+        if isinstance(source, str):
+            dataSize = os.path.getsize(source)
+        else:
+            dataSize = source.seek(0, os.SEEK_END)
+        if is_printable_jpeg(img, dataSize, size, max_size_kb):
+            if log:
+                log(f'{img.size[0]}x{img.size[1]} JPEG fits the printer, sending it as is')
+            if isinstance(source, str):
+                with open(source, 'rb') as f:
+                    return bytearray(f.read())
+            source.seek(0)
+            return bytearray(source.read())
+
+        return encode_jpeg(load_image(img, size, log), size, max_size_kb, quality_mode, log)
@@ -1,28 +1,58 @@
 #!/usr/bin/env python3
 
+from collections import deque
 from math import ceil
 from struct import pack, unpack_from
-from time import sleep
+from time import perf_counter, sleep
 
 # Try to import Types with a relative import first
 try:
-    from .Types import EventType, InfoType, PrinterSettings
+    from .Types import EventType, InfoType, PrinterSettings, QUALITY_MODES, SERVICE_UUID, WRITE_CHAR_UUID, NOTIFY_CHAR_UUID
+    from .Packetizer import create_image_data_packets
+    from .FrameParser import EVENT_TYPES, PRINTER_HEADER, FrameReassembler
+    from .PrinterState import PrinterState
+    from .TransferStats import TransferStats
     from . import LedPatterns
 except ImportError:
     # If that fails (which it will if this file is being run directly),
     # try an absolute import instead
-    from Types import EventType, InfoType, PrinterSettings
+    from Types import EventType, InfoType, PrinterSettings, QUALITY_MODES, SERVICE_UUID, WRITE_CHAR_UUID, NOTIFY_CHAR_UUID
+    from Packetizer import create_image_data_packets
+    from FrameParser import EVENT_TYPES, PRINTER_HEADER, FrameReassembler
+    from PrinterState import PrinterState
+    from TransferStats import TransferStats
     import LedPatterns
 
 import argparse
+import importlib
 
-import simplepyble
 import sys
-from PIL import Image
+import threading
 from io import BytesIO
 
+# the CLI subcommands, see cli()
+COMMANDS = ('print', 'status', 'led', 'scan', 'prepare')
+
+
+def lazy_import(name):
+    """
+    Import one of our modules when it's first needed instead of at startup,
+    for the ones that pull in PIL (ImageEncoder, ImageCache, Prepare) and the
+    ones only the CLI needs (KnownPrinters, SimulatedPrinter)
+    """
+    try:
+        return importlib.import_module(f'.{name}', __package__)
+    except (ImportError, TypeError):
+        # no package (which happens if this file is being run directly), import it by its own name
+        return importlib.import_module(name)
+
 
 class InstaxBLE:
+    defaultFragmentSize = 182  # used when the MTU can't be read
+    maxFragmentSize = 509  # max attribute length (512) minus the ATT header
+    instrumentationEvents = ('packet_sent', 'reply_received', 'chunk_progress', 'transfer_complete', 'print_complete', 'orientation', 'error',
+                             'fragment_written', 'notification')
+
     def __init__(
         self,
         device_address=None,
@@ -31,54 +61,155 @@ class InstaxBLE:
         dummy_printer=False,
         verbose=False,
         quiet=False,
-        image_path=None):
+        image_path=None,
+        control_write_mode='command',
+        image_write_mode='command',
+        quality_mode='search',
+        image_cache=None,
+        known_printers=None,
+        adapter=None,
+        peripheral=None,
+        trace_path=None):
         """
         Initialize the InstaxBLE class.
         deviceAddress: if specified, will only connect to a printer with this address.
         printEnabled: by default, actual printing is disabled to prevent misprints.
+        control_write_mode / image_write_mode: write image chunks and all other
+            commands using either 'command' (write without response) or 'request'
+            (write with response).
+        quality_mode: how to find the JPEG quality that fits the printer's file size limit:
+            'search' (binary search) or 'predict' (estimate from a downscaled trial encode).
+        image_cache: an ImageCache to store printer-ready JPEGs in, so images
+            that were printed before don't need to be resized and encoded again.
+        known_printers: a KnownPrinters list to remember the printers we connect
+            to in, so we can try connecting to them directly next time.
+        adapter: the simplepyble adapter to use, by default the first one found
+            (when it's first needed, see open_adapter).
+        peripheral: the printer to connect to, skips scanning for it.
+        trace_path: record everything written to and received from the printer
+            to this file until disconnecting, see ProtocolTrace.
         """
         # BLE
-        self.serviceUUID = '70954782-2d83-473d-9e5f-81e1d02d5273'
-        self.writeCharUUID = '70954783-2d83-473d-9e5f-81e1d02d5273'
-        self.notifyCharUUID = '70954784-2d83-473d-9e5f-81e1d02d5273'
-        self.peripheral = None
+        self.serviceUUID = SERVICE_UUID
+        self.writeCharUUID = WRITE_CHAR_UUID
+        self.notifyCharUUID = NOTIFY_CHAR_UUID
+        self.peripheral = peripheral
 
         self.quiet = quiet
         self.dummyPrinter = dummy_printer
+        self.printerModel = 'mini' if self.dummyPrinter else None
         self.printerSettings = PrinterSettings['mini'] if self.dummyPrinter else None
         self.chunkSize = PrinterSettings['mini']['chunkSize'] if self.dummyPrinter else 0
         self.printEnabled = print_enabled
         self.deviceName = device_name.upper() if device_name else None
         self.deviceAddress = device_address.upper() if device_address else None
         self.image_path = image_path
+        self.qualityMode = quality_mode
+        self.imageCache = image_cache
+        self.knownPrinters = known_printers
         self.verbose = verbose if not self.quiet else False
-        self.packetsForPrinting = []
+        self.packetsForPrinting = deque()
+        self.listeners = {}  # instrumentation event name -> callbacks, see on()
+        self.frameReassembler = FrameReassembler()
+        self.responseHandlers = self.create_response_handlers()
+        self.stats = TransferStats()
+        self.sentTimes = {}  # request_key -> send time of the commands still waiting for a reply
+        self.connectTime = 0
         self.pos = (0, 0, 0, 0)
         self.batteryState = 0
         self.batteryPercentage = 0
         self.photosLeft = 0
         self.isCharging = False
+        self.state = PrinterState()  # when the values above were last read from the printer
+        self.ledPatterns = {}  # when -> payload of the LED pattern the printer is set to show
+        self.sentLedPatterns = deque()  # payloads of the LED patterns the printer hasn't replied to yet
+        self.preparedImage = None  # (imgSrc, model, future) started by prepare_image_ahead
+        self.photosBeforePrint = 0
+        self.printStartedAt = None
+        self.printError = None  # why the printer rejected the last print, if it did
         self.imageSize = (PrinterSettings['mini']['width'], PrinterSettings['mini']['height']) if self.dummyPrinter else (0, 0)
         self.waitingForResponse = False
         self.cancelled = False
+        # packets get split into fragments that fit the negotiated MTU (minus 3 bytes of ATT header)
+        self.fragmentSize = self.defaultFragmentSize
+        self.writeStrategy = {'control': control_write_mode, 'image': image_write_mode}
+        for phase, mode in self.writeStrategy.items():
+            if mode not in ('command', 'request'):
+                raise ValueError(f"Unknown {phase} write mode: {mode} (use 'command' or 'request')")
+        self.traceRecorder = None
+        if trace_path:
+            self.traceRecorder = lazy_import('ProtocolTrace').TraceRecorder(self, trace_path)
+            self.traceRecorder.start()
+
+        self._adapter = adapter
+
+    @property
+    def adapter(self):
+        """ The bluetooth adapter, opened on first use """
+        if self._adapter is None:
+            self._adapter = self.open_adapter()
+        return self._adapter
+
+    @adapter.setter
+    def adapter(self, adapter):
+        self._adapter = adapter
+
+    def open_adapter(self):
+        """ Import simplepyble and return the first bluetooth adapter """
+        import simplepyble
 
-        adapters = simplepyble.Adapter.get_adapters()
+        try:
+            adapters = simplepyble.Adapter.get_adapters()
+        except RuntimeError as e:  # e.g. when the bluetooth service isn't running
+            raise ConnectionError(f"No bluetooth adapters found (are they enabled?): {e}") from e
         if len(adapters) == 0:
-            if not self.quiet:
-                sys.exit("No bluetooth adapters found (are they enabled?)")
-            else:
-                sys.exit()
+            raise ConnectionError("No bluetooth adapters found (are they enabled?)")
 
         if len(adapters) > 1:
             self.log(f"Found multiple adapters: {', '.join([adapter.identifier() for adapter in adapters])}")
             self.log(f"Using the first one: {adapters[0].identifier()}")
-        self.adapter = adapters[0]
+        return adapters[0]
 
     def log(self, msg):
         """ Print a debug message"""
         if self.verbose:
             print(msg)
 
+    def on(self, name, callback):
+        """
+        Call <callback> with keyword arguments whenever instrumentation event <name> happens:
+            packet_sent(event, size, writes): a packet was written to the printer.
+            reply_received(event, rtt, packet): the printer replied, rtt is the
+                seconds since the command was sent (None if unknown).
+            chunk_progress(acked, total): the printer acknowledged an image chunk.
+            transfer_complete(stats): the image transfer finished, with the job's TransferStats.
+            print_complete(duration): the printer finished printing, see wait_for_print_completion.
+            orientation(x, y, z, o): the printer replied to an accelerometer request, see MotionStream.
+            error(message): something went wrong.
+            fragment_written(data, mode): <data> was written to the printer, with mode 'command' or 'request'.
+            notification(data): the printer sent a notification, before it gets reassembled (see ProtocolTrace).
+        Replies arrive on the bluetooth library's thread, so callbacks can be called from there.
+        """
+        if name not in self.instrumentationEvents:
+            raise ValueError(f"Unknown event: {name} (use one of {', '.join(self.instrumentationEvents)})")
+        self.listeners.setdefault(name, []).append(callback)
+
+    def off(self, name, callback):
+        """ Stop calling <callback> for event <name> """
+        if callback in self.listeners.get(name, []):
+            self.listeners[name].remove(callback)
+
+    def emit(self, name, **data):
+        """ Call all callbacks registered for event <name> """
+        for callback in self.listeners.get(name, ()):
+            callback(**data)
+
+    def report_error(self, message):
+        """ Log an error, add it to the job's stats and emit it """
+        self.log(message)
+        self.stats.record_error(message)
+        self.emit('error', message=message)
+
     def display_current_status(self):
         """ Display an overview of the current printer state """
         print("\nPrinter details: ")
@@ -88,128 +219,219 @@ class InstaxBLE:
         print(f"Battery level:       {self.batteryPercentage}%")
         print(f"Charging:            {self.isCharging}")
         print(f"Required image size: {self.printerSettings['width']}x{self.printerSettings['height']}px")
-        if self.peripheral.mtu:
+        if hasattr(self.peripheral, 'mtu'):
             print(f"MTU:                 {self.peripheral.mtu()}")
+        print(f"Write strategy:      {self.fragmentSize} byte fragments, "
+              f"control: write {self.writeStrategy['control']}, image: write {self.writeStrategy['image']}")
         print("")
 
+    def create_response_handlers(self):
+        """ Table of opCode -> method that handles the printer's reply to that command """
+        return {
+            EventType.XYZ_AXIS_INFO.value: self.parse_xyz_axis_info,
+            EventType.LED_PATTERN_SETTINGS.value: self.parse_led_pattern_reply,
+            EventType.SUPPORT_FUNCTION_INFO.value: self.parse_function_info,
+            EventType.PRINT_IMAGE_DOWNLOAD_START.value: self.continue_image_transfer,
+            EventType.PRINT_IMAGE_DOWNLOAD_DATA.value: self.continue_image_transfer,
+            EventType.PRINT_IMAGE_DOWNLOAD_END.value: self.continue_image_transfer,
+            EventType.PRINT_IMAGE_DOWNLOAD_CANCEL.value: self.ignore_response,
+            EventType.PRINT_IMAGE.value: self.parse_print_confirmation,
+        }
+
     def parse_printer_response(self, event, packet):
         """ Parse the response packet and print the result """
         # self.log(f"event: {event}")
         self.waitingForResponse = False
 
-        if event == EventType.XYZ_AXIS_INFO:
-            x, y, z, o = unpack_from('<hhhB', packet[6:-1])
-            self.pos = (x, y, z, o)
-        elif event == EventType.LED_PATTERN_SETTINGS:
-            pass
-        elif event == EventType.SUPPORT_FUNCTION_INFO:
-            try:
-                infoType = InfoType(packet[7])
-            except ValueError:
-                self.log(f'Unknown InfoType: {packet[7]}')
-                return
-
-            if infoType == InfoType.IMAGE_SUPPORT_INFO:
-                w, h = unpack_from('>HH', packet[8:12])
-                # self.log(self.prettify_bytearray(packet[8:12]))
-                # self.log(f'image size: {w}x{h}')
-                self.imageSize = (w, h)
-                if (w, h) == (600, 800):
-                    self.printerSettings = PrinterSettings['mini']
-                elif (w, h) == (800, 800):
-                    self.printerSettings = PrinterSettings['square']
-                elif (w, h) == (1260, 840):
-                    self.printerSettings = PrinterSettings['wide']
-                else:
-                    exit(f'Unknown image size from printer: {w}x{h}')
-
-                self.chunkSize = self.printerSettings['chunkSize']
-
-            elif infoType == InfoType.BATTERY_INFO:
-                self.batteryState, self.batteryPercentage = unpack_from('>BB', packet[8:10])
-                # self.log(f'battery state: {self.batteryState}, battery percentage: {self.batteryPercentage}')
-            elif infoType == InfoType.PRINTER_FUNCTION_INFO:
-                dataByte = packet[8]
-                self.photosLeft = dataByte & 15
-                self.isCharging = (1 << 7) & dataByte >= 1
-                # self.log(f'photos left: {self.photosLeft}')
-                # if self.isCharging:
-                #     self.log('Printer is charging')
-                # else:
-                #     self.log('Printer is running on battery')
-
-        elif event == EventType.PRINT_IMAGE_DOWNLOAD_START:
-            self.handle_image_packet_queue()
+        handler = self.responseHandlers.get(event.value)
+        if handler is not None:
+            handler(packet)
+        else:
+            self.log(f'Uncaught response from printer. Eventype: {event}')
 
-        elif event == EventType.PRINT_IMAGE_DOWNLOAD_DATA:
-            self.handle_image_packet_queue()
+    def ignore_response(self, packet):
+        pass
 
-        elif event == EventType.PRINT_IMAGE_DOWNLOAD_END:
-            self.handle_image_packet_queue()
+    def parse_led_pattern_reply(self, packet):
+        """ Remember the LED pattern the printer replied to, if it accepted it """
+        if len(self.sentLedPatterns) == 0:
+            return
+        payload = self.sentLedPatterns.popleft()
+        if packet[6] == 0:
+            self.ledPatterns[payload[0]] = payload
+        else:
+            self.log(f'Printer rejected the LED pattern (status {packet[6]})')
 
-        elif event == EventType.PRINT_IMAGE_DOWNLOAD_CANCEL:
-            pass
+    def continue_image_transfer(self, packet):
+        if packet[6] != 0:
+            # sending the rest won't help, the printer won't print this image
+            self.print_rejected(packet)
+            self.cancel_print()
+            return
+        self.handle_image_packet_queue()
+
+    def print_rejected(self, packet):
+        """ Remember why the printer rejected the print, so wait_for_print_completion doesn't wait for it """
+        event = EVENT_TYPES.get((packet[4], packet[5]))
+        self.printError = f'Printer rejected {event.name if event else "the image"} (status {packet[6]})'
+
+    def parse_xyz_axis_info(self, packet):
+        x, y, z, o = unpack_from('<hhhB', packet[6:-1])
+        self.pos = (x, y, z, o)
+        self.emit('orientation', x=x, y=y, z=z, o=o)
+
+    def parse_print_confirmation(self, packet):
+        self.log('received print confirmation')
+        if packet[6] == 0:
+            self.printStartedAt = perf_counter()
+        else:
+            self.print_rejected(packet)
 
-        elif event == EventType.PRINT_IMAGE:
-            self.log('received print confirmation')
-            pass
+    def parse_function_info(self, packet):
+        try:
+            infoType = InfoType(packet[7])
+        except ValueError:
+            self.log(f'Unknown InfoType: {packet[7]}')
+            return
 
-        else:
-            self.log(f'Uncaught response from printer. Eventype: {event}')
+        if infoType == InfoType.IMAGE_SUPPORT_INFO:
+            w, h = unpack_from('>HH', packet[8:12])
+            # self.log(self.prettify_bytearray(packet[8:12]))
+            # self.log(f'image size: {w}x{h}')
+            self.imageSize = (w, h)
+            if (w, h) == (600, 800):
+                self.printerModel = 'mini'
+            elif (w, h) == (800, 800):
+                self.printerModel = 'square'
+            elif (w, h) == (1260, 840):
+                self.printerModel = 'wide'
+            else:
+                exit(f'Unknown image size from printer: {w}x{h}')
+
+            self.printerSettings = PrinterSettings[self.printerModel]
+            self.chunkSize = self.printerSettings['chunkSize']
+
+        elif infoType == InfoType.BATTERY_INFO:
+            self.batteryState, self.batteryPercentage = unpack_from('>BB', packet[8:10])
+            # self.log(f'battery state: {self.batteryState}, battery percentage: {self.batteryPercentage}')
+        elif infoType == InfoType.PRINTER_FUNCTION_INFO:
+            dataByte = packet[8]
+            self.photosLeft = dataByte & 15
+            self.isCharging = (1 << 7) & dataByte >= 1
+            # self.log(f'photos left: {self.photosLeft}')
+            # if self.isCharging:
+            #     self.log('Printer is charging')
+            # else:
+            #     self.log('Printer is running on battery')
+        self.state.mark(infoType)
 
     def handle_image_packet_queue(self):
         if len(self.packetsForPrinting) > 0 and not self.cancelled:
             if len(self.packetsForPrinting) % 10 == 0:
                 self.log(f"Img packets left to send: {len(self.packetsForPrinting)}")
-            packet = self.packetsForPrinting.pop(0)
+            packet = self.packetsForPrinting.popleft()
             self.send_packet(packet)
 
-    def notification_handler(self, packet):
-        """ Gets called whenever the printer replies and handles parsing the received data """
-        # self.log('Notification handler:')
-        # self.log(f'\t{self.prettify_bytearray(packet[:40])}')
-        if not self.quiet:
-            if len(packet) < 8:
-                self.log(f"\tError: response packet size should be >= 8 (was {len(packet)})!")
-                return
-            elif not self.validate_checksum(packet):
-                self.log("\tResponse packet checksum was invalid!")
-                return
-
-        header, length, op1, op2 = unpack_from('>HHBB', packet)
-        # self.log('\theader: ', header, '\t', self.prettify_bytearray(packet[0:2]))
-        # self.log('\tlength: ', length, '\t', self.prettify_bytearray(packet[2:4]))
-        # self.log('\top1: ', op1, '\t\t', self.prettify_bytearray(packet[4:5]))
-        # self.log('\top2: ', op2, '\t\t', self.prettify_bytearray(packet[5:6]))
+    def notification_handler(self, data):
+        """
+        Gets called whenever the printer sends a notification. A notification
+        can hold part of a reply or more than one, so reassemble them first.
+        """
+        if self.listeners.get('notification'):
+            self.emit('notification', data=data)
+        for packet in self.frameReassembler.feed(data):
+            self.handle_frame(packet)
+
+    def handle_frame(self, packet):
+        """ Handle a single complete reply from the printer """
+        # the frame reassembler already dropped frames with an invalid checksum
+        if not self.quiet and len(packet) < 8:
+            self.report_error(f"\tError: response packet size should be >= 8 (was {len(packet)})!")
+            return
 
-        try:
-            event = EventType((op1, op2))
-            # self.log(f'\tResponse event: {event}')
-        except ValueError:
-            self.log(f"Unknown EventType: ({op1}, {op2})")
+        event = EVENT_TYPES.get((packet[4], packet[5]))
+        if event is None:
+            self.report_error(f"Unknown EventType: ({packet[4]}, {packet[5]})")
             return
 
+        self.record_reply(event, packet)
         self.parse_printer_response(event, packet)
 
+    def record_reply(self, event, packet):
+        """ Update the job's stats with a reply from the printer and emit the matching events """
+        sentAt = self.sentTimes.pop(self.request_key(packet), None)
+        rtt = perf_counter() - sentAt if sentAt is not None else None
+        if rtt is not None:
+            self.stats.record_rtt(event.name, rtt)
+        self.emit('reply_received', event=event, rtt=rtt, packet=packet)
+
+        if event in (EventType.PRINT_IMAGE_DOWNLOAD_START, EventType.PRINT_IMAGE_DOWNLOAD_DATA,
+                     EventType.PRINT_IMAGE_DOWNLOAD_END, EventType.PRINT_IMAGE) and packet[6] != 0:
+            self.report_error(f'Printer replied to {event.name} with status {packet[6]}')
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_DATA:
+            self.stats.chunksAcked += 1
+            self.emit('chunk_progress', acked=self.stats.chunksAcked, total=self.stats.chunks)
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_END:
+            self.stats.finish_transfer()
+            self.log(str(self.stats))
+            self.emit('transfer_complete', stats=self.stats)
+
+    def request_key(self, packet):
+        """
+        What a command and the printer's reply to it have in common, so every
+        command gets timed on its own: the opCode, plus the chunk index for
+        image chunks and the info type for info requests, as more than one of
+        those can be waiting for a reply at once.
+        """
+        opCode = (packet[4], packet[5])
+        reply = packet[:2] == PRINTER_HEADER
+        if opCode == EventType.PRINT_IMAGE_DOWNLOAD_DATA.value:
+            if not reply:
+                return opCode, unpack_from('>I', packet, 6)[0]
+            if len(packet) >= 12:  # replies echo the chunk index after the status byte
+                return opCode, unpack_from('>I', packet, 7)[0]
+            # if they don't, the reply is for the oldest chunk
+            return min((key for key in self.sentTimes if key[0] == opCode), default=None)
+        if opCode == EventType.SUPPORT_FUNCTION_INFO.value and len(packet) > 7:
+            return opCode, packet[7 if reply else 6]
+        return opCode
+
+    def start_timing(self, packet):
+        """ Start timing the round trip of <packet>, right before its last fragment gets written """
+        self.sentTimes[self.request_key(packet)] = perf_counter()
+
+    def start_transfer_stats(self, imgData):
+        """ Start timing the transfer of <imgData> """
+        self.sentTimes.clear()
+        self.stats.start_transfer(len(imgData), ceil(len(imgData) / self.chunkSize))
+
     def connect(self, timeout=0):
         """ Connect to the printer. Stops trying after <timeout> seconds. """
         if self.dummyPrinter:
             return
 
-        self.peripheral = self.find_device(timeout=timeout)
+        start = perf_counter()
+        if self.peripheral is None:
+            self.peripheral = self.find_device(timeout=timeout)
         if self.peripheral:
             try:
-                self.log(f"Connecting to {self.peripheral.identifier()} [{self.peripheral.address()}]")
-                self.peripheral.connect()
+                if not self.peripheral.is_connected():  # find_device already connects to known printers
+                    self.log(f"Connecting to {self.peripheral.identifier()} [{self.peripheral.address()}]")
+                    self.peripheral.connect()
             except Exception as e:
                 if not self.quiet:
                     self.log(f'error on connecting: {e}')
 
             if self.peripheral.is_connected():
-                # check if we're using a version of simplepyble that supports reading mtu
                 self.log(f"Connected")
+                self.update_fragment_size()
 
                 # self.log('Attaching notification_handler')
+                self.frameReassembler.reset()
+                self.state.invalidate()
+                self.ledPatterns.clear()
+                self.sentLedPatterns.clear()
+                self.sentTimes.clear()  # replies to commands sent before reconnecting won't come anymore
                 try:
                     self.peripheral.notify(self.serviceUUID, self.notifyCharUUID, self.notification_handler)
                 except Exception as e:
@@ -217,12 +439,30 @@ class InstaxBLE:
                         self.log(f'Error on attaching notification_handler: {e}')
                         return
 
+                self.connectTime = perf_counter() - start
                 self.get_printer_info()
-                sleep(1)
+                self.wait_for_printer_info()
+                self.remember_printer()
                 self.display_current_status()
 
+    def wait_for_printer_info(self, timeout=1):
+        """ Wait (at most <timeout> seconds) until the printer replied to get_printer_info """
+        deadline = perf_counter() + timeout
+        while len(self.state.stale()) > 0 and perf_counter() < deadline:
+            sleep(0.01)
+
+    def wait_for_reply(self, timeout=1):
+        """ Wait (at most <timeout> seconds) until the printer replied to the last packet we sent """
+        deadline = perf_counter() + timeout
+        while self.waitingForResponse and perf_counter() < deadline:
+            sleep(0.01)
+        if self.waitingForResponse:
+            self.sentTimes.clear()  # we only send one command at a time, so that's the one that didn't get a reply
+
     def disconnect(self):
         """ Disconnect from the printer (if connected) """
+        if self.traceRecorder:
+            self.traceRecorder.stop()
         if self.dummyPrinter:
             return
         if self.peripheral:
@@ -235,8 +475,9 @@ class InstaxBLE:
                 self.log("Disconnected")
 
     def cancel_print(self):
-        self.packetsForPrinting = []
+        self.packetsForPrinting = deque()
         self.waitingForResponse = False
+        self.sentTimes.clear()
         self.send_packet(self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_CANCEL))
 
     def enable_printing(self):
@@ -248,28 +489,23 @@ class InstaxBLE:
         self.printEnabled = False
 
     def find_device(self, timeout=0):
-        """" Scan for our device and return it when found """
-        self.log('Searching for instax printer...')
-        secondsTried = 0
+        """" Find our device and return it. Tries printers we know first, then scans. """
         try:
+            peripheral = self.find_known_device()
+            if peripheral:
+                return peripheral
+
+            self.log('Searching for instax printer...')
+            if hasattr(self.adapter, 'set_callback_on_scan_found'):
+                return self.scan_for_device(timeout)
+
+            # adapters without scan callbacks: scan in blocks of 2 seconds
+            secondsTried = 0
             while True:
                 self.adapter.scan_for(2000)
-                peripherals = self.adapter.scan_get_results()
-                for peripheral in peripherals:
-                    foundName = peripheral.identifier()
-                    foundAddress = peripheral.address()
-                    # if foundName.startswith('INSTAX'):
-                    #     self.log(f"Found: {foundName} [{foundAddress}]")
-                    if (self.deviceName and foundName.startswith(self.deviceName)) or \
-                       (self.deviceAddress and foundAddress == self.deviceAddress) or \
-                       (self.deviceName is None and self.deviceAddress is None and
-                       foundName.startswith('INSTAX-') and foundName.endswith('(IOS)')):
-                        # if foundAddress.startswith('FA:AB:BC'):  # start of IOS endpooint
-                        #     to convert to ANDROID endpoint, replace 'FA:AB:BC' with '88:B4:36')
-                        if peripheral.is_connectable():
-                            return peripheral
-                        elif not self.quiet:
-                            self.log(f"Can't connect to printer at {foundAddress}")
+                for peripheral in self.adapter.scan_get_results():
+                    if self.is_wanted_device(peripheral):
+                        return peripheral
                 secondsTried += 2
                 if timeout != 0 and secondsTried >= timeout:
                     return None
@@ -278,23 +514,119 @@ class InstaxBLE:
             self.disconnect()
             sys.exit()
 
+    def scan(self, timeout=5):
+        """ Scan for <timeout> seconds and return the Instax printers found, as peripherals """
+        self.adapter.scan_for(int(timeout * 1000))
+        printers = {}
+        for peripheral in self.adapter.scan_get_results():
+            if peripheral.identifier().startswith('INSTAX-'):
+                printers[peripheral.address()] = peripheral
+        return list(printers.values())
+
+    def is_wanted_device(self, peripheral):
+        """ Check if a peripheral is the printer we're looking for (and we can connect to it) """
+        foundName = peripheral.identifier()
+        foundAddress = peripheral.address()
+        # if foundName.startswith('INSTAX'):
+        #     self.log(f"Found: {foundName} [{foundAddress}]")
+        if (self.deviceName and foundName.startswith(self.deviceName)) or \
+           (self.deviceAddress and foundAddress == self.deviceAddress) or \
+           (self.deviceName is None and self.deviceAddress is None and
+           foundName.startswith('INSTAX-') and foundName.endswith('(IOS)')):
+            # if foundAddress.startswith('FA:AB:BC'):  # start of IOS endpooint
+            #     to convert to ANDROID endpoint, replace 'FA:AB:BC' with '88:B4:36')
+            if peripheral.is_connectable():
+                return True
+            elif not self.quiet:
+                self.log(f"Can't connect to printer at {foundAddress}")
+        return False
+
+    def scan_for_device(self, timeout=0):
+        """ Scan until the first advertisement of our device comes in and return it """
+        found = []
+        foundEvent = threading.Event()
+
+        def on_scan_found(peripheral):
+            if not foundEvent.is_set() and self.is_wanted_device(peripheral):
+                found.append(peripheral)
+                foundEvent.set()
+
+        self.adapter.set_callback_on_scan_found(on_scan_found)
+        self.adapter.scan_start()
+        try:
+            secondsTried = 0
+            # wait in short steps, so a KeyboardInterrupt gets through
+            while not foundEvent.wait(0.1):
+                secondsTried += 0.1
+                if timeout != 0 and secondsTried >= timeout:
+                    break
+        finally:
+            self.adapter.scan_stop()
+            self.adapter.set_callback_on_scan_found(lambda peripheral: None)
+        return found[0] if found else None
+
+    def find_known_device(self):
+        """
+        Connect directly to a printer from our list of known printers, without
+        scanning. simplepyble can't connect to an address it hasn't seen, so
+        this only works for printers the adapter has paired with; for the rest
+        we still need to scan. Returns the connected peripheral, or None.
+        """
+        if not self.knownPrinters or not hasattr(self.adapter, 'get_paired_peripherals'):
+            return None
+        known = [address for address, info in self.knownPrinters.find(self.deviceName, self.deviceAddress)]
+        if len(known) == 0:
+            return None
+        try:
+            paired = {peripheral.address().upper(): peripheral for peripheral in self.adapter.get_paired_peripherals()}
+        except Exception as e:  # not supported by every backend
+            self.log(f"Can't get paired peripherals: {e}")
+            return None
+
+        for address in known:
+            if address in paired:
+                peripheral = paired[address]
+                self.log(f"Connecting to known printer {peripheral.identifier()} [{address}]")
+                try:
+                    peripheral.connect()
+                except Exception as e:
+                    self.log(f"Couldn't connect to known printer: {e}")
+                if peripheral.is_connected():
+                    return peripheral
+        return None
+
+    def remember_printer(self):
+        """ Add the printer we're connected to to our list of known printers """
+        if self.knownPrinters and self.peripheral:
+            self.knownPrinters.remember(self.peripheral.address(), self.peripheral.identifier(), self.printerModel)
+
     def create_color_payload(self, colorArray, speed, repeat, when):
         """
         Create a payload for a color pattern. See send_led_pattern for details.
         """
-        payload = pack('BBBB', when, len(colorArray), speed, repeat)
-        for color in colorArray:
-            payload += pack('BBB', color[0], color[1], color[2])
-        return payload
+        return LedPatterns.compile_pattern(colorArray, speed, repeat, when)
 
-    def send_led_pattern(self, pattern, speed=5, repeat=255, when=0):
+    def is_led_pattern_active(self, payload):
+        """
+        Check if the printer is already set to show the LED pattern in <payload>. Patterns
+        that play a limited number of times right away aren't, they'll have to play again.
+        """
+        when, _, _, repeat = payload[:4]
+        return self.ledPatterns.get(when) == payload and (repeat == 255 or when != 0)
+
+    def send_led_pattern(self, pattern, speed=5, repeat=255, when=0, force=False):
         """ Send a LED pattern to the Instax printer.
             colorArray: array of BGR(!) values to use in animation, e.g. [[255, 0, 0], [0, 255, 0], [0, 0, 255]]
             speed: time per frame/color: higher is slower animation
             repeat: 0 = don't repeat (so play once), 1-254 = times to repeat, 255 = repeat forever
-            when: 0 = normal, 1 = on print, 2 = on print completion, 3 = pattern switch """
+            when: 0 = normal, 1 = on print, 2 = on print completion, 3 = pattern switch
+            force: send the pattern even if the printer is already showing it """
         payload = self.create_color_payload(pattern, speed, repeat, when)
+        if not force and self.is_led_pattern_active(payload):
+            self.log('LED pattern already set, not sending it again')
+            return
         packet = self.create_packet(EventType.LED_PATTERN_SETTINGS, payload)
+        self.sentLedPatterns.append(payload)  # only counts as set once the printer accepted it
         self.send_packet(packet)
 
     def prettify_bytearray(self, value):
@@ -321,6 +653,59 @@ class InstaxBLE:
         """ Validate the checksum of a packet. """
         return (sum(packet) & 255) == 255
 
+    def update_fragment_size(self):
+        """ Size packet fragments to the MTU negotiated with the printer """
+        # check if we're using a version of simplepyble that supports reading mtu
+        if not hasattr(self.peripheral, 'mtu'):
+            self.fragmentSize = self.defaultFragmentSize
+        else:
+            self.fragmentSize = max(20, min(self.peripheral.mtu() - 3, self.maxFragmentSize))
+        self.log(f"Using fragments of {self.fragmentSize} bytes")
+
+    def get_write_mode(self, packet):
+        """ Get the write mode ('command' or 'request') to use for this packet """
+        if (packet[4], packet[5]) == EventType.PRINT_IMAGE_DOWNLOAD_DATA.value:
+            return self.writeStrategy['image']
+        return self.writeStrategy['control']
+
+    def write_packet(self, packet):
+        """ Write a packet to the printer in parts, without waiting for a response """
+        mode = self.get_write_mode(packet)
+        if mode == 'request':
+            write = self.peripheral.write_request if self.peripheral else None
+        else:
+            write = self.peripheral.write_command if self.peripheral else None
+        tracing = bool(self.listeners.get('fragment_written'))
+
+        numberOfParts = ceil(len(packet) / self.fragmentSize)
+        # self.log(f"> number of parts to send: {numberOfParts}")
+        for subPartIndex in range(numberOfParts):
+            # self.log((subPartIndex + 1), '/', numberOfParts)
+            subPacket = packet[subPartIndex * self.fragmentSize:subPartIndex * self.fragmentSize + self.fragmentSize]
+
+            if subPartIndex == numberOfParts - 1:
+                # before writing, the reply can arrive before write returns
+                self.start_timing(packet)
+            if not self.dummyPrinter:
+                # image packets are memoryviews, simplepyble wants bytes
+                data = bytes(subPacket)
+                write(self.serviceUUID, self.writeCharUUID, data)
+                if tracing:
+                    self.emit('fragment_written', data=data, mode=mode)
+
+        self.record_sent(packet, numberOfParts)
+
+    def record_sent(self, packet, writes):
+        """ Update the job's stats with a packet that was sent in <writes> writes and emit packet_sent """
+        opCode = (packet[4], packet[5])
+        self.stats.record_packet(len(packet), writes)
+        if self.listeners.get('packet_sent'):
+            try:
+                event = EventType(opCode)
+            except ValueError:
+                event = opCode
+            self.emit('packet_sent', event=event, size=len(packet), writes=writes)
+
     def send_packet(self, packet):
         """ Send a packet to the printer """
         if not self.dummyPrinter and not self.quiet:
@@ -343,15 +728,7 @@ class InstaxBLE:
             # self.log(f'sending eventtype: {event}')
 
             self.waitingForResponse = True
-            smallPacketSize = 182
-            numberOfParts = ceil(len(packet) / smallPacketSize)
-            # self.log(f"> number of parts to send: {numberOfParts}")
-            for subPartIndex in range(numberOfParts):
-                # self.log((subPartIndex + 1), '/', numberOfParts)
-                subPacket = packet[subPartIndex * smallPacketSize:subPartIndex * smallPacketSize + smallPacketSize]
-
-                if not self.dummyPrinter:
-                    self.peripheral.write_command(self.serviceUUID, self.writeCharUUID, subPacket)
+            self.write_packet(packet)
 
         except KeyboardInterrupt:
             self.cancelled = True
@@ -370,44 +747,22 @@ class InstaxBLE:
             self.log("Can't print: no photos left")
             return
 
-        imgData = imgSrc
-        if isinstance(imgSrc, str):  # if it's a path, load the image contents
-            image = Image.open(imgSrc)
-            imgData = self.pil_image_to_bytes(image, max_size_kb=105)
-        elif isinstance(imgSrc, BytesIO):
-            imgSrc.seek(0)  # Go to the start of the BytesIO object
-            image = Image.open(imgSrc)
-            imgData = self.pil_image_to_bytes(image, max_size_kb=105)
-
-        # self.log(f"len of imagedata: {len(imgData)}")
-        self.packetsForPrinting = [
-            self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_START, b'\x02\x00\x00\x00' + pack('>I', len(imgData)))
-        ]
-
-        # divide image data up into chunks of <chunkSize> bytes and pad the last chunk with zeroes if needed
-        imgDataChunks = [imgData[i:i + self.chunkSize] for i in range(0, len(imgData), self.chunkSize)]
-        if len(imgDataChunks[-1]) < self.chunkSize:
-            imgDataChunks[-1] = imgDataChunks[-1] + bytes(self.chunkSize - len(imgDataChunks[-1]))
-
-        # create a packet from each of our chunks, this includes adding the chunk number
-        for index, chunk in enumerate(imgDataChunks):
-            imgDataChunks[index] = pack('>I', index) + chunk  # add chunk number as int (4 bytes)
-            self.packetsForPrinting.append(self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_DATA, imgDataChunks[index]))
-
-        self.packetsForPrinting.append(self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_END))
-
-        if self.printEnabled:
-            self.packetsForPrinting.append(self.create_packet(EventType.PRINT_IMAGE))
-            self.packetsForPrinting.append(self.create_packet((0, 2), b'\x02'))
-        elif not self.quiet:
-            self.log("Printing is disabled, sending all packets except the actual print command")
+        self.stats = TransferStats(self.connectTime)
+        self.photosBeforePrint = self.photosLeft
+        self.printStartedAt = None
+        self.printError = None
+        start = perf_counter()
+        imgData = self.get_prepared_image(imgSrc)
+        self.stats.encodeTime = perf_counter() - start
+        self.packetsForPrinting = self.create_image_packets(imgData)
+        self.start_transfer_stats(imgData)
 
         # for packet in self.packetsForPrinting:
         #     self.log(self.prettify_bytearray(packet))
         # exit()
         # send the first packet from our list, the packet handler will take care of the rest
         if not self.dummyPrinter:
-            packet = self.packetsForPrinting.pop(0)
+            packet = self.packetsForPrinting.popleft()
             self.send_packet(packet)
             # try:
             #     while len(self.packetsForPrinting) > 0:
@@ -417,6 +772,83 @@ class InstaxBLE:
             #     self.disconnect()
             #     sys.exit('Cancelled')
 
+    def prepare_image(self, imgSrc, model=None):
+        """
+        Turn an image path, BytesIO object or bytearray into the JPEG data
+        to send to a <model> printer (by default the connected one)
+        """
+        model = model or self.printerModel
+        size = (PrinterSettings[model]['width'], PrinterSettings[model]['height']) if model else self.imageSize
+        imgData = imgSrc
+        if self.imageCache and isinstance(imgSrc, (str, BytesIO)):
+            if isinstance(imgSrc, str):
+                with open(imgSrc, 'rb') as f:
+                    sourceData = f.read()
+            else:
+                sourceData = imgSrc.getvalue()
+            imgData = self.imageCache.get_or_encode(sourceData, model, 105, self.qualityMode, self.log)
+        elif isinstance(imgSrc, (str, BytesIO)):  # a path or file contents: load the image (if it needs encoding at all)
+            if isinstance(imgSrc, BytesIO):
+                imgSrc.seek(0)  # Go to the start of the BytesIO object
+            imgData = lazy_import('ImageEncoder').prepare_jpeg(imgSrc, size, 105, self.qualityMode, self.log)
+        return imgData
+
+    def expected_model(self):
+        """ The model of the printer we're (about to be) connected to, going by our list of known printers """
+        if self.printerModel:
+            return self.printerModel
+        if self.knownPrinters:
+            for address, info in self.knownPrinters.find(self.deviceName, self.deviceAddress):
+                return info.get('model')
+        return None
+
+    def prepare_image_ahead(self, imgSrc):
+        """
+        Start preparing <imgSrc> on a background thread while we're still
+        scanning and connecting, for the model of the printer we expect to
+        connect to (see expected_model). print_image uses the result if the
+        printer turns out to be that model. Returns False if we don't know
+        what to expect.
+        """
+        model = self.expected_model()
+        if model is None or not isinstance(imgSrc, (str, BytesIO)):
+            return False
+        from concurrent.futures import ThreadPoolExecutor  # imports logging, which we don't need otherwise
+
+        self.log(f'Preparing image for a {model} printer while connecting')
+        executor = ThreadPoolExecutor(1)
+        self.preparedImage = (imgSrc, model, executor.submit(self.prepare_image, imgSrc, model))
+        executor.shutdown(wait=False)
+        return True
+
+    def get_prepared_image(self, imgSrc):
+        """ The JPEG data for <imgSrc>: from prepare_image_ahead if it was for the right model, prepared now if not """
+        if self.preparedImage is not None and self.preparedImage[0] is imgSrc:
+            _, model, future = self.preparedImage
+            self.preparedImage = None
+            if model == self.printerModel:
+                return future.result()
+            self.log(f'Image was prepared for a {model} printer but this is a {self.printerModel}, preparing it again')
+            future.exception()  # wait for it to finish, it may still be reading imgSrc
+        return self.prepare_image(imgSrc)
+
+    def create_image_packets(self, imgData):
+        """ Create the queue of packets needed to send (and print) the given image data """
+        # self.log(f"len of imagedata: {len(imgData)}")
+        # divide image data up into chunks of <chunkSize> bytes (with the chunk number in front)
+        packets = create_image_data_packets(imgData, self.chunkSize)
+        packets.appendleft(
+            self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_START, b'\x02\x00\x00\x00' + pack('>I', len(imgData)))
+        )
+        packets.append(self.create_packet(EventType.PRINT_IMAGE_DOWNLOAD_END))
+
+        if self.printEnabled:
+            packets.append(self.create_packet(EventType.PRINT_IMAGE))
+            packets.append(self.create_packet((0, 2), b'\x02'))
+        elif not self.quiet:
+            self.log("Printing is disabled, sending all packets except the actual print command")
+        return packets
+
     def print_services(self):
         """ Get and display and overview of the printer's services and characteristics """
         self.log("Successfully connected, listing services...")
@@ -451,51 +883,9 @@ class InstaxBLE:
 
         self.get_printer_status()
 
-    def pil_image_to_bytes(self, img: Image.Image, max_size_kb: int = None) -> bytearray:
+    def pil_image_to_bytes(self, img, max_size_kb: int = None) -> bytearray:
         """ Convert a PIL image to a bytearray """
-        img_buffer = BytesIO()
-
-        # Convert the image to RGB mode if it's in RGBA mode
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
-
-        # Resize the image to <imageSize> pixels
-        img = img.resize(self.imageSize, Image.Resampling.LANCZOS)
-
-        def save_img_with_quality(quality):
-            img_buffer.seek(0)
-            img.save(img_buffer, format='JPEG', quality=quality)
-            return img_buffer.tell() / 1024
-
-        if max_size_kb is not None:
-            low_quality, high_quality = 1, 100
-            current_quality = 75
-            closest_quality = current_quality
-            min_target_size_kb = max_size_kb * 0.9
-
-            while low_quality <= high_quality:
-                output_size_kb = save_img_with_quality(current_quality)
-                # self.log(f"current output quality: {current_quality}, current size: {output_size_kb}")
-
-                if output_size_kb <= max_size_kb and output_size_kb >= min_target_size_kb:
-                    closest_quality = current_quality
-                    break
-
-                if output_size_kb > max_size_kb:
-                    high_quality = current_quality - 1
-                else:
-                    low_quality = current_quality + 1
-
-                current_quality = (low_quality + high_quality) // 2
-                closest_quality = current_quality
-
-            # Save the image with the closest_quality
-            save_img_with_quality(closest_quality)
-            self.log(f'Saved img with quality of {closest_quality}')
-        else:
-            img.save(img_buffer, format='JPEG')
-
-        return bytearray(img_buffer.getvalue())
+        return lazy_import('ImageEncoder').encode_jpeg(img, self.imageSize, max_size_kb, quality_mode=self.qualityMode, log=self.log)
 
     def wait_one_minute(self):
         """ Wait for one minute. Hacky way of preventing disconnecting too soon """
@@ -503,6 +893,52 @@ class InstaxBLE:
             print("Waiting for one minute...")
         sleep(60)
 
+    def wait_for_print_completion(self, timeout=120, interval=1):
+        """
+        Wait until the printer has finished printing the last image, by polling
+        its photo counter every <interval> seconds until it drops. Returns the
+        number of seconds the print took (counted from the printer accepting
+        the print command), or None if it didn't finish within <timeout> seconds
+        or the printer rejected it (see printError).
+        """
+        if self.dummyPrinter or not self.printEnabled:
+            return 0
+        if not self.quiet:
+            print("Waiting for the print to finish...")
+        start = perf_counter()
+        while perf_counter() - start < timeout:
+            if self.printError is not None:
+                return self.print_failed()
+            if self.print_finished():
+                return self.print_completed()
+            sleep(interval)
+            # the image packets get sent from the notification handler, don't interrupt those
+            if self.printStartedAt is not None:
+                self.get_printer_status()
+        return self.print_timed_out(timeout)
+
+    def print_finished(self):
+        """ Check if the photo counter dropped since we sent the last print """
+        return self.printStartedAt is not None and self.photosLeft < self.photosBeforePrint
+
+    def print_completed(self):
+        """ Record how long the last print took and return that """
+        duration = perf_counter() - self.printStartedAt
+        self.stats.printTime = duration
+        self.log(f'Print finished after {duration:.1f}s')
+        self.emit('print_complete', duration=duration)
+        return duration
+
+    def print_failed(self):
+        """ Report a print the printer rejected """
+        self.log(f'Not waiting for the print: {self.printError}')
+        return None
+
+    def print_timed_out(self, timeout):
+        """ Report a print that didn't finish in time """
+        self.report_error(f"Print didn't finish within {timeout}s")
+        return None
+
 
 def main(args={}):
     """ Example usage of the InstaxBLE class """
@@ -514,15 +950,19 @@ def main(args={}):
         # this script
 
         # instax.enable_printing()
+        # if we know what printer to expect, the image gets resized and encoded while we connect
+        if instax.image_path:
+            instax.prepare_image_ahead(instax.image_path)
         instax.connect()
         # Set a rainbow effect to be shown while printing and a pulsating
         # green effect when printing is done
         instax.send_led_pattern(LedPatterns.rainbow, when=1)
         instax.send_led_pattern(LedPatterns.pulseGreen, when=2)
         # you can also read the current accelerometer values if you want
-        # while True:
-        #     instax.get_printer_orientation()
-        #     sleep(.5)
+        # (from MotionStream import MotionStream)
+        # stream = MotionStream(instax, rate=20)
+        # stream.subscribe(lambda t, x, y, z, o: print(x, y, z, o))
+        # stream.start()
 
         # send your image (.jpg) to the printer by
         # passing the image_path as an argument when calling
@@ -531,8 +971,10 @@ def main(args={}):
             instax.print_image(instax.image_path)
         else:
             instax.print_image(instax.printerSettings['exampleImage'])
-        instax.wait_one_minute()
+        instax.wait_for_print_completion()
 
+    except ConnectionError:
+        raise  # e.g. no bluetooth adapters, cli shows the message
     except Exception as e:
         print(type(e).__name__, __file__, e.__traceback__.tb_lineno)
         instax.log(f'Error: {e}')
@@ -541,15 +983,137 @@ def main(args={}):
         instax.disconnect()  # all done, disconnect
 
 
+def show_status(args={}):
+    """ Connect (which shows the printer's status) and disconnect """
+    instax = InstaxBLE(**args)
+    try:
+        instax.connect()
+        if not instax.dummyPrinter and not (instax.peripheral and instax.peripheral.is_connected()):
+            sys.exit('Not connected to a printer')
+    finally:
+        instax.disconnect()
+
+
+def show_led_pattern(args={}, pattern='rainbow', speed=5, repeat=255, when=0):
+    """ Connect, show the LED pattern called <pattern> (see LedPatterns) and disconnect """
+    if not isinstance(getattr(LedPatterns, pattern, None), (list, tuple)):
+        sys.exit(f'Unknown LED pattern: {pattern}')
+    instax = InstaxBLE(**args)
+    try:
+        instax.connect()
+        instax.send_led_pattern(getattr(LedPatterns, pattern), speed, repeat, when)
+        instax.wait_for_reply()
+    finally:
+        instax.disconnect()
+
+
+def scan_for_printers(args={}, timeout=5):
+    """ List the printers in range """
+    instax = InstaxBLE(**args)
+    printers = instax.scan(timeout)
+    for peripheral in printers:
+        print(f'{peripheral.identifier()} [{peripheral.address()}]')
+    if len(printers) == 0:
+        print('No printers found')
+
+
+def create_parser():
+    """ The command line parser, with a subparser for every command in COMMANDS """
+    printer = argparse.ArgumentParser(add_help=False)
+    printer.add_argument('-a', '--device-address')
+    printer.add_argument('-n', '--device-name')
+    printer.add_argument('-d', '--dummy-printer', action='store_true')
+    printer.add_argument('-v', '--verbose', action='store_true')
+    printer.add_argument('-q', '--quiet', action='store_true')
+    printer.add_argument('--control-write-mode', choices=['command', 'request'], default='command')
+    printer.add_argument('--image-write-mode', choices=['command', 'request'], default='command')
+    printer.add_argument('--no-known-printers', action='store_true',
+                         help="Don't remember printers or try to connect to remembered ones before scanning")
+    printer.add_argument('--simulate', choices=['mini', 'square', 'wide'], help='Use a simulated printer of this model instead of a real one')
+    printer.add_argument('--bluez', action='store_true',
+                         help='Write through sockets from BlueZ instead of simplepyble (Linux only, needs jeepney and --device-address)')
+    printer.add_argument('--trace', dest='trace_path', help='Record everything sent to and received from the printer to this file, see ProtocolTrace.py')
+
+    parser = argparse.ArgumentParser(description='Print to Instax Link printers. Without a command, "print" is used.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    printCommand = subparsers.add_parser('print', parents=[printer], help='Print an image (the default)')
+    printCommand.add_argument('-p', '--print-enabled', action='store_true')
+    printCommand.add_argument('-i', '--image-path', help='Path to the image file')
+    printCommand.add_argument('--quality-mode', choices=QUALITY_MODES, default='search',
+                              help='How to find the JPEG quality that fits the file size limit')
+    printCommand.add_argument('-c', '--cache-dir', help='Cache printer-ready images in this directory')
+    printCommand.add_argument('--cache-size', type=int, default=100, help='Max size of the image cache in MB')
+
+    subparsers.add_parser('status', parents=[printer], help="Show the printer's status")
+
+    led = subparsers.add_parser('led', parents=[printer], help='Show a LED pattern')
+    led.add_argument('pattern', help='Name of a pattern in LedPatterns.py')
+    led.add_argument('--speed', type=int, default=5)
+    led.add_argument('--repeat', type=int, default=255)
+    led.add_argument('--when', type=int, default=0)
+
+    scan = subparsers.add_parser('scan', parents=[printer], help='List the printers in range')
+    scan.add_argument('-t', '--timeout', type=float, default=5, help='Seconds to scan for')
+
+    prepare = subparsers.add_parser('prepare', help='Prepare a directory of images for every model, see Prepare.py')
+    prepare.add_argument('directory', help='Directory with the images to prepare')
+    prepare.add_argument('-o', '--output-dir', required=True, help='Directory to write the prepared images to, one subdirectory per model')
+    prepare.add_argument('-m', '--models', nargs='+', choices=['mini', 'square', 'wide'], default=['mini', 'square', 'wide'])
+    prepare.add_argument('-j', '--workers', type=int, help='Number of worker processes (default: one per CPU core)')
+    prepare.add_argument('--quality-mode', choices=QUALITY_MODES, default='search')
+    prepare.add_argument('-f', '--force', action='store_true', help='Also prepare images that were prepared before')
+    return parser
+
+
+def cli(argv=None):
+    """
+    Run a command from the command line. PIL and simplepyble are only
+    imported by the commands that need them, so --help, scan and status
+    start quickly.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if len(argv) == 0 or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv.insert(0, 'print')  # the options of the original script, without a command
+    args = vars(create_parser().parse_args(argv))
+    command = args.pop('command')
+
+    if command == 'prepare':
+        Prepare = lazy_import('Prepare')
+        prepared, errors = Prepare.prepare_directory(args['directory'], args['output_dir'], args['models'], quality_mode=args['quality_mode'],
+                                                     workers=args['workers'], force=args['force'],
+                                                     progress=lambda done, total, name, error: print(f"[{done}/{total}] {name} {error or 'done'}"))
+        print(f"Prepared {prepared} images" + (f", {len(errors)} failed" if errors else ''))
+        return
+
+    simulate, noKnownPrinters, bluez = args.pop('simulate'), args.pop('no_known_printers'), args.pop('bluez')
+    if simulate:
+        simulator = lazy_import('SimulatedPrinter')
+        args['adapter'] = simulator.SimulatedAdapter([simulator.SimulatedPrinter(simulate)])
+    elif not noKnownPrinters:
+        args['known_printers'] = lazy_import('KnownPrinters').KnownPrinters()
+    if bluez:
+        if not args['device_address']:
+            sys.exit('--bluez needs the address of the printer (--device-address)')
+        args['peripheral'] = lazy_import('Transports').BluezTransport(args['device_address'])
+
+    try:
+        if command == 'print':
+            cacheDir, cacheSize = args.pop('cache_dir'), args.pop('cache_size')
+            if cacheDir:
+                args['image_cache'] = lazy_import('ImageCache').ImageCache(cacheDir, cacheSize)
+            main(args)
+        elif command == 'status':
+            show_status(args)
+        elif command == 'led':
+            pattern, speed, repeat, when = args.pop('pattern'), args.pop('speed'), args.pop('repeat'), args.pop('when')
+            show_led_pattern(args, pattern, speed, repeat, when)
+        elif command == 'scan':
+            timeout = args.pop('timeout')
+            scan_for_printers(args, timeout)
+    except ConnectionError as e:
+        sys.exit(str(e))  # the bluetooth adapter is opened on first use, so e.g. "No bluetooth adapters found" ends up here
+
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-a', '--device-address')
-    parser.add_argument('-n', '--device-name')
-    parser.add_argument('-p', '--print-enabled', action='store_true')
-    parser.add_argument('-d', '--dummy-printer', action='store_true')
-    parser.add_argument('-v', '--verbose', action='store_true')
-    parser.add_argument('-q', '--quiet', action='store_true')
-    parser.add_argument('-i', '--image-path', help='Path to the image file')
-    args = parser.parse_args()
-
-    main(vars(args))
+    cli()
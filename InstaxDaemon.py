@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""
+Keeps the connection to a printer open and accepts print, LED and status
+requests from local clients over a Unix socket, so a print doesn't have to
+wait for scanning, connecting and reading the printer's info first.
+
+    python3 InstaxDaemon.py serve --print-enabled
+    python3 InstaxDaemon.py print image.jpg
+    python3 InstaxDaemon.py led rainbow
+    python3 InstaxDaemon.py status
+
+Requests and replies are JSON objects, one per line:
+    {"command": "print", "image": "/path/to/image.jpg", "wait": true}
+    {"command": "led", "pattern": "rainbow", "speed": 5, "repeat": 255, "when": 0}
+    {"command": "status"}
+Every reply has "ok" set to true or false, failed requests include an "error".
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+
+# Only what the clients need is imported here, the modules the daemon itself needs
+# (the bluetooth library, PIL) are imported when it starts, see InstaxDaemon and serve.
+# Try to import with a relative import first
+try:
+    from .Types import QUALITY_MODES
+    from . import LedPatterns
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import QUALITY_MODES
+    import LedPatterns
+
+
+def default_socket_path():
+    """ Socket path to use when none is given: in the user's runtime dir if there is one """
+    runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtimeDir:
+        return os.path.join(runtimeDir, 'instaxble.sock')
+    return f'/tmp/instaxble-{os.getuid()}.sock'
+
+
+class InstaxDaemon:
+    """
+    Holds an AsyncInstaxBLE connection open, reconnecting when it drops, and
+    serves requests from local clients over a Unix socket. Print requests go
+    through a PrintQueue, so the next image gets encoded while one is printing.
+    """
+
+    def __init__(self, socket_path=None, reconnect_interval=5, **kwargs):
+        """
+        socket_path: path of the Unix socket to listen on, see default_socket_path.
+        reconnect_interval: seconds between checks of the connection.
+        Other arguments are passed on to AsyncInstaxBLE.
+        """
+        try:
+            from .AsyncInstaxBLE import AsyncInstaxBLE
+            from .PrintQueue import PrintQueue
+        except ImportError:
+            from AsyncInstaxBLE import AsyncInstaxBLE
+            from PrintQueue import PrintQueue
+
+        self.socketPath = socket_path or default_socket_path()
+        self.reconnectInterval = reconnect_interval
+        self.instax = AsyncInstaxBLE(**kwargs)
+        self.queue = PrintQueue(self.instax)
+        self.printing = None
+        self.server = None
+
+    def log(self, msg):
+        self.instax.log(msg)
+
+    def is_connected(self):
+        """ Check if we're connected to the printer """
+        return self.instax.dummyPrinter or (self.instax.peripheral is not None and self.instax.peripheral.is_connected())
+
+    async def ensure_connected(self):
+        """ Connect to the printer if we aren't connected. Returns True if we're connected. """
+        if not self.is_connected():
+            self.log('Connecting to printer...')
+            try:
+                # AsyncInstaxBLE serializes connecting, so this doesn't race a reconnect during a print
+                return await self.instax.ensure_connected(timeout=self.reconnectInterval)
+            except Exception as e:
+                self.log(f'Connecting failed: {e}')
+        return self.is_connected()
+
+    async def keep_connected(self):
+        """ Reconnect whenever the connection drops """
+        while True:
+            await self.ensure_connected()
+            await asyncio.sleep(self.reconnectInterval)
+
+    async def serve(self):
+        """ Connect to the printer and serve requests until cancelled """
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)  # left behind by a daemon that didn't shut down cleanly
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        print(f'Listening on {self.socketPath}')
+        keepConnected = asyncio.ensure_future(self.keep_connected())
+        keepStateFresh = asyncio.ensure_future(self.instax.keep_state_fresh())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            keepConnected.cancel()
+            keepStateFresh.cancel()
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+            await self.instax.disconnect()
+
+    async def handle_client(self, reader, writer):
+        """ Answer every request a client sends until it disconnects """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = await self.handle_request(json.loads(line))
+                except Exception as e:
+                    reply = {'ok': False, 'error': str(e) or type(e).__name__}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle_request(self, request):
+        """ Handle a single request and return the reply """
+        command = request.get('command')
+        if command == 'status':
+            return await self.handle_status()
+        elif command == 'print':
+            return await self.handle_print(request)
+        elif command == 'led':
+            return await self.handle_led(request)
+        raise ValueError(f'Unknown command: {command}')
+
+    async def handle_status(self):
+        """
+        Return the printer's status. Info that's still fresh comes from the
+        cache, it's only requested from the printer when it's idle.
+        """
+        connected = await self.ensure_connected()
+        if connected and self.instax.is_idle():
+            await self.instax.refresh_status()
+        return {
+            'ok': connected,
+            'connected': connected,
+            'model': self.instax.printerModel,
+            'photosLeft': self.instax.photosLeft,
+            'batteryPercentage': self.instax.batteryPercentage,
+            'isCharging': self.instax.isCharging,
+            'queued': len(self.queue.jobs),
+            'age': self.instax.state.ages(),
+        }
+
+    async def handle_print(self, request):
+        """ Queue an image, and wait until it's printed unless the request says not to """
+        image = request.get('image')
+        if not image or not os.path.isfile(image):
+            raise ValueError(f'Image not found: {image}')
+        job = self.queue.add(image)
+        if self.printing is None or self.printing.done():
+            self.printing = asyncio.ensure_future(self.work())
+        if not request.get('wait', True):
+            return {'ok': True, 'status': job.status, 'queued': len(self.queue.jobs)}
+
+        status = await job.wait()
+        reply = {'ok': status == 'printed', 'status': status}
+        if job.error:
+            reply['error'] = str(job.error)
+        if job.stats:
+            reply['stats'] = job.stats.summary()
+        return reply
+
+    async def work(self):
+        """ Print the queued jobs """
+        while len(self.queue.jobs) > 0:
+            if not await self.ensure_connected():
+                self.log('Not connected to a printer, trying again in a bit')
+                await asyncio.sleep(self.reconnectInterval)
+                continue
+            await self.queue.run_one()
+
+    async def handle_led(self, request):
+        """ Show a LED pattern, by name (see LedPatterns) or as a list of [b, g, r] colors """
+        pattern = request.get('pattern', 'off')
+        if isinstance(pattern, str):
+            if not isinstance(getattr(LedPatterns, pattern, None), (list, tuple)):
+                raise ValueError(f'Unknown LED pattern: {pattern}')
+            pattern = getattr(LedPatterns, pattern)
+        if not await self.ensure_connected():
+            raise ConnectionError('Not connected to a printer')
+        reply = await self.instax.send_led_pattern(pattern, request.get('speed', 5), request.get('repeat', 255), request.get('when', 0))
+        return {'ok': True, 'sent': reply is not None or self.instax.dummyPrinter}
+
+
+def send_request(request, socketPath=None, timeout=None):
+    """ Send a request to a running daemon and return its reply """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socketPath or default_socket_path())
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep a printer connected and print on request')
+    parser.add_argument('-s', '--socket-path', help=f'Path of the Unix socket (default: {default_socket_path()})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='Run the daemon')
+    serve.add_argument('-a', '--device-address')
+    serve.add_argument('-n', '--device-name')
+    serve.add_argument('-p', '--print-enabled', action='store_true')
+    serve.add_argument('-v', '--verbose', action='store_true')
+    serve.add_argument('-r', '--reconnect-interval', type=float, default=5, help='Seconds between checks of the connection')
+    serve.add_argument('-t', '--timeout', type=float, default=5, help='Seconds to wait for a reply from the printer')
+    serve.add_argument('-w', '--transfer-window', type=int, default=1, help='Number of image chunks to send ahead')
+    serve.add_argument('--quality-mode', choices=QUALITY_MODES, default='search',
+                       help='How to find the JPEG quality that fits the file size limit')
+    serve.add_argument('-c', '--cache-dir', help='Cache printer-ready images in this directory')
+    serve.add_argument('--cache-size', type=int, default=100, help='Max size of the image cache in MB')
+    serve.add_argument('--no-known-printers', action='store_true',
+                       help="Don't remember printers or try to connect to remembered ones before scanning")
+    serve.add_argument('--simulate', choices=['mini', 'square', 'wide'], help='Use a simulated printer of this model instead of a real one')
+
+    printCommand = subparsers.add_parser('print', help='Print an image')
+    printCommand.add_argument('image_path', help='Path to the image file')
+    printCommand.add_argument('--no-wait', action='store_true', help="Return once the image is queued instead of printed")
+
+    led = subparsers.add_parser('led', help='Show a LED pattern')
+    led.add_argument('pattern', help='Name of a pattern in LedPatterns.py')
+    led.add_argument('--speed', type=int, default=5)
+    led.add_argument('--repeat', type=int, default=255)
+    led.add_argument('--when', type=int, default=0)
+
+    subparsers.add_parser('status', help="Show the printer's status")
+
+    args = vars(parser.parse_args())
+    command, socketPath = args.pop('command'), args.pop('socket_path')
+
+    if command == 'serve':
+        try:
+            from .ImageCache import ImageCache
+            from .KnownPrinters import KnownPrinters
+            from .SimulatedPrinter import SimulatedAdapter, SimulatedPrinter
+        except ImportError:
+            from ImageCache import ImageCache
+            from KnownPrinters import KnownPrinters
+            from SimulatedPrinter import SimulatedAdapter, SimulatedPrinter
+
+        cacheDir, cacheSize = args.pop('cache_dir'), args.pop('cache_size')
+        if cacheDir:
+            args['image_cache'] = ImageCache(cacheDir, cacheSize)
+        simulate, noKnownPrinters = args.pop('simulate'), args.pop('no_known_printers')
+        if simulate:
+            args['adapter'] = SimulatedAdapter([SimulatedPrinter(simulate)])
+        elif not noKnownPrinters:
+            args['known_printers'] = KnownPrinters()
+        try:
+            asyncio.run(InstaxDaemon(socketPath, **args).serve())
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
+    if command == 'print':
+        request = {'command': 'print', 'image': os.path.abspath(args['image_path']), 'wait': not args['no_wait']}
+    elif command == 'led':
+        request = {'command': 'led', 'pattern': args['pattern'], 'speed': args['speed'], 'repeat': args['repeat'], 'when': args['when']}
+    else:
+        request = {'command': 'status'}
+    try:
+        reply = send_request(request, socketPath)
+    except OSError as e:
+        sys.exit(f"Can't reach the daemon: {e}")
+    print(json.dumps(reply, indent=2))
+    sys.exit(0 if reply.get('ok') else 1)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import threading
+from time import time
+
+
+class KnownPrinters:
+    """
+    On-disk list of the printers we connected to before: their address,
+    name, model and when we last saw them. Used to connect to a known
+    printer before falling back to scanning.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(os.path.expanduser('~'), '.cache', 'instaxble', 'printers.json')
+        self.lock = threading.Lock()
+        self.printers = self.load()
+
+    def load(self):
+        """ Read the list of known printers, starting over if it's missing or unreadable """
+        try:
+            with open(self.path) as f:
+                printers = json.load(f)
+            return printers if isinstance(printers, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """ Write the list of known printers to disk """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporaryPath = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporaryPath, 'w') as f:
+            json.dump(self.printers, f, indent=2)
+        os.replace(temporaryPath, self.path)  # so other processes never read a half written file
+
+    def remember(self, address, name, model=None):
+        """ Store (or update) a printer we just connected to """
+        with self.lock:
+            printer = self.printers.setdefault(address.upper(), {})
+            printer['name'] = name
+            if model:
+                printer['model'] = model
+            printer['lastSeen'] = time()
+            self.save()
+
+    def forget(self, address):
+        """ Remove a printer from the list """
+        with self.lock:
+            if self.printers.pop(address.upper(), None) is not None:
+                self.save()
+
+    def get(self, address):
+        """ Get the stored info of a printer, or None if we don't know it """
+        return self.printers.get(address.upper())
+
+    def find(self, name=None, address=None):
+        """
+        Known printers whose name starts with <name> and/or whose address is
+        <address> (all of them if neither is given), as (address, info) pairs,
+        most recently seen first.
+        """
+        matches = [(printerAddress, info) for printerAddress, info in self.printers.items()
+                   if name is None or info['name'].upper().startswith(name.upper())
+                   if address is None or printerAddress == address.upper()]
+        return sorted(matches, key=lambda match: match[1]['lastSeen'], reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List or forget the printers InstaxBLE connected to before')
+    parser.add_argument('-f', '--forget', metavar='ADDRESS', help='Forget the printer with this address')
+    parser.add_argument('-p', '--path', help='Path of the list (default: ~/.cache/instaxble/printers.json)')
+    args = parser.parse_args()
+
+    knownPrinters = KnownPrinters(args.path)
+    if args.forget:
+        knownPrinters.forget(args.forget)
+    for address, info in knownPrinters.find():
+        print(f"{info['name']} [{address}] {info.get('model', 'unknown model')}")
@@ -1,3 +1,16 @@
+"""
+LED patterns for send_led_pattern: lists of [b, g, r] colors (note the
+order), one per frame, at most MAX_FRAMES. Besides the hand-written patterns
+below, gradient, pulse and chase render patterns from a few parameters; the
+generated patterns at the bottom can be used by name like the others.
+"""
+
+from functools import lru_cache
+from itertools import chain
+from struct import pack
+
+MAX_FRAMES = 255  # the payload stores the number of frames in a single byte
+
 off = [[0, 0, 0]]
 
 blinkRed = [[0, 0, 255], [0, 0, 0]]
@@ -40,3 +53,59 @@ pulseBlue = [
     [230, 0, 0], [220, 0, 0], [210, 0, 0], [200, 0, 0], [190, 0, 0], [180, 0, 0], [170, 0, 0], [160, 0, 0], [150, 0, 0],
     [140, 0, 0], [130, 0, 0], [120, 0, 0], [110, 0, 0], [100, 0, 0], [90, 0, 0], [80, 0, 0], [70, 0, 0], [60, 0, 0], [50, 0, 0]
 ]
+
+
+def blend(a, b, t):
+    """ Color between <a> (t=0) and <b> (t=1) """
+    return tuple(round(ca + (cb - ca) * t) for ca, cb in zip(a, b))
+
+
+def gradient(colors, steps=32, loop=True):
+    """
+    Fade through <colors> in <steps> frames per color. With <loop> the
+    last color fades back into the first, so the pattern can repeat smoothly.
+    Raises a ValueError if that takes more than MAX_FRAMES frames.
+    """
+    frames = len(colors) * steps if loop else (len(colors) - 1) * steps + 1
+    if frames > MAX_FRAMES:
+        raise ValueError(f'A gradient through {len(colors)} colors in {steps} steps has {frames} frames, the printer takes at most {MAX_FRAMES}')
+    stops = list(colors) + [colors[0]] if loop else list(colors)
+    return tuple(blend(a, b, i / steps) for a, b in zip(stops, stops[1:]) for i in range(steps)) + (() if loop else (tuple(stops[-1]),))
+
+
+def pulse(color, steps=37, low=0.2, high=0.9):
+    """ Fade <color> from <low> to <high> brightness and back in <steps> frames, like pulseRed """
+    half = steps // 2
+    levels = [low + (high - low) * min(i, steps - 1 - i) / half for i in range(steps)]
+    return tuple(tuple(round(c * level) for c in color) for level in levels)
+
+
+def chase(color, background=(0, 0, 0), length=12, tail=4):
+    """ Flash <color> once every <length> frames, fading into <background> over <tail> frames """
+    return tuple(blend(color, background, min(i, tail + 1) / (tail + 1)) for i in range(length))
+
+
+@lru_cache(maxsize=64)
+def compile_frames(frames, speed, repeat, when):
+    return pack('BBBB', when, len(frames), speed, repeat) + bytes(chain.from_iterable(frames))
+
+
+def compile_pattern(pattern, speed=5, repeat=255, when=0):
+    """
+    Create the LED_PATTERN_SETTINGS payload for <pattern>. Payloads are
+    cached, so sending the same pattern again doesn't build it again.
+    Raises a ValueError for patterns without frames or with more than MAX_FRAMES.
+    """
+    if not 0 < len(pattern) <= MAX_FRAMES:
+        raise ValueError(f'LED patterns have 1 to {MAX_FRAMES} frames, this one has {len(pattern)}')
+    frames = pattern if isinstance(pattern, tuple) and isinstance(pattern[0], tuple) else tuple(map(tuple, pattern))
+    return compile_frames(frames, speed, repeat, when)
+
+
+# generated patterns
+fadeRGB = gradient([(255, 0, 0), (0, 255, 0), (0, 0, 255)])
+fadeWarm = gradient([(0, 0, 255), (0, 128, 255), (0, 200, 255)], steps=24)
+pulseWhite = pulse((255, 255, 255))
+pulseYellow = pulse((0, 255, 255))
+chaseBlue = chase((255, 0, 0))
+chaseRed = chase((0, 0, 255))
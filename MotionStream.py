@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+from array import array
+from time import perf_counter, sleep
+
+FIELDS = 5  # time, x, y, z, o
+
+
+class MotionBuffer:
+    """
+    Fixed-size ring buffer of timestamped accelerometer samples. Samples are
+    stored in one preallocated array of doubles, so adding one doesn't
+    allocate anything and the oldest sample gets overwritten once it's full.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.data = array('d', bytes(8 * FIELDS * size))
+        self.count = 0  # number of samples added in total
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t, x, y, z, o):
+        """ Add a sample, overwriting the oldest one when the buffer is full """
+        i = (self.count % self.size) * FIELDS
+        data = self.data
+        data[i] = t
+        data[i + 1] = x
+        data[i + 2] = y
+        data[i + 3] = z
+        data[i + 4] = o
+        self.count += 1
+
+    def sample(self, n):
+        """ The <n>th sample, counting from the oldest one still in the buffer """
+        i = ((self.count - len(self) + n) % self.size) * FIELDS
+        t, x, y, z, o = self.data[i:i + FIELDS]
+        return (t, int(x), int(y), int(z), int(o))
+
+    def latest(self):
+        """ The most recent sample as (t, x, y, z, o), or None if there is none """
+        return self.sample(len(self) - 1) if self.count else None
+
+    def samples(self, since=None):
+        """ All samples in the buffer (or the ones taken after time <since>), oldest first """
+        samples = [self.sample(n) for n in range(len(self))]
+        if since is not None:
+            samples = [sample for sample in samples if sample[0] > since]
+        return samples
+
+    def clear(self):
+        self.count = 0
+
+
+class MotionStream:
+    """
+    Samples the printer's accelerometer (XYZ_AXIS_INFO) at a target rate in
+    the background and keeps the samples in a MotionBuffer. Works with both
+    InstaxBLE (on a thread) and AsyncInstaxBLE (as a task on its event loop).
+    Only one request is in flight at a time, so when the printer replies
+    slower than the target rate, the achieved rate is simply lower.
+
+        stream = MotionStream(instax, rate=20)
+        stream.subscribe(lambda t, x, y, z, o: print(x, y, z, o))
+        stream.start()
+    """
+
+    def __init__(self, instax, rate=20, size=1024):
+        """
+        instax: a connected InstaxBLE or AsyncInstaxBLE instance.
+        rate: number of samples to request per second.
+        size: number of samples to keep.
+        """
+        self.instax = instax
+        self.rate = rate
+        self.buffer = MotionBuffer(size)
+        self.subscribers = []
+        self.missed = 0  # requests the printer didn't reply to in time
+        self.running = False
+        self.task = None
+        self.thread = None
+        instax.on('orientation', self.add_sample)
+
+    def subscribe(self, callback):
+        """ Call <callback>(t, x, y, z, o) for every new sample. Can be called from the bluetooth library's thread. """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def add_sample(self, x, y, z, o):
+        """ Store a reply to an XYZ_AXIS_INFO request and pass it on to the subscribers """
+        t = perf_counter()
+        self.buffer.append(t, x, y, z, o)
+        for callback in self.subscribers:
+            callback(t, x, y, z, o)
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def samples(self, since=None):
+        return self.buffer.samples(since)
+
+    def achieved_rate(self, window=1):
+        """ Samples per second received over the last <window> seconds """
+        samples = self.buffer.samples(perf_counter() - window)
+        if len(samples) < 2:
+            return 0
+        return (len(samples) - 1) / (samples[-1][0] - samples[0][0])
+
+    def start(self):
+        """ Start sampling in the background """
+        if self.running:
+            return
+        self.running = True
+        if asyncio.iscoroutinefunction(self.instax.get_printer_orientation):
+            self.task = asyncio.ensure_future(self.run_async())
+        else:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """ Stop sampling. The samples stay in the buffer. """
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def next_deadline(self, deadline):
+        """ Time of the next request, without trying to catch up on requests we fell behind on """
+        interval = 1 / self.rate
+        now = perf_counter()
+        deadline += interval
+        if deadline < now:
+            deadline = now + interval - (now - deadline) % interval
+        return deadline
+
+    def is_transferring(self):
+        """ Check if an image is being sent, we don't compete with that for the printer's attention """
+        return len(self.instax.packetsForPrinting) > 0
+
+    def run(self):
+        """ Sample on a thread, for InstaxBLE """
+        deadline = perf_counter()
+        while self.running:
+            if not self.is_transferring():
+                # send_packet waits for the reply to the previous request before sending this one
+                self.instax.get_printer_orientation()
+            deadline = self.next_deadline(deadline)
+            sleep(max(0, deadline - perf_counter()))
+
+    async def run_async(self):
+        """ Sample as a task, for AsyncInstaxBLE """
+        deadline = perf_counter()
+        while self.running:
+            if not self.is_transferring():
+                try:
+                    await self.instax.get_printer_orientation()
+                except asyncio.TimeoutError:
+                    self.missed += 1
+            deadline = self.next_deadline(deadline)
+            await asyncio.sleep(max(0, deadline - perf_counter()))
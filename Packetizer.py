@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from struct import pack
+from zlib import adler32
+
+# Try to import Types with a relative import first
+try:
+    from .Types import EventType
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import EventType
+
+
+SUM_PIECE = 256  # bytes, at most 256 * 255 = 65280, which is below adler32's modulus (65521)
+
+
+def byte_sum(data):
+    """
+    sum(data) for a bytes-like object, without going over it byte by byte in
+    Python (which is slow for memoryviews): the low half of adler32 is 1 plus
+    the sum of the bytes, modulo 65521, so that's exact for pieces of SUM_PIECE bytes.
+    """
+    pieces = range(0, len(data), SUM_PIECE)
+    return sum(adler32(data[start:start + SUM_PIECE]) & 0xFFFF for start in pieces) - len(pieces)
+
+
+def create_image_data_packets(imgData, chunkSize):
+    """
+    Create all PRINT_IMAGE_DOWNLOAD_DATA packets for the given image data.
+    All packets are written into one preallocated buffer and handed out as
+    memoryviews into that buffer, instead of building every packet through
+    repeated concatenation. The image data is read through a memoryview as
+    well, so every chunk is copied once, straight into its packet. The last
+    chunk is padded with zeroes.
+    """
+    numberOfChunks = (len(imgData) + chunkSize - 1) // chunkSize
+    packetSize = 7 + 4 + chunkSize  # header, size, opcode and checksum + chunk number + chunk
+    header = b'\x41\x62' + pack('>H', packetSize) + bytes(EventType.PRINT_IMAGE_DOWNLOAD_DATA.value)
+    headerSum = sum(header)
+
+    # zero filled, which takes care of padding the last chunk
+    buffer = bytearray(header + bytes(packetSize - len(header))) * numberOfChunks
+    view = memoryview(buffer)
+    packets = deque()
+    # released when we're done, so a bytearray passed in can still be resized afterwards
+    with memoryview(imgData) as data:
+        for index in range(numberOfChunks):
+            offset = index * packetSize
+            chunk = data[index * chunkSize:(index + 1) * chunkSize]
+            chunkNumber = index.to_bytes(4, 'big')
+            view[offset + 6:offset + 10] = chunkNumber
+            view[offset + 10:offset + 10 + len(chunk)] = chunk
+            # the header is the same for every packet, so only the chunk number and data need summing
+            buffer[offset + packetSize - 1] = (255 - ((headerSum + sum(chunkNumber) + byte_sum(chunk)) & 255)) & 255
+            packets.append(view[offset:offset + packetSize])
+    return packets
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+Prepares a directory of images for printing ahead of time, without a
+printer: every image is decoded once and written as a printer-ready JPEG
+for every model, using all CPU cores.
+
+    python3 Prepare.py /path/to/images -o /path/to/prepared
+
+writes /path/to/prepared/mini/<name>.jpg, .../square/<name>.jpg and
+.../wide/<name>.jpg, where <name> is the image's file name (including its
+extension, unless that's .jpg already). Images that were prepared before
+(and haven't changed since) are skipped, unless --force is given.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+
+# Try to import with a relative import first
+try:
+    from .Types import PrinterSettings
+    from .ImageCache import IMAGE_EXTENSIONS
+    from .ImageEncoder import encode_jpeg, is_printable_jpeg, load_image, QUALITY_MODES
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import PrinterSettings
+    from ImageCache import IMAGE_EXTENSIONS
+    from ImageEncoder import encode_jpeg, is_printable_jpeg, load_image, QUALITY_MODES
+
+from PIL import Image
+
+MODELS = ('mini', 'square', 'wide')
+
+
+def model_size(model):
+    settings = PrinterSettings[model]
+    return (settings['width'], settings['height'])
+
+
+def prepare_variants(sourcePath, models=MODELS, max_size_kb=105, quality_mode='search'):
+    """
+    Create the printer-ready JPEG data of an image for every model in
+    <models>. The image is decoded once, at a scale large enough for the
+    largest model. Returns a dict of model -> JPEG data.
+    """
+    variants = {}
+    with open(sourcePath, 'rb') as f:
+        sourceData = f.read()
+    # when every variant is passed through the image is never loaded, so close it ourselves
+    with Image.open(sourcePath) as img:
+        for model in models:
+            if is_printable_jpeg(img, len(sourceData), model_size(model), max_size_kb):
+                variants[model] = sourceData
+
+        remaining = [model for model in models if model not in variants]
+        if len(remaining) > 0:
+            sizes = [model_size(model) for model in remaining]
+            img = load_image(img, (max(w for w, _ in sizes), max(h for _, h in sizes)))
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')  # reduce() can't handle palette images, and this way it's done once for all models
+            for model, size in zip(remaining, sizes):
+                # like draft mode does when decoding: shrink by a whole factor first, so there's less to resize
+                factor = min(img.width // size[0], img.height // size[1])
+                variants[model] = encode_jpeg(img.reduce(factor) if factor > 1 else img, size, max_size_kb, quality_mode)
+    return variants
+
+
+def output_name(name):
+    """ The file name of a prepared image: the source's, with .jpg added unless it has that already, so photo.png and photo.jpg don't collide """
+    return name if name.lower().endswith('.jpg') else name + '.jpg'
+
+
+def output_path(outputDir, model, name):
+    return os.path.join(outputDir, model, output_name(name))
+
+
+def is_prepared(sourcePath, outputDir, models):
+    """ Check if all variants of an image exist and are newer than the image """
+    sourceTime = os.path.getmtime(sourcePath)
+    for model in models:
+        path = output_path(outputDir, model, os.path.basename(sourcePath))
+        if not os.path.exists(path) or os.path.getmtime(path) < sourceTime:
+            return False
+    return True
+
+
+def prepare_file(sourcePath, outputDir, models=MODELS, max_size_kb=105, quality_mode='search'):
+    """
+    Write the variants of a single image. Runs in a worker process.
+    Returns the number of bytes written and the time it took.
+    """
+    start = perf_counter()
+    written = 0
+    for model, data in prepare_variants(sourcePath, models, max_size_kb, quality_mode).items():
+        path = output_path(outputDir, model, os.path.basename(sourcePath))
+        temporaryPath = f'{path}.{os.getpid()}.tmp'  # unique per worker
+        with open(temporaryPath, 'wb') as f:
+            f.write(data)
+        os.replace(temporaryPath, path)  # so an interrupted run doesn't leave half a file that looks prepared
+        written += len(data)
+    return written, perf_counter() - start
+
+
+def prepare_directory(directory, outputDir, models=MODELS, max_size_kb=105, quality_mode='search', workers=None, force=False,
+                      progress=None):
+    """
+    Prepare every image in <directory> for every model in <models>, in a pool
+    of <workers> processes (default: one per CPU core).
+    progress: called as progress(done, total, name, error) after every image,
+        error is None if it succeeded.
+    Returns the number of images prepared and a dict of name -> error for the
+    ones that failed. Images that would be written to the same file as an
+    earlier one (like photo.png next to photo.png.jpg) fail without being prepared.
+    """
+    for model in models:
+        os.makedirs(os.path.join(outputDir, model), exist_ok=True)
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+    errors = {}
+    outputNames = {}
+    for name in names:
+        other = outputNames.setdefault(output_name(name), name)
+        if other != name:
+            errors[name] = f'would overwrite the prepared {other}'
+    names = [name for name in names if name not in errors]
+    if not force:
+        names = [name for name in names if not is_prepared(os.path.join(directory, name), outputDir, models)]
+
+    total = len(names) + len(errors)
+    if progress:
+        for done, (name, error) in enumerate(errors.items(), 1):
+            progress(done, total, name, error)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(prepare_file, os.path.join(directory, name), outputDir, models, max_size_kb, quality_mode): name
+                   for name in names}
+        for done, future in enumerate(as_completed(futures), len(errors) + 1):
+            name = futures[future]
+            error = future.exception()
+            if error is not None:
+                errors[name] = str(error) or type(error).__name__
+            if progress:
+                progress(done, total, name, errors.get(name))
+    return total - len(errors), errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepare a directory of images for printing, for every printer model')
+    parser.add_argument('directory', help='Directory with the images to prepare')
+    parser.add_argument('-o', '--output-dir', required=True, help='Directory to write the prepared images to, one subdirectory per model')
+    parser.add_argument('-m', '--models', nargs='+', choices=MODELS, default=list(MODELS))
+    parser.add_argument('-j', '--workers', type=int, help='Number of worker processes (default: one per CPU core)')
+    parser.add_argument('--quality-mode', choices=QUALITY_MODES, default='search')
+    parser.add_argument('-f', '--force', action='store_true', help='Also prepare images that were prepared before')
+    args = parser.parse_args()
+
+    start = perf_counter()
+
+    def show_progress(done, total, name, error):
+        status = f'failed: {error}' if error else 'done'
+        print(f'[{done}/{total}] {name} {status}')
+
+    prepared, errors = prepare_directory(args.directory, args.output_dir, args.models, quality_mode=args.quality_mode,
+                                         workers=args.workers, force=args.force, progress=show_progress)
+    print(f'Prepared {prepared} images in {perf_counter() - start:.1f}s' + (f', {len(errors)} failed' if errors else ''))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from time import perf_counter
+
+# Try to import with a relative import first
+try:
+    from .AsyncInstaxBLE import AsyncInstaxBLE
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from AsyncInstaxBLE import AsyncInstaxBLE
+
+
+class PrintJob:
+    """ An image waiting to be printed """
+
+    def __init__(self, imgSrc):
+        self.imgSrc = imgSrc
+        self.status = 'queued'  # queued, printing, printed, skipped or failed
+        self.error = None
+        self.encodeTime = 0
+        self.stats = None  # TransferStats of the print, once it's been sent
+        self.finished = asyncio.Event()
+
+    def finish(self, status, error=None):
+        """ Mark the job as done """
+        self.status = status
+        self.error = error
+        self.finished.set()
+
+    async def wait(self):
+        """ Wait until the job has been printed (or skipped/failed) and return its status """
+        await self.finished.wait()
+        return self.status
+
+
+class PrintQueue:
+    """
+    Prints a queue of images on a connected AsyncInstaxBLE printer. While one
+    image is being sent to and printed by the printer, the next image is
+    already being resized and encoded in a worker thread.
+    """
+
+    def __init__(self, instax, executor=None):
+        """
+        instax: a connected AsyncInstaxBLE instance.
+        executor: the executor to encode images in, by default a single worker thread.
+        """
+        self.instax = instax
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.jobs = deque()
+        self.encoded = {}  # job -> future with its encoded image data
+
+    def add(self, imgSrc):
+        """ Add an image (path, BytesIO or bytearray) to the queue. Returns its PrintJob. """
+        job = PrintJob(imgSrc)
+        self.jobs.append(job)
+        return job
+
+    def encode(self, job):
+        """ Start encoding a job in the executor (if it isn't already) and return the future for it """
+        if job not in self.encoded:
+            loop = asyncio.get_running_loop()
+            self.encoded[job] = loop.run_in_executor(self.executor, self.prepare, job)
+        return self.encoded[job]
+
+    def prepare(self, job):
+        """ Encode a job's image, keeping track of how long that took """
+        start = perf_counter()
+        imgData = self.instax.prepare_image(job.imgSrc)
+        job.encodeTime = perf_counter() - start
+        return imgData
+
+    async def run(self):
+        """
+        Print jobs until the queue is empty or the printer runs out of film.
+        Jobs that can't be printed because there's no film left are skipped.
+        """
+        while len(self.jobs) > 0:
+            if not await self.run_one():
+                break
+
+    async def run_one(self):
+        """ Print the next job in the queue. Returns False if the printer ran out of film. """
+        if self.instax.photosLeft == 0 and not self.instax.dummyPrinter:
+            self.instax.log(f"No photos left, skipping {len(self.jobs)} job(s)")
+            self.skip_remaining()
+            return False
+
+        job = self.jobs.popleft()
+        job.status = 'printing'
+        try:
+            imgData = await self.encode(job)
+            # encode the next image while this one is being sent and printed
+            if len(self.jobs) > 0:
+                self.encode(self.jobs[0])
+
+            printed = await self.instax.print_image(imgData)
+            # the image was encoded ahead of time, so count that instead of passing on the ready data
+            job.stats = self.instax.stats
+            job.stats.encodeTime = job.encodeTime
+            if not printed and self.instax.printError is None:
+                job.finish('skipped')
+                return True
+            if not printed or (self.instax.printEnabled and await self.instax.wait_for_print_completion() is None):
+                if self.instax.printError is not None:
+                    job.finish('failed', RuntimeError(self.instax.printError))
+                else:
+                    job.finish('failed', TimeoutError("Print didn't finish in time"))
+                return True
+            job.finish('printed')
+        except Exception as e:
+            self.instax.log(f"Printing {job.imgSrc} failed: {e}")
+            job.finish('failed', e)
+        finally:
+            self.encoded.pop(job, None)
+        return True
+
+    def skip_remaining(self):
+        """ Skip all jobs that are still in the queue """
+        while len(self.jobs) > 0:
+            job = self.jobs.popleft()
+            future = self.encoded.pop(job, None)
+            if future is not None:
+                future.cancel()
+            job.finish('skipped')
+
+
+async def main(args):
+    """ Print all images passed on the command line """
+    imagePaths = args.pop('image_paths')
+    instax = AsyncInstaxBLE(**args)
+    try:
+        await instax.connect()
+        queue = PrintQueue(instax)
+        jobs = [queue.add(imagePath) for imagePath in imagePaths]
+        await queue.run()
+        for job in jobs:
+            print(f"{job.imgSrc}: {job.status}")
+    finally:
+        await instax.disconnect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print a list of images')
+    parser.add_argument('image_paths', nargs='+', help='Paths to the image files')
+    parser.add_argument('-a', '--device-address')
+    parser.add_argument('-n', '--device-name')
+    parser.add_argument('-p', '--print-enabled', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    parser.add_argument('-w', '--transfer-window', type=int, default=1, help='Number of image chunks to send ahead')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(vars(args)))
+    except ConnectionError as e:
+        sys.exit(str(e))  # e.g. "No bluetooth adapters found (are they enabled?)"
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+
+# Try to import with a relative import first
+try:
+    from .Types import InfoType
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import InfoType
+
+# seconds the info from every status request stays valid, None means until reconnecting
+DEFAULT_TTLS = {
+    InfoType.IMAGE_SUPPORT_INFO: None,  # model and image size
+    InfoType.BATTERY_INFO: 60,  # battery state and percentage
+    InfoType.PRINTER_FUNCTION_INFO: 10,  # photos left and charging
+}
+
+
+class PrinterState:
+    """
+    Keeps track of when each part of the printer's info (model, battery,
+    photos left) was last read from the printer, so it only gets requested
+    again once it's older than its TTL. The values themselves are stored on
+    the InstaxBLE instance as before (printerModel, batteryPercentage,
+    photosLeft, ...), so reading them never touches the radio.
+    """
+
+    def __init__(self, ttls=None):
+        """ ttls: InfoType -> seconds, overrides DEFAULT_TTLS """
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.updated = {}  # InfoType -> time it was last read
+
+    def mark(self, infoType):
+        """ Note that <infoType> was just read from the printer """
+        self.updated[infoType] = monotonic()
+
+    def invalidate(self, infoType=None):
+        """ Forget when <infoType> (or everything) was read, e.g. after reconnecting """
+        if infoType is None:
+            self.updated.clear()
+        else:
+            self.updated.pop(infoType, None)
+
+    def age(self, infoType):
+        """ Seconds since <infoType> was read, None if it never was """
+        if infoType not in self.updated:
+            return None
+        return monotonic() - self.updated[infoType]
+
+    def is_fresh(self, infoType):
+        """ Check if <infoType> was read and hasn't expired yet """
+        age = self.age(infoType)
+        if age is None:
+            return False
+        ttl = self.ttls.get(infoType)
+        return ttl is None or age < ttl
+
+    def stale(self, infoTypes=None):
+        """ The info types (out of <infoTypes>, by default all) that need to be read again """
+        return [infoType for infoType in (infoTypes or self.ttls) if not self.is_fresh(infoType)]
+
+    def ages(self):
+        """ Age in seconds of every info type, keyed by name """
+        return {infoType.name: self.age(infoType) for infoType in self.ttls}
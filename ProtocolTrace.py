@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Records what goes over the air between InstaxBLE and a printer to a compact
+binary trace file, and replays a recorded trace back into InstaxBLE, so a
+slow transfer seen in the field can be reproduced and profiled offline.
+
+    recorder = TraceRecorder(instax, 'transfer.trace')
+    recorder.start()
+    instax.print_image('image.jpg')
+    recorder.stop()
+
+    python3 ProtocolTrace.py dump transfer.trace
+    python3 ProtocolTrace.py replay transfer.trace --speed 10
+
+A trace file starts with a header (MAGIC, a version byte and the wall clock
+time the recording started, as a double). Every fragment written to the
+printer and every notification it sent follows as a record: the microseconds
+since the previous record (uint32), the kind of record (one of KINDS, a
+byte), the length of the data (uint16) and the data itself, all little endian.
+Times come from perf_counter, so they're monotonic.
+"""
+
+import argparse
+import struct
+import threading
+from math import ceil
+from time import perf_counter, sleep, time
+
+# Try to import with a relative import first
+try:
+    from .Types import EventType
+    from .FrameParser import CLIENT_HEADER, PRINTER_HEADER, EVENT_TYPES, MAX_PACKET_LENGTH, FrameReassembler
+    from .TransferStats import TransferStats
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import EventType
+    from FrameParser import CLIENT_HEADER, PRINTER_HEADER, EVENT_TYPES, MAX_PACKET_LENGTH, FrameReassembler
+    from TransferStats import TransferStats
+
+MAGIC = b'IXTR'
+VERSION = 1
+HEADER = struct.Struct('<4sBd')
+RECORD = struct.Struct('<IBH')
+MAX_DELTA = 0xFFFFFFFF  # longer pauses are shortened to ~71 minutes
+
+# record kinds
+WRITE_COMMAND = 0
+WRITE_REQUEST = 1
+NOTIFICATION = 2
+KINDS = {WRITE_COMMAND: 'command', WRITE_REQUEST: 'request', NOTIFICATION: 'notification'}
+
+
+class TraceRecorder:
+    """
+    Writes every fragment InstaxBLE writes to the printer and every
+    notification it gets back to a trace file, using the fragment_written and
+    notification events. Writes and notifications happen on different
+    threads, so records are written under a lock. Also works as a context
+    manager:
+
+        with TraceRecorder(instax, 'transfer.trace'):
+            instax.print_image('image.jpg')
+    """
+
+    def __init__(self, instax, path):
+        self.instax = instax
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        self.lastTime = 0
+        self.records = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """ Create the trace file and start recording """
+        if self.file is not None:
+            return
+        self.file = open(self.path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, time()))
+        self.lastTime = perf_counter()
+        self.records = 0
+        self.instax.on('fragment_written', self.record_write)
+        self.instax.on('notification', self.record_notification)
+
+    def stop(self):
+        """ Stop recording and close the trace file """
+        if self.file is None:
+            return
+        self.instax.off('fragment_written', self.record_write)
+        self.instax.off('notification', self.record_notification)
+        with self.lock:
+            self.file.close()
+            self.file = None
+
+    def record_write(self, data, mode):
+        self.record(WRITE_REQUEST if mode == 'request' else WRITE_COMMAND, data)
+
+    def record_notification(self, data):
+        self.record(NOTIFICATION, data)
+
+    def record(self, kind, data):
+        """ Append a record of <kind> with <data> to the trace """
+        with self.lock:
+            if self.file is None:
+                return
+            now = perf_counter()
+            delta = min(round((now - self.lastTime) * 1e6), MAX_DELTA)
+            self.lastTime = now
+            self.file.write(RECORD.pack(delta, kind, len(data)))
+            self.file.write(data)
+            self.records += 1
+
+
+def read_trace(path):
+    """
+    Read a trace file. Returns the wall clock time the recording started and
+    a list of (seconds since the start, kind, data) tuples.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    if len(content) < HEADER.size:
+        raise ValueError(f'{path} is not a trace file')
+    magic, version, startTime = HEADER.unpack_from(content)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a trace file')
+    if version != VERSION:
+        raise ValueError(f'Unsupported trace version: {version}')
+
+    records = []
+    t = 0
+    offset = HEADER.size
+    while offset + RECORD.size <= len(content):
+        delta, kind, length = RECORD.unpack_from(content, offset)
+        offset += RECORD.size
+        if offset + length > len(content):
+            break  # the recording was cut off halfway through a record
+        t += delta / 1e6
+        records.append((t, kind, content[offset:offset + length]))
+        offset += length
+    return startTime, records
+
+
+def replay_trace(instax, records, speed=1):
+    """
+    Feed the notifications in <records> (see read_trace) to
+    instax.notification_handler, keeping the time between them. <speed>
+    speeds up (or slows down) the replay; with speed=None notifications are
+    fed in as fast as possible, which is what you want when profiling.
+    Recorded writes aren't sent anywhere, but they do update instax.stats and
+    emit packet_sent as they did while recording, so replies get their round
+    trip times. Returns the number of notifications that were fed in.
+    """
+    # writes are reassembled like notifications, so a packet counts once however many fragments it was written in
+    reassembler = FrameReassembler(CLIENT_HEADER, MAX_PACKET_LENGTH)
+    writes = 0
+    notifications = 0
+    start = perf_counter()
+    for t, kind, data in records:
+        if speed:
+            sleep(max(0, start + t / speed - perf_counter()))
+        if kind == NOTIFICATION:
+            instax.notification_handler(data)
+            notifications += 1
+        else:
+            writes += 1
+            for packet in reassembler.feed(data):
+                if (packet[4], packet[5]) == EventType.PRINT_IMAGE_DOWNLOAD_START.value:
+                    start_replayed_transfer(instax, packet)
+                instax.start_timing(packet)
+                instax.record_sent(packet, writes)
+                writes = 0
+    return notifications
+
+
+def start_replayed_transfer(instax, packet):
+    """ Start new stats for the image transfer a replayed PRINT_IMAGE_DOWNLOAD_START packet starts, like print_image does """
+    imageSize = struct.unpack_from('>I', packet, 10)[0]  # after the header, opCode and 4 bytes we don't know the meaning of
+    instax.stats = TransferStats(instax.connectTime)
+    instax.stats.start_transfer(imageSize, ceil(imageSize / instax.chunkSize) if instax.chunkSize else 0)
+
+
+def describe_record(data, kind):
+    """ The name of the command or reply a record starts with, if it starts one """
+    if len(data) < 6 or data[:2] != (PRINTER_HEADER if kind == NOTIFICATION else CLIENT_HEADER):
+        return ''
+    event = EVENT_TYPES.get((data[4], data[5]))
+    return event.name if event else f'({data[4]}, {data[5]})'
+
+
+def dump_trace(path, width=40):
+    """ Print every record of a trace, with the first <width> bytes of its data """
+    startTime, records = read_trace(path)
+    written = received = 0
+    for t, kind, data in records:
+        if kind == NOTIFICATION:
+            received += len(data)
+        else:
+            written += len(data)
+        direction = '<' if kind == NOTIFICATION else '>'
+        hexData = ' '.join(f'{x:02x}' for x in data[:width]) + (' ...' if len(data) > width else '')
+        print(f'{t:10.6f} {direction} {KINDS.get(kind, kind):12} {len(data):4} {describe_record(data, kind):30} {hexData}')
+    duration = records[-1][0] if records else 0
+    print(f'{len(records)} records in {duration:.3f}s, {written} bytes written, {received} bytes received')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show or replay a protocol trace recorded with TraceRecorder')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    dump = subparsers.add_parser('dump', help='Show every write and notification in a trace')
+    dump.add_argument('trace')
+    replay = subparsers.add_parser('replay', help='Feed the notifications in a trace to a dummy printer and show the transfer statistics')
+    replay.add_argument('trace')
+    replay.add_argument('-s', '--speed', type=float, default=1, help='Replay this many times faster than recorded (0: as fast as possible)')
+    replay.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'dump':
+        dump_trace(args.trace)
+    else:
+        try:
+            from .InstaxBLE import InstaxBLE
+        except ImportError:
+            from InstaxBLE import InstaxBLE
+        _, records = read_trace(args.trace)
+        instax = InstaxBLE(dummy_printer=True, verbose=args.verbose)
+        start = perf_counter()
+        notifications = replay_trace(instax, records, args.speed or None)
+        print(f'Replayed {notifications} notifications in {perf_counter() - start:.3f}s')
+        print(instax.stats)
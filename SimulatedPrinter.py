@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+
+import heapq
+import random
+import socket
+import threading
+from struct import pack, unpack_from
+from time import monotonic, sleep
+
+# Try to import with a relative import first
+try:
+    from .Types import EventType, InfoType, PrinterSettings
+    from .FrameParser import CLIENT_HEADER, MAX_PACKET_LENGTH, FrameReassembler
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import EventType, InfoType, PrinterSettings
+    from FrameParser import CLIENT_HEADER, MAX_PACKET_LENGTH, FrameReassembler
+
+
+MAX_WRITE_LENGTH = 512
+
+
+class LinkScheduler(threading.Thread):
+    """ Runs callbacks at a given (monotonic) time, in order, on a background thread """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.events = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def schedule(self, at, callback, *args):
+        """ Run callback(*args) at time <at> """
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.events, (at, self.counter, callback, args))
+            self.condition.notify()
+
+    def stop(self):
+        """ Stop the scheduler, dropping all events that haven't run yet """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (len(self.events) == 0 or self.events[0][0] > monotonic()):
+                    self.condition.wait(None if len(self.events) == 0 else self.events[0][0] - monotonic())
+                if self.stopped:
+                    return
+                at, counter, callback, args = heapq.heappop(self.events)
+            callback(*args)
+
+
+class SimulatedPrinter:
+    """
+    An in-process stand-in for an Instax printer peripheral. It has the same
+    surface as the simplepyble peripheral InstaxBLE uses, decodes the packets
+    written to it and answers them like a printer would, over a simulated
+    link with configurable latency, bandwidth, MTU, jitter and packet loss.
+    """
+
+    def __init__(
+        self,
+        model='mini',
+        name='INSTAX-00000000(IOS)',
+        address='FA:AB:BC:00:00:00',
+        photos_left=10,
+        battery=80,
+        charging=False,
+        mtu=185,
+        latency=0.015,
+        write_latency=0.0075,
+        bandwidth=20000,
+        jitter=0,
+        loss=0,
+        print_time=0,
+        accepts_window=True,
+        keeps_transfer=True,
+        notification_size=None,
+        rssi=-50,
+        seed=None,
+    ):
+        """
+        model: 'mini', 'square' or 'wide'.
+        mtu: the MTU negotiated on connecting, writes can be at most mtu - 3 bytes.
+        latency: seconds between the printer receiving a packet and its reply arriving.
+        write_latency: seconds every GATT write occupies the link, on top of its bytes.
+        bandwidth: link speed in bytes per second.
+        jitter: max number of seconds randomly added to every reply.
+        loss: chance (0-1) that a packet never reaches the printer (so never gets a reply).
+        print_time: seconds a print takes, the photo counter drops once it's done.
+        accepts_window: if False, image chunks that arrive before the previous one
+            was acknowledged get rejected.
+        keeps_transfer: if False, the image received so far is dropped when the
+            connection drops, so a transfer can't be resumed after reconnecting.
+        notification_size: if set, replies are split into notifications of at most this many bytes.
+        """
+        self.model = model
+        self.name = name
+        self.addressValue = address
+        self.photosLeft = photos_left
+        self.battery = battery
+        self.charging = charging
+        self.mtuValue = mtu
+        self.latency = latency
+        self.writeLatency = write_latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.loss = loss
+        self.printTime = print_time
+        self.acceptsWindow = accepts_window
+        self.keepsTransfer = keeps_transfer
+        self.notificationSize = notification_size
+        self.rssiValue = rssi
+        self.random = random.Random(seed)
+
+        self.connected = False
+        self.callback = None
+        self.scheduler = None
+        self.linkFreeAt = 0
+        self.lastReplyAt = 0
+        self.previousReplyAt = 0
+        self.reassembler = FrameReassembler(CLIENT_HEADER, MAX_PACKET_LENGTH)
+        self.packetSentAt = 0
+        self.pos = (0, 0, 0, 0)
+        self.reset_image()
+
+        # statistics
+        self.writes = 0
+        self.bytesWritten = 0
+        self.packetsReceived = 0
+        self.packetsLost = 0
+        self.receivedImages = []
+
+    def reset_image(self):
+        """ Forget the image being received """
+        self.imageSize = None
+        self.imageChunks = {}
+        self.imageComplete = None
+
+    # simplepyble peripheral surface
+
+    def identifier(self):
+        return self.name
+
+    def address(self):
+        return self.addressValue
+
+    def rssi(self):
+        return self.rssiValue
+
+    def is_connectable(self):
+        return True
+
+    def is_connected(self):
+        return self.connected
+
+    def mtu(self):
+        return self.mtuValue
+
+    def services(self):
+        return []
+
+    def connect(self):
+        if not self.connected:
+            self.connected = True
+            self.scheduler = LinkScheduler()
+            self.scheduler.start()
+
+    def disconnect(self):
+        if self.connected:
+            self.connected = False
+            self.scheduler.stop()
+            self.scheduler = None
+            self.reassembler.reset()
+            if not self.keepsTransfer:
+                self.reset_image()
+
+    def notify(self, service, characteristic, callback):
+        self.callback = callback
+
+    def write_command(self, service, characteristic, data):
+        """ Write without response: returns as soon as the write is queued on the link """
+        self.transmit(data)
+
+    def write_request(self, service, characteristic, data):
+        """ Write with response: returns once the printer has acknowledged the write """
+        arrivesAt = self.transmit(data)
+        sleep(max(0, arrivesAt + self.latency - monotonic()))
+
+    # link
+
+    def transmit(self, data):
+        """ Put a write on the link and return the time it arrives at the printer """
+        if not self.connected:
+            raise RuntimeError('Peripheral is not connected')
+        if len(data) > self.mtuValue - 3:
+            raise RuntimeError(f'Write of {len(data)} bytes exceeds the MTU of {self.mtuValue}')
+
+        self.writes += 1
+        self.bytesWritten += len(data)
+        # writes go out one after the other, each taking up the link for a while
+        sentAt = monotonic()
+        self.linkFreeAt = max(sentAt, self.linkFreeAt) + self.writeLatency + len(data) / self.bandwidth
+        self.scheduler.schedule(self.linkFreeAt, self.receive, bytes(data), sentAt)
+        return self.linkFreeAt
+
+    def receive(self, fragment, sentAt):
+        """ Gets called when a fragment arrives at the printer """
+        if len(self.reassembler.buffer) == 0:
+            self.packetSentAt = sentAt
+        for packet in self.reassembler.feed(fragment):
+            if self.random.random() < self.loss:
+                self.packetsLost += 1
+                continue
+            self.packetsReceived += 1
+            reply = self.handle_packet(packet)
+            if reply is not None:
+                self.previousReplyAt = self.reply(reply)
+
+    def reply(self, payload):
+        """ Send a notification back, keeping the order replies were sent in. Returns the time it arrives. """
+        replyAt = monotonic() + self.latency + self.random.uniform(0, self.jitter)
+        self.lastReplyAt = max(self.lastReplyAt, replyAt)
+        size = self.notificationSize or len(payload)
+        for start in range(0, len(payload), size):
+            self.scheduler.schedule(self.lastReplyAt, self.notify_client, payload[start:start + size])
+        return self.lastReplyAt
+
+    def notify_client(self, packet):
+        if self.connected and self.callback:
+            self.callback(packet)
+
+    # protocol
+
+    def create_reply(self, opCode, payload=b''):
+        """ Create an 'aB' packet from printer to client """
+        packet = b'\x61\x42' + pack('>H', 7 + len(payload)) + bytes(opCode) + payload
+        return packet + pack('B', (255 - (sum(packet) & 255)) & 255)
+
+    def handle_packet(self, packet):
+        """ Handle a complete packet from the client and return the reply to send (if any) """
+        if packet[:2] != b'\x41\x62' or (sum(packet) & 255) != 255:
+            return None
+        opCode = (packet[4], packet[5])
+        payload = packet[6:-1]
+        try:
+            event = EventType(opCode)
+        except ValueError:
+            return self.create_reply(opCode, b'\x01')
+
+        if event == EventType.SUPPORT_FUNCTION_INFO:
+            return self.create_reply(opCode, b'\x00' + self.function_info(payload[0]))
+        elif event == EventType.XYZ_AXIS_INFO:
+            return self.create_reply(opCode, pack('<hhhB', *self.pos))
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_START:
+            self.reset_image()
+            self.imageSize = unpack_from('>I', payload, 4)[0]
+            return self.create_reply(opCode, b'\x00')
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_DATA:
+            index = unpack_from('>I', payload)[0]
+            status = 0
+            if self.imageSize is None:
+                status = 1
+            elif not self.acceptsWindow and self.packetSentAt < self.previousReplyAt:
+                status = 1  # sent before our reply to the previous packet arrived
+            else:
+                self.imageChunks[index] = payload[4:]
+            return self.create_reply(opCode, pack('>BI', status, index))
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_END:
+            if self.imageSize is None:
+                return self.create_reply(opCode, b'\x01')
+            imgData = b''.join(self.imageChunks[index] for index in sorted(self.imageChunks))[:self.imageSize]
+            self.imageComplete = imgData if len(imgData) == self.imageSize else None
+            self.receivedImages.append(imgData)
+            return self.create_reply(opCode, b'\x00' if self.imageComplete else b'\x01')
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_CANCEL:
+            self.reset_image()
+            return self.create_reply(opCode, b'\x00')
+        elif event == EventType.PRINT_IMAGE:
+            if self.imageComplete is None or self.photosLeft == 0:
+                return self.create_reply(opCode, b'\x01')
+            self.imageComplete = None
+            self.scheduler.schedule(monotonic() + self.printTime, self.finish_print)
+            return self.create_reply(opCode, b'\x00')
+        return self.create_reply(opCode, b'\x00')
+
+    def function_info(self, infoType):
+        """ Payload of the reply to a SUPPORT_FUNCTION_INFO request """
+        settings = PrinterSettings[self.model]
+        if infoType == InfoType.IMAGE_SUPPORT_INFO.value:
+            return pack('>BHH', infoType, settings['width'], settings['height'])
+        elif infoType == InfoType.BATTERY_INFO.value:
+            return pack('>BBB', infoType, 2 if self.charging else 1, self.battery)
+        elif infoType == InfoType.PRINTER_FUNCTION_INFO.value:
+            return pack('>BB', infoType, (self.photosLeft & 15) | (128 if self.charging else 0))
+        return pack('>B', infoType)
+
+    def finish_print(self):
+        self.photosLeft = max(0, self.photosLeft - 1)
+
+
+class SimulatedAdapter:
+    """ Stand-in for a simplepyble adapter that 'finds' the given simulated printers when scanning """
+
+    def __init__(self, printers, name='simulated', paired=(), advertising_interval=0.1):
+        """
+        printers: the simulated printers to find when scanning.
+        paired: the simulated printers this adapter is paired with.
+        advertising_interval: seconds until a printer's first advertisement comes in after starting a scan.
+        """
+        self.printers = printers
+        self.paired = list(paired)
+        self.name = name
+        self.advertisingInterval = advertising_interval
+        self.onScanFound = None
+        self.timers = []
+
+    def identifier(self):
+        return self.name
+
+    def address(self):
+        return '00:00:00:00:00:00'
+
+    def scan_for(self, timeout_ms):
+        sleep(timeout_ms / 1000)
+
+    def scan_get_results(self):
+        return list(self.printers)
+
+    def get_paired_peripherals(self):
+        return list(self.paired)
+
+    def set_callback_on_scan_found(self, callback):
+        self.onScanFound = callback
+
+    def scan_start(self):
+        for printer in self.printers:
+            timer = threading.Timer(self.advertisingInterval, lambda printer=printer: self.onScanFound and self.onScanFound(printer))
+            timer.daemon = True
+            timer.start()
+            self.timers.append(timer)
+
+    def scan_stop(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
+
+class SimulatedSocketPrinter:
+    """
+    Serves a simulated printer over socket pairs, like the sockets BlueZ
+    hands out for AcquireWrite and AcquireNotify: every message written to
+    the write socket is a GATT write to the printer, every reply comes back
+    as a message on the notify socket. Lets Transports.SocketTransport be
+    tested without bluetooth:
+
+        printer = SimulatedSocketPrinter(SimulatedPrinter('mini'))
+        instax = InstaxBLE(peripheral=SocketTransport(printer.open_sockets, printer.printer.name))
+    """
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.serverSockets = ()
+
+    def open_sockets(self):
+        """ Connect the printer and return the client's (write socket, notify socket, MTU) """
+        writeClient, writeServer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        notifyClient, notifyServer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.printer.connect()
+        self.printer.notify(None, None, lambda data: self.send_notification(notifyServer, data))
+        self.serverSockets = (writeServer, notifyServer)
+        threading.Thread(target=self.serve, args=(writeServer, notifyServer), daemon=True).start()
+        return writeClient, notifyClient, self.printer.mtu()
+
+    def send_notification(self, notifyServer, data):
+        try:
+            notifyServer.send(data)
+        except OSError:
+            pass  # the client disconnected
+
+    def serve(self, writeServer, notifyServer):
+        """ Pass the client's writes on to the printer until the client closes its socket """
+        while True:
+            try:
+                data = writeServer.recv(MAX_WRITE_LENGTH)
+            except OSError:
+                break
+            if not data:
+                break
+            try:
+                self.printer.write_command(None, None, data)
+            except RuntimeError:  # e.g. the printer got disconnected
+                break
+        self.printer.disconnect()
+        writeServer.close()
+        notifyServer.close()
+
+    def drop_connection(self):
+        """ Disconnect the printer from its side, like it got out of range """
+        self.printer.disconnect()
+        for sock in self.serverSockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
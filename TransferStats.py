@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+from time import perf_counter
+
+# upper bounds (in seconds) of the round trip time histogram buckets
+RTT_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+class TransferStats:
+    """
+    Statistics of a single print job: what was sent, how long the printer
+    took to reply to every command and where the time went.
+    """
+
+    def __init__(self, connectTime=0):
+        """ connectTime: seconds it took to connect to the printer this job was sent to """
+        self.packetsSent = 0
+        self.bytesSent = 0
+        self.writes = 0
+        self.rtts = {}  # command name -> list of round trip times in seconds
+        self.errors = []
+        self.imageSize = 0
+        self.chunks = 0
+        self.chunksAcked = 0
+        self.resumes = 0  # times the transfer continued after reconnecting
+        self.restarts = 0  # times the printer didn't accept that and the transfer started over
+        self.connectTime = connectTime
+        self.encodeTime = 0
+        self.transferStart = None
+        self.transferTime = 0
+        self.printTime = 0
+
+    def record_packet(self, size, writes):
+        """ Count a packet of <size> bytes that was sent in <writes> GATT writes """
+        self.packetsSent += 1
+        self.bytesSent += size
+        self.writes += writes
+
+    def record_rtt(self, command, rtt):
+        """ Store the time between sending <command> and the printer's reply to it """
+        self.rtts.setdefault(command, []).append(rtt)
+
+    def record_error(self, message):
+        self.errors.append(message)
+
+    def start_transfer(self, imageSize, chunks):
+        """ Mark the start of sending an image of <imageSize> bytes in <chunks> chunks """
+        self.imageSize = imageSize
+        self.chunks = chunks
+        self.chunksAcked = 0
+        self.transferStart = perf_counter()
+
+    def finish_transfer(self):
+        """ Mark the end of the image transfer """
+        if self.transferStart is not None:
+            self.transferTime = perf_counter() - self.transferStart
+
+    def throughput(self):
+        """ Effective image transfer speed in bytes per second """
+        return self.imageSize / self.transferTime if self.transferTime > 0 else 0
+
+    def histogram(self, command=None):
+        """
+        Count the round trip times of <command> (or all commands) per bucket.
+        Returns a list of (upper bound in seconds, count), the last bucket
+        having an upper bound of None.
+        """
+        rtts = self.rtts.get(command, []) if command else [rtt for rtts in self.rtts.values() for rtt in rtts]
+        counts = [0] * (len(RTT_BUCKETS) + 1)
+        for rtt in rtts:
+            counts[bisect_left(RTT_BUCKETS, rtt)] += 1
+        return list(zip(RTT_BUCKETS + (None,), counts))
+
+    def summary(self):
+        """ The statistics as a dict, e.g. to log as JSON """
+        return {
+            'packetsSent': self.packetsSent,
+            'bytesSent': self.bytesSent,
+            'writes': self.writes,
+            'imageSize': self.imageSize,
+            'chunks': self.chunks,
+            'chunksAcked': self.chunksAcked,
+            'resumes': self.resumes,
+            'restarts': self.restarts,
+            'connectTime': self.connectTime,
+            'encodeTime': self.encodeTime,
+            'transferTime': self.transferTime,
+            'printTime': self.printTime,
+            'throughput': self.throughput(),
+            'rtts': {command: {
+                'count': len(rtts),
+                'min': min(rtts),
+                'mean': sum(rtts) / len(rtts),
+                'max': max(rtts),
+                'histogram': self.histogram(command),
+            } for command, rtts in self.rtts.items()},
+            'errors': self.errors,
+        }
+
+    def __str__(self):
+        lines = [
+            f"Sent {self.bytesSent / 1024:.1f}KB in {self.packetsSent} packets, {self.writes} writes",
+            f"Image: {self.imageSize / 1024:.1f}KB, {self.chunksAcked}/{self.chunks} chunks acknowledged, "
+            f"{self.throughput() / 1024:.1f}KB/s",
+            f"Time: connect {self.connectTime:.2f}s, encode {self.encodeTime:.2f}s, transfer {self.transferTime:.2f}s, "
+            f"print {self.printTime:.2f}s",
+        ]
+        for command, rtts in self.rtts.items():
+            lines.append(f"RTT {command}: {len(rtts)}x, min {min(rtts) * 1000:.0f}ms, "
+                         f"mean {sum(rtts) / len(rtts) * 1000:.0f}ms, max {max(rtts) * 1000:.0f}ms")
+        if self.resumes:
+            lines.append(f"Reconnected {self.resumes}x, restarted {self.restarts}x")
+        if self.errors:
+            lines.append(f"Errors: {', '.join(self.errors)}")
+        return '\n'.join(lines)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+Transports let InstaxBLE talk to a printer through something other than
+simplepyble. A transport has the part of simplepyble's Peripheral interface
+InstaxBLE uses, so it can be passed in as the peripheral:
+
+    instax = InstaxBLE(peripheral=BluezTransport('FA:AB:BC:xx:xx:xx'))
+
+BluezTransport (Linux only, needs jeepney) asks BlueZ for file descriptors
+to write to and get notifications from (AcquireWrite and AcquireNotify), so
+writes and notifications go through the kernel instead of being a D-Bus
+call each.
+"""
+
+import socket
+import threading
+from abc import ABC, abstractmethod
+from time import monotonic, sleep
+
+# Try to import with a relative import first
+try:
+    from .Types import SERVICE_UUID, WRITE_CHAR_UUID, NOTIFY_CHAR_UUID
+except ImportError:
+    # If that fails (which it will if this file is being run directly),
+    # try an absolute import instead
+    from Types import SERVICE_UUID, WRITE_CHAR_UUID, NOTIFY_CHAR_UUID
+
+MAX_ATTRIBUTE_LENGTH = 512  # the most a single write or notification can hold
+
+
+class Transport(ABC):
+    """
+    The part of simplepyble's Peripheral interface InstaxBLE uses. Subclasses
+    implement the abstract methods, a transport missing one can't be created.
+    """
+
+    def __init__(self, name='INSTAX', address=''):
+        self.name = name
+        self.addressValue = address
+
+    def identifier(self):
+        return self.name
+
+    def address(self):
+        return self.addressValue
+
+    def is_connectable(self):
+        return True
+
+    def services(self):
+        return []
+
+    @abstractmethod
+    def is_connected(self):
+        pass
+
+    @abstractmethod
+    def connect(self):
+        pass
+
+    @abstractmethod
+    def disconnect(self):
+        pass
+
+    @abstractmethod
+    def mtu(self):
+        pass
+
+    @abstractmethod
+    def notify(self, service, characteristic, callback):
+        """ Call <callback> with the data of every notification """
+        pass
+
+    @abstractmethod
+    def write_command(self, service, characteristic, data):
+        """ Write without response """
+        pass
+
+    @abstractmethod
+    def write_request(self, service, characteristic, data):
+        """ Write with response """
+        pass
+
+
+class SocketTransport(Transport):
+    """
+    Writes and notifications over two SOCK_SEQPACKET sockets, one message per
+    write or notification, like the ones BlueZ hands out for AcquireWrite and
+    AcquireNotify. A thread reads the notifications and passes them on.
+    """
+
+    def __init__(self, open_sockets=None, name='INSTAX', address=''):
+        """
+        open_sockets: called on connecting, returns (write socket, notify socket, MTU).
+            Subclasses can override open_sockets instead, one of the two is required.
+        """
+        # open_sockets can't be an abstractmethod, as passing it in is enough, so check it here like ABC would
+        if open_sockets is None and type(self).open_sockets is SocketTransport.open_sockets:
+            raise TypeError(f"Can't instantiate {type(self).__name__} without open_sockets: pass it in or override it")
+        super().__init__(name, address)
+        if open_sockets is not None:
+            self.open_sockets = open_sockets
+        self.writeSocket = None
+        self.notifySocket = None
+        self.mtuValue = 23  # the minimum until we know better
+        self.callback = None
+        self.reader = None
+
+    def open_sockets(self):
+        """ Return (write socket, notify socket, MTU), see __init__ """
+        raise NotImplementedError
+
+    def close_sockets(self):
+        """ Gets called after disconnecting, for subclasses that need to clean up """
+        pass
+
+    def is_connected(self):
+        return self.writeSocket is not None
+
+    def connect(self):
+        if self.is_connected():
+            return
+        self.writeSocket, self.notifySocket, self.mtuValue = self.open_sockets()
+        self.reader = threading.Thread(target=self.read_notifications, args=(self.notifySocket,), daemon=True)
+        self.reader.start()
+
+    def disconnect(self):
+        if not self.is_connected():
+            return
+        writeSocket, notifySocket = self.writeSocket, self.notifySocket
+        self.writeSocket = self.notifySocket = None
+        for sock in (writeSocket, notifySocket):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        if self.reader is not threading.current_thread():
+            self.reader.join()
+        self.close_sockets()
+
+    def mtu(self):
+        return self.mtuValue
+
+    def notify(self, service, characteristic, callback):
+        self.callback = callback
+
+    def write_command(self, service, characteristic, data):
+        if not self.is_connected():
+            raise RuntimeError('Transport is not connected')
+        self.writeSocket.send(data)
+
+    def write_request(self, service, characteristic, data):
+        # the socket only does writes without response, but it does block until
+        # the kernel took the write, which is all the client needs it for
+        self.write_command(service, characteristic, data)
+
+    def read_notifications(self, notifySocket):
+        """ Pass every notification on to the callback until the socket closes """
+        while True:
+            try:
+                data = notifySocket.recv(MAX_ATTRIBUTE_LENGTH)
+            except OSError:
+                break
+            if not data:
+                break
+            if self.callback:
+                self.callback(data)
+        if notifySocket is self.notifySocket:  # closed from the other side
+            self.disconnect()
+
+
+class BluezTransport(SocketTransport):
+    """
+    Connects through BlueZ over D-Bus (using jeepney), then writes and gets
+    notifications through the sockets BlueZ returns from AcquireWrite and
+    AcquireNotify. The printer has to be known to BlueZ, e.g. by scanning for
+    it once with bluetoothctl.
+    """
+
+    def __init__(self, address, adapter='hci0', name='INSTAX', timeout=10, service=SERVICE_UUID,
+                 write_characteristic=WRITE_CHAR_UUID, notify_characteristic=NOTIFY_CHAR_UUID):
+        super().__init__(name=name, address=address.upper())
+        self.adapterName = adapter
+        self.timeout = timeout
+        self.serviceUUID = service
+        self.writeCharUUID = write_characteristic
+        self.notifyCharUUID = notify_characteristic
+        self.devicePath = f"/org/bluez/{adapter}/dev_{self.addressValue.replace(':', '_')}"
+        self.connection = None
+
+    def call(self, path, interface, method, signature=None, body=()):
+        """ Call a BlueZ method and return the reply's body """
+        from jeepney import DBusAddress, new_method_call, unwrap_msg
+        address = DBusAddress(path, bus_name='org.bluez', interface=interface)
+        return unwrap_msg(self.connection.send_and_get_reply(new_method_call(address, method, signature, body), timeout=self.timeout))
+
+    def get_property(self, path, interface, name):
+        variant = self.call(path, 'org.freedesktop.DBus.Properties', 'Get', 'ss', (interface, name))[0]
+        return variant[1]
+
+    def find_characteristics(self):
+        """ The D-Bus paths of the printer's characteristics, by UUID """
+        objects = self.call('/', 'org.freedesktop.DBus.ObjectManager', 'GetManagedObjects')[0]
+        characteristics = {}
+        for path, interfaces in objects.items():
+            if path.startswith(self.devicePath + '/') and 'org.bluez.GattCharacteristic1' in interfaces:
+                characteristics[interfaces['org.bluez.GattCharacteristic1']['UUID'][1]] = path
+        return characteristics
+
+    def open_sockets(self):
+        try:
+            from jeepney.io.blocking import open_dbus_connection
+        except ImportError:
+            raise ImportError('BluezTransport needs jeepney: pip install jeepney')
+
+        self.connection = open_dbus_connection(bus='SYSTEM', enable_fds=True)
+        try:
+            self.call(self.devicePath, 'org.bluez.Device1', 'Connect')
+            deadline = monotonic() + self.timeout
+            while not self.get_property(self.devicePath, 'org.bluez.Device1', 'ServicesResolved'):
+                if monotonic() > deadline:
+                    raise ConnectionError(f"Services of {self.addressValue} weren't resolved within {self.timeout}s")
+                sleep(0.1)
+            if self.name == 'INSTAX':
+                self.name = self.get_property(self.devicePath, 'org.bluez.Device1', 'Name')
+
+            characteristics = self.find_characteristics()
+            for uuid in (self.writeCharUUID, self.notifyCharUUID):
+                if uuid not in characteristics:
+                    raise ConnectionError(f'Printer has no characteristic {uuid}')
+            writeFd, mtu = self.call(characteristics[self.writeCharUUID], 'org.bluez.GattCharacteristic1', 'AcquireWrite', 'a{sv}', ({},))
+            notifyFd, _ = self.call(characteristics[self.notifyCharUUID], 'org.bluez.GattCharacteristic1', 'AcquireNotify', 'a{sv}', ({},))
+        except Exception:
+            self.close_sockets()
+            raise
+        return writeFd.to_socket(), notifyFd.to_socket(), mtu
+
+    def close_sockets(self):
+        """ Disconnect the printer and close our D-Bus connection """
+        if self.connection is None:
+            return
+        try:
+            self.call(self.devicePath, 'org.bluez.Device1', 'Disconnect')
+        except Exception:
+            pass  # already disconnected
+        self.connection.close()
+        self.connection = None
@@ -49,6 +49,14 @@ PrinterSettings = {
     }
 }
 
+# the printer's GATT service and the characteristics we write to and get notifications from
+SERVICE_UUID = '70954782-2d83-473d-9e5f-81e1d02d5273'
+WRITE_CHAR_UUID = '70954783-2d83-473d-9e5f-81e1d02d5273'
+NOTIFY_CHAR_UUID = '70954784-2d83-473d-9e5f-81e1d02d5273'
+
+# ways to find the JPEG quality that fits the file size limit, see ImageEncoder
+QUALITY_MODES = ('search', 'predict')
+
 
 class EventType (Enum):
     """ Events we can send to the printer """
@@ -0,0 +1,130 @@
+import asyncio
+import os
+from time import monotonic
+
+import pytest
+
+from AsyncInstaxBLE import AsyncInstaxBLE
+from PrintQueue import PrintQueue
+from SimulatedPrinter import SimulatedPrinter
+from Types import EventType, InfoType
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example-mini.jpg')
+
+
+class ForgetfulPrinter(SimulatedPrinter):
+    """ Doesn't answer image chunks after reconnecting, until the transfer gets started over """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ignoreChunks = False
+
+    def connect(self):
+        self.ignoreChunks = self.imageSize is not None
+        super().connect()
+
+    def handle_packet(self, packet):
+        event = (packet[4], packet[5])
+        if event == EventType.PRINT_IMAGE_DOWNLOAD_START.value:
+            self.ignoreChunks = False
+        elif event == EventType.PRINT_IMAGE_DOWNLOAD_DATA.value and self.ignoreChunks:
+            return None
+        return super().handle_packet(packet)
+
+
+def print_with_drop(printer, window):
+    """ Print on <printer>, dropping the connection once a few packets were acknowledged. Returns the client. """
+    instax = AsyncInstaxBLE(peripheral=printer, quiet=True, transfer_window=window, timeout=0.2)
+
+    async def run():
+        await instax.connect()
+        task = asyncio.ensure_future(instax.print_image(IMAGE))
+        while instax.transferPosition < 5:
+            await asyncio.sleep(0.001)
+        printer.disconnect()
+        assert await task
+        await instax.disconnect()
+
+    asyncio.run(run())
+    return instax
+
+
+def simulated_printer(cls=SimulatedPrinter):
+    return cls('mini', latency=0.002, write_latency=0, bandwidth=1_000_000)
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_resume_after_drop(window):
+    printer = simulated_printer()
+    instax = print_with_drop(printer, window)
+    assert instax.stats.resumes == 1
+    assert instax.stats.restarts == 0
+    assert len(printer.receivedImages) == 1 and printer.imageComplete is not None
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_restart_when_resuming_gets_no_reply(window):
+    printer = simulated_printer(ForgetfulPrinter)
+    instax = print_with_drop(printer, window)
+    assert instax.stats.resumes == 1
+    assert instax.stats.restarts == 1
+    assert len(printer.receivedImages) == 1 and printer.imageComplete is not None
+
+
+def test_lost_replies_dont_skew_round_trip_times():
+    printer = SimulatedPrinter('mini', latency=0.005, write_latency=0, bandwidth=1_000_000, loss=0.2, seed=1)
+    instax = AsyncInstaxBLE(peripheral=printer, quiet=True, timeout=0.05)
+    rtts = []
+
+    async def run():
+        printer.loss = 0
+        await instax.connect()
+        printer.loss = 0.2
+        instax.on('reply_received', lambda event, rtt, packet: rtts.append(rtt))
+        for i in range(50):
+            try:
+                await instax.request_info([InfoType.BATTERY_INFO])
+            except asyncio.TimeoutError:
+                pass
+        await instax.disconnect()
+
+    asyncio.run(run())
+    assert printer.packetsLost > 0
+    # a reply matched to an earlier, lost command would take at least one timeout
+    assert all(rtt < instax.timeout for rtt in rtts)
+    assert len(instax.sentTimes) == 0
+
+
+class RejectingPrinter(SimulatedPrinter):
+    """ Replies to one kind of command with status 1 """
+
+    def __init__(self, rejects, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rejects = rejects
+
+    def handle_packet(self, packet):
+        if (packet[4], packet[5]) == self.rejects.value:
+            return self.create_reply(self.rejects.value, b'\x01')
+        return super().handle_packet(packet)
+
+
+@pytest.mark.parametrize('rejects', [EventType.PRINT_IMAGE_DOWNLOAD_START, EventType.PRINT_IMAGE_DOWNLOAD_END, EventType.PRINT_IMAGE])
+@pytest.mark.parametrize('window', [1, 8])
+def test_rejected_print(rejects, window):
+    printer = RejectingPrinter(rejects, 'mini', latency=0.002, write_latency=0, bandwidth=1_000_000)
+    instax = AsyncInstaxBLE(peripheral=printer, quiet=True, print_enabled=True, transfer_window=window)
+    queue = PrintQueue(instax)
+
+    async def run():
+        await instax.connect()
+        job = queue.add(IMAGE)
+        start = monotonic()
+        await queue.run_one()
+        await instax.disconnect()
+        return job, monotonic() - start
+
+    job, duration = asyncio.run(run())
+    assert job.status == 'failed'
+    assert str(job.error) == f'Printer rejected {rejects.name} (status 1)'
+    assert duration < 2  # not waiting for a print that isn't coming
+    assert instax.transferWindow == window
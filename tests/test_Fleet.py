@@ -0,0 +1,47 @@
+import asyncio
+import os
+from functools import partial
+
+from Fleet import Fleet
+from SimulatedPrinter import SimulatedAdapter, SimulatedPrinter
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example-mini.jpg')
+
+
+def simulated_printer(number, photos_left):
+    return SimulatedPrinter('mini', name=f'INSTAX-0000000{number}(IOS)', address=f'FA:AB:BC:00:00:0{number}', photos_left=photos_left,
+                            latency=0.001, write_latency=0, bandwidth=10_000_000, print_time=0.05)
+
+
+def run_fleet(photosLeft, jobs):
+    """ Print <jobs> images on simulated printers with <photosLeft> photos each, returns the jobs and the printers """
+    printers = [simulated_printer(number, photos) for number, photos in enumerate(photosLeft, 1)]
+
+    async def run():
+        fleet = Fleet(adapters=[SimulatedAdapter(printers)], print_enabled=True, quiet=True)
+        try:
+            assert await fleet.discover(scanTime=0) == len(printers)
+            # the simulated printers print quickly, so don't wait a second between status requests
+            for printer in fleet.printers:
+                printer.instax.wait_for_print_completion = partial(printer.instax.wait_for_print_completion, interval=0.02)
+            submitted = [fleet.submit(IMAGE) for _ in range(jobs)]
+            await fleet.join()
+            return submitted
+        finally:
+            await fleet.disconnect()
+
+    return asyncio.run(run()), printers
+
+
+def test_single_printer_uses_all_film():
+    jobs, printers = run_fleet([2], 2)
+    assert [job.status for job in jobs] == ['printed', 'printed']
+    assert printers[0].photosLeft == 0
+
+
+def test_fleet_uses_all_film():
+    jobs, printers = run_fleet([2, 3], 7)
+    statuses = [job.status for job in jobs]
+    assert statuses.count('printed') == 5
+    assert statuses.count('skipped') == 2
+    assert [printer.photosLeft for printer in printers] == [0, 0]
@@ -0,0 +1,70 @@
+from struct import pack
+
+from FrameParser import CLIENT_HEADER, MAX_PACKET_LENGTH, FrameReassembler
+from SimulatedPrinter import SimulatedPrinter
+from Types import EventType
+
+printer = SimulatedPrinter('mini')
+REPLIES = [printer.create_reply(EventType.SUPPORT_FUNCTION_INFO.value, b'\x00' + printer.function_info(infoType)) for infoType in range(3)] + \
+          [printer.create_reply(EventType.PRINT_IMAGE_DOWNLOAD_DATA.value, pack('>BI', 0, index)) for index in range(100)]
+STREAM = b''.join(REPLIES)
+
+
+def feed(reassembler, notifications):
+    return [frame for notification in notifications for frame in reassembler.feed(notification)]
+
+
+def split(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def test_one_frame_per_notification():
+    assert feed(FrameReassembler(), REPLIES) == REPLIES
+
+
+def test_split_frames():
+    for size in (1, 3, 20):
+        assert feed(FrameReassembler(), split(STREAM, size)) == REPLIES
+
+
+def test_coalesced_frames():
+    reassembler = FrameReassembler()
+    assert feed(reassembler, split(STREAM, 509)) == REPLIES
+    assert reassembler.droppedBytes == 0
+
+
+def test_garbage_before_frames():
+    reassembler = FrameReassembler()
+    assert feed(reassembler, [b'\x00\x61\xff' + STREAM[:30]] + split(STREAM[30:], 20)) == REPLIES
+    assert reassembler.droppedBytes == 3
+
+
+def test_corrupted_length():
+    # a header with a length that doesn't fit the protocol, followed by valid replies
+    reassembler = FrameReassembler()
+    assert feed(reassembler, [b'aB\x10\x00' + bytes(4)] + REPLIES) == REPLIES
+
+
+def test_corrupted_length_within_limit():
+    # a plausible length, so it takes a checksum to find out the frame isn't real
+    reassembler = FrameReassembler()
+    assert feed(reassembler, [b'aB\x00\x40' + bytes(4)] + split(STREAM, 20)) == REPLIES
+
+
+def test_corrupted_checksum():
+    corrupted = bytearray(REPLIES[1])
+    corrupted[-1] ^= 0xff
+    assert feed(FrameReassembler(), [REPLIES[0], bytes(corrupted), REPLIES[2]]) == [REPLIES[0], REPLIES[2]]
+
+
+def test_reset_drops_partial_frame():
+    reassembler = FrameReassembler()
+    assert reassembler.feed(REPLIES[0][:5]) == []
+    reassembler.reset()
+    assert feed(reassembler, REPLIES[1:3]) == REPLIES[1:3]
+
+
+def test_client_packets_longer_than_replies():
+    packet = CLIENT_HEADER + pack('>H', 1819) + bytes(EventType.PRINT_IMAGE_DOWNLOAD_DATA.value) + bytes(1812)
+    packet += bytes([(255 - sum(packet)) & 255])
+    assert feed(FrameReassembler(CLIENT_HEADER, MAX_PACKET_LENGTH), split(packet, 182)) == [packet]
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+from PIL import Image, ImageFilter
+
+from ImageEncoder import JpegEncoder, search_quality, predict_quality
+from Types import PrinterSettings
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example-wide.jpg')
+
+
+def images():
+    noise = Image.effect_noise((1600, 1600), 90).convert('RGB')
+    yield noise
+    yield noise.filter(ImageFilter.GaussianBlur(2))
+    yield Image.effect_mandelbrot((1600, 1600), (-2, -1.5, 1, 1.5), 200).convert('RGB')
+    with Image.open(IMAGE) as img:
+        yield img.convert('RGB')
+
+
+@pytest.mark.parametrize('model', ['mini', 'square', 'wide'])
+def test_predict_matches_search(model):
+    size = (PrinterSettings[model]['width'], PrinterSettings[model]['height'])
+    maxSize = 105 * 1024
+    for img in images():
+        img = img.resize(size, Image.Resampling.LANCZOS)
+        searched = JpegEncoder(img)
+        searchQuality, searchData = search_quality(searched, maxSize, maxSize * 0.9)
+        predicted = JpegEncoder(img)
+        quality, data = predict_quality(predicted, maxSize, maxSize * 0.9)
+        assert len(data) <= len(searchData)
+        assert quality == searchQuality
+        assert predicted.encodes <= searched.encodes
@@ -0,0 +1,22 @@
+import os
+from time import monotonic
+
+from InstaxBLE import InstaxBLE
+from SimulatedPrinter import SimulatedPrinter
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example-mini.jpg')
+
+
+def test_rejected_print_isnt_waited_for():
+    printer = SimulatedPrinter('mini', latency=0.002, write_latency=0, bandwidth=1_000_000)
+    instax = InstaxBLE(peripheral=printer, quiet=True, print_enabled=True)
+    try:
+        instax.connect()
+        printer.photosLeft = 0  # ran out since we connected, so the printer rejects the print
+        start = monotonic()
+        instax.print_image(IMAGE)
+        assert instax.wait_for_print_completion(timeout=10, interval=0.05) is None
+        assert monotonic() - start < 5
+        assert instax.printError == 'Printer rejected PRINT_IMAGE (status 1)'
+    finally:
+        instax.disconnect()
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from Packetizer import byte_sum, create_image_data_packets
+
+
+@pytest.mark.parametrize('size', [0, 1, 255, 256, 257, 1808, 5000])
+def test_byte_sum_matches_sum(size):
+    for data in (b'\xff' * size, os.urandom(size)):
+        assert byte_sum(memoryview(data)) == sum(data)
+
+
+def test_packets_carry_the_image_and_valid_checksums():
+    imgData = bytearray(os.urandom(10_000))
+    packets = create_image_data_packets(imgData, 1808)
+    assert len(packets) == 6
+    assert all(sum(packet) & 255 == 255 for packet in packets)
+    assert [int.from_bytes(packet[6:10], 'big') for packet in packets] == list(range(6))
+    data = b''.join(bytes(packet[10:-1]) for packet in packets)
+    assert data[:len(imgData)] == imgData
+    assert data[len(imgData):] == bytes(len(data) - len(imgData))
+    imgData.extend(b'\x00')  # the image isn't held on to after packetizing
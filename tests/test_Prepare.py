@@ -0,0 +1,20 @@
+import os
+
+from PIL import Image
+
+from Prepare import prepare_directory
+
+
+def test_same_name_different_extension(tmp_path):
+    source = tmp_path / 'images'
+    source.mkdir()
+    for name, color in (('photo.jpg', 'red'), ('photo.png', 'blue'), ('photo.png.jpg', 'green')):
+        Image.new('RGB', (900, 900), color).save(source / name)
+
+    prepared, errors = prepare_directory(str(source), str(tmp_path / 'prepared'), ['mini'], workers=1)
+    assert prepared == 2
+    assert list(errors) == ['photo.png.jpg']  # would be written to the same file as photo.png
+    outputDir = tmp_path / 'prepared' / 'mini'
+    assert sorted(os.listdir(outputDir)) == ['photo.jpg', 'photo.png.jpg']
+    with Image.open(outputDir / 'photo.png.jpg') as img:
+        assert img.convert('RGB').getpixel((300, 400))[2] > 200  # the blue one
@@ -0,0 +1,36 @@
+import pytest
+
+from InstaxBLE import InstaxBLE
+from SimulatedPrinter import SimulatedPrinter, SimulatedSocketPrinter
+from Transports import Transport, SocketTransport
+
+
+def test_incomplete_transport_fails_on_creation():
+    class WriteOnly(Transport):
+        def write_command(self, service, characteristic, data):
+            pass
+
+    with pytest.raises(TypeError):
+        WriteOnly()
+
+
+def test_socket_transport_needs_open_sockets():
+    with pytest.raises(TypeError):
+        SocketTransport()
+
+    class Opened(SocketTransport):
+        def open_sockets(self):
+            return None, None, 23
+
+    Opened()
+
+
+def test_socket_transport_with_open_sockets_passed_in():
+    printer = SimulatedSocketPrinter(SimulatedPrinter('mini', latency=0.001, write_latency=0, bandwidth=10_000_000))
+    instax = InstaxBLE(peripheral=SocketTransport(printer.open_sockets, printer.printer.name), quiet=True)
+    try:
+        instax.connect()
+        assert instax.printerModel == 'mini'
+        assert instax.photosLeft == 10
+    finally:
+        instax.disconnect()